@@ -0,0 +1,90 @@
+"""
+Benchmark of the schema codec against plain JSON for sensor samples
+
+Writes count samples of a typical sensor (temperature, humidity, pressure,
+battery, a sequence number) both ways and reports the size of the request
+message that goes on the wire, the time to encode and to decode them and,
+on the board, the heap allocated per sample:
+
+    import bench.codec_bench
+    bench.codec_bench.run()
+
+or on a desktop python:
+
+    python3 -m bench.codec_bench
+"""
+
+import sys
+import time
+import ujson
+
+from src.firebase.codec import Schema
+
+try:
+    import gc
+    _alloc = gc.mem_alloc
+except (ImportError, AttributeError):
+    _alloc = None
+
+try:
+    _ticks = time.ticks_us
+    _diff = time.ticks_diff
+except AttributeError:
+    def _ticks():
+        return int(time.perf_counter() * 1000000)
+
+    def _diff(end, start):
+        return end - start
+
+SCHEMA = Schema('Sample', [('temp', 'f'), ('hum', 'B'), ('pressure', 'f'), ('battery', 'H'), ('seq', 'I')])
+
+
+def _samples(count):
+    return [{"temp": 20.0 + (i % 50) / 10, "hum": 40 + i % 20, "pressure": 1013.25 - (i % 30) / 4,
+             "battery": 3300 - i % 100, "seq": i} for i in range(count)]
+
+
+def _message(path, value):
+    # the request set() sends
+    return ujson.dumps({"t": "d", "d": {"r": 1, "a": "p", "b": {"p": path, "d": value}}})
+
+
+def _measure(function, items):
+    # (total us, heap bytes per item or None)
+    if _alloc is not None:
+        gc.collect()
+        before = _alloc()
+    start = _ticks()
+    for item in items:
+        function(item)
+    elapsed = _diff(_ticks(), start)
+    perItem = None
+    if _alloc is not None:
+        perItem = (_alloc() - before) // len(items)
+    return elapsed, perItem
+
+
+def run(count=200, path='devices/pico1/samples/0'):
+    samples = _samples(count)
+    record = SCHEMA.new()
+    jsonTexts = [ujson.dumps(s) for s in samples]
+    packed = [SCHEMA.encode(s) for s in samples]
+    jsonWire = sum(len(_message(path, s)) for s in samples) // count
+    packedWire = sum(len(_message(path, p)) for p in packed) // count
+    rows = (
+        ('json', jsonWire, sum(len(t) for t in jsonTexts) // count,
+         _measure(ujson.dumps, samples), _measure(ujson.loads, jsonTexts)),
+        ('codec', packedWire, sum(len(p) for p in packed) // count,
+         _measure(SCHEMA.encode, samples), _measure(lambda p: SCHEMA.decode(p, record), packed)),
+    )
+    print("{} samples".format(count))
+    print("format  message(B)  value(B)  encode(us)  decode(us)  encode heap(B)  decode heap(B)")
+    for name, wire, value, encoded, decoded in rows:
+        print("{:<7} {:>10} {:>9} {:>11} {:>11} {:>15} {:>15}".format(
+            name, wire, value, encoded[0] // count, decoded[0] // count, str(encoded[1]), str(decoded[1])))
+    batch = SCHEMA.encodeMany(samples[:10])
+    print("10 samples in one value: {} B packed, {} B as JSON".format(len(batch), len(ujson.dumps(samples[:10]))))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
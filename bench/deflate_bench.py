@@ -0,0 +1,72 @@
+"""
+Benchmark of permessage-deflate on Firebase traffic
+
+Compresses every message of a recording the way the server does with
+permessage-deflate (each message on its own, server_no_context_takeover) for
+a range of window sizes, and reports the bytes on the wire, the time it takes
+to inflate them and an estimate of the radio on time at linkKbps. The
+recording is a text file with one websocket message per line, e.g. written
+by an onDataReceived that does
+
+    with open('traffic.txt', 'a') as f:
+        f.write(str(payload) + '\\n')
+
+Without a recording a generated sensor snapshot is used. Compressing needs a
+desktop python or a firmware with deflate compression:
+
+    python3 -m bench.deflate_bench traffic.txt
+"""
+
+import sys
+import time
+import ujson
+
+from src.firebase.compression import deflateRaw, inflateRaw
+
+try:
+    _ticks = time.ticks_us
+    _diff = time.ticks_diff
+except AttributeError:
+    def _ticks():
+        return int(time.perf_counter() * 1000000)
+
+    def _diff(end, start):
+        return end - start
+
+_TAIL = b'\x00\x00\xff\xff\x03\x00'
+
+
+def load(path=None):
+    if path is None:
+        data = {}
+        for i in range(100):
+            data['sensor_%d' % i] = {"temp": 20.5 + i, "hum": 40 + i % 7, "label": "room number %d" % i}
+        return [ujson.dumps({"t": "d", "d": {"b": {"p": "devices", "d": data}, "a": "d"}}).encode('utf-8')]
+    with open(path) as f:
+        return [line.rstrip('\n').encode('utf-8') for line in f if line.strip()]
+
+
+def run(path=None, windowBits=(9, 11, 13, 15), linkKbps=1000):
+    messages = load(path)
+    raw = sum(len(m) for m in messages)
+    print("{} messages, {} bytes, radio {} ms uncompressed".format(len(messages), raw, raw * 8 // linkKbps))
+    print("wbits  window(B)   wire(B)  ratio   inflate(us)  radio(ms)")
+    for bits in windowBits:
+        compressed = []
+        for message in messages:
+            out = deflateRaw(message, bits)
+            if out is None:
+                print("this firmware can't compress, run the benchmark on a desktop python")
+                return
+            compressed.append(out)
+        wire = sum(len(c) for c in compressed)
+        start = _ticks()
+        for c in compressed:
+            inflateRaw(c + _TAIL, bits)
+        elapsed = _diff(_ticks(), start)
+        print("{:>5} {:>10} {:>9}  {:>5.1f} {:>13} {:>10}".format(
+            bits, 1 << bits, wire, raw / wire, elapsed, wire * 8 // linkKbps))
+
+
+if __name__ == '__main__':
+    run(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,92 @@
+"""
+Benchmark of the streaming Firebase message parser against json.loads
+
+Builds a realtime database snapshot of a number of sensors and measures the
+latency and the peak memory of parsing it whole with json.loads versus
+feeding it in websocket sized chunks to FirebaseMessageParser, with and
+without skipping the subtrees the application does not want. Run it on the
+board, or from the project root with the MicroPython unix port:
+
+    micropython -m bench.json_bench
+"""
+
+import gc
+import time
+import ujson
+
+from src.firebase.jsonstream import FirebaseMessageParser, prefixFilter
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    _ticks = time.ticks_us
+    _diff = time.ticks_diff
+except AttributeError:
+    def _ticks():
+        return int(time.perf_counter() * 1000000)
+
+    def _diff(end, start):
+        return end - start
+
+CHUNK = 512
+
+
+def make_message(sensors):
+    data = {}
+    for i in range(sensors):
+        data['sensor_%d' % i] = {"temp": 20.5 + i, "hum": 40 + i % 7, "label": "room number %d" % i,
+                                 "history": [i, i + 1, i + 2, i + 3]}
+    return ujson.dumps({"t": "d", "d": {"b": {"p": "devices", "d": data}, "a": "d"}})
+
+
+def _measure(func):
+    # returns (microseconds, peak bytes allocated while running func)
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        start = _ticks()
+        func()
+        elapsed = _diff(_ticks(), start)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak
+    # on MicroPython there is no peak tracking, disable the gc and count what got allocated
+    gc.disable()
+    before = gc.mem_alloc()
+    start = _ticks()
+    func()
+    elapsed = _diff(_ticks(), start)
+    used = gc.mem_alloc() - before
+    gc.enable()
+    return elapsed, used
+
+
+def run(sizes=(10, 100, 500)):
+    print("sensors   bytes   loads(us)  loads(B)   stream(us)  stream(B)   selective(us)  selective(B)")
+    for sensors in sizes:
+        message = make_message(sensors).encode('utf-8')
+        chunks = [message[i:i + CHUNK] for i in range(0, len(message), CHUNK)]
+        values = []
+
+        def whole():
+            values.append(ujson.loads(message))
+
+        def stream(accept=None):
+            parser = FirebaseMessageParser(lambda path, value: None, None, accept)
+            for chunk in chunks:
+                parser.feed(chunk)
+            parser.end()
+
+        wanted = prefixFilter(['devices/sensor_1/temp'])
+        results = [_measure(whole), _measure(stream), _measure(lambda: stream(wanted))]
+        del values[:]
+        print("{:>7} {:>7}   {:>9} {:>9}   {:>10} {:>10}   {:>13} {:>13}".format(
+            sensors, len(message),
+            results[0][0], results[0][1], results[1][0], results[1][1], results[2][0], results[2][1]))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,78 @@
+"""
+Micro benchmark for websocket payload masking
+
+Compares the original per byte generator with the in place masking engine
+for payloads from 16 B to 64 KB. Runs on the Pico W (copy bench/ and src/ to
+the board) or on a desktop python from the project root. It prints the engine
+mask() runs on (viper on the board, bigint elsewhere) and, where gc.mem_alloc
+exists, the heap bytes one in-place call allocates:
+
+    python -m bench.mask_bench
+"""
+
+import gc
+import time
+
+from src.firebase.masking import mask, mask_generator, ENGINE
+
+SIZES = (16, 64, 256, 1024, 4096, 16384, 65536)
+MASK_BITS = b'\x12\x34\x56\x78'
+
+try:
+    _ticks = time.ticks_us
+    _diff = time.ticks_diff
+except AttributeError:
+    def _ticks():
+        return int(time.perf_counter() * 1000000)
+
+    def _diff(end, start):
+        return end - start
+
+
+def _time_us(func, rounds):
+    start = _ticks()
+    for _ in range(rounds):
+        func()
+    return _diff(_ticks(), start)
+
+
+def _allocated(func):
+    # heap bytes allocated by one call, None where gc can't tell
+    if not hasattr(gc, 'mem_alloc'):
+        return None
+    gc.collect()
+    gc.disable()
+    before = gc.mem_alloc()
+    func()
+    after = gc.mem_alloc()
+    gc.enable()
+    return after - before
+
+
+def run(sizes=SIZES, budget=65536):
+    print("engine:", ENGINE)
+    print("size(B)   generator(KB/s)   in-place(KB/s)   speedup   in-place alloc(B)")
+    for size in sizes:
+        payload = bytes(i & 0xff for i in range(size))
+        buf = bytearray(payload)
+        rounds = max(1, budget // size)
+
+        # sanity check: both implementations must agree
+        assert bytes(mask(bytearray(payload), MASK_BITS)) == mask_generator(payload, MASK_BITS)
+
+        gen_us = _time_us(lambda: mask_generator(payload, MASK_BITS), rounds) or 1
+        inplace_us = _time_us(lambda: mask(buf, MASK_BITS, size), rounds) or 1
+
+        allocated = _allocated(lambda: mask(buf, MASK_BITS, size))
+
+        total_kb = size * rounds / 1024
+        print("{:>7}   {:>15.1f}   {:>14.1f}   {:>6.1f}x   {:>17}".format(
+            size,
+            total_kb * 1000000 / gen_us,
+            total_kb * 1000000 / inplace_us,
+            gen_us / inplace_us,
+            '-' if allocated is None else allocated))
+
+
+if __name__ == '__main__':
+    run()
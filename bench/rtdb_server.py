@@ -0,0 +1,300 @@
+"""
+Local stand-in for the Firebase realtime database websocket
+
+Speaks enough of the realtime wire protocol for the clients in src/firebase
+to be exercised without the real service: the websocket upgrade, the
+connection handshake, 'auth', 'q' (listen, answered with only the ack when
+the hash the client sent matches the data), 'n' (unlisten), 'p' (set) and
+'m' (merge), with the writes pushed to every connection listening to the
+path. Pings are answered and messages longer than FRAGMENT_BYTES are sent
+in several frames. Run it with a desktop python from the project root:
+
+    python3 -m bench.rtdb_server 8765
+
+and point the client at it with "socketUrl": "ws://<pc address>:8765/.ws?v=5".
+Every token is accepted except 'wrong'.
+
+    python3 -m bench.rtdb_server --check
+
+checks nodeHash against hashes worked out independently, then runs the
+asyncio client against it: authentication, listening with and without a
+matching mirror hash across reconnects, writes and their pushes, and a
+keep alive ping.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import sys
+
+import src.utils.compat
+from src.firebase.hashing import nodeHash
+
+FRAGMENT_BYTES = 512
+_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def _keys(path):
+    return [key for key in path.split('/') if key]
+
+
+def _frame(opcode, data, fin=True):
+    length = len(data)
+    byte1 = (0x80 if fin else 0) | opcode
+    if length < 126:
+        return struct.pack('!BB', byte1, length) + data
+    if length < (1 << 16):
+        return struct.pack('!BBH', byte1, 126, length) + data
+    return struct.pack('!BBQ', byte1, 127, length) + data
+
+
+class RTDBServer:
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else {}
+        # writer -> paths it listens to
+        self.listeners = {}
+        self.connections = 0
+        self.requests = []
+        self.snapshots = 0
+        self.hashHits = 0
+        self.pings = 0
+
+    def get(self, path):
+        value = self.data
+        for key in _keys(path):
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    def put(self, path, value):
+        keys = _keys(path)
+        if not keys:
+            self.data = value if isinstance(value, dict) else {}
+            return
+        node = self.data
+        for key in keys[:-1]:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            node = node[key]
+        if value is None:
+            node.pop(keys[-1], None)
+        else:
+            node[keys[-1]] = value
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        key = b''
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'sec-websocket-key':
+                key = value.strip()
+        accept = base64.b64encode(hashlib.sha1(key + _GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        self.send(writer, {'t': 'c', 'd': {'t': 'h', 'd': {'ts': 1713601266283, 'v': '5', 'h': 'localhost',
+                                                                 's': 'session'}}})
+        self.listeners[writer] = set()
+        try:
+            while True:
+                opcode, data = await self.readMessage(reader)
+                if opcode == 8:
+                    writer.write(_frame(8, data[:2]))
+                    break
+                if opcode == 9:
+                    self.pings += 1
+                    writer.write(_frame(10, data))
+                elif opcode == 1 and data != b'0':
+                    self.answer(writer, json.loads(data)['d'])
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        del self.listeners[writer]
+        writer.close()
+
+    async def readMessage(self, reader):
+        # a whole message, the continuation frames put together
+        message = b''
+        opcode = None
+        while True:
+            byte1, byte2 = struct.unpack('!BB', await reader.readexactly(2))
+            length = byte2 & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', await reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await reader.readexactly(8))
+            mask = await reader.readexactly(4) if byte2 & 0x80 else None
+            data = bytearray(await reader.readexactly(length))
+            if mask:
+                for i in range(length):
+                    data[i] ^= mask[i & 3]
+            if opcode is None:
+                opcode = byte1 & 0x0f
+            message += data
+            if byte1 & 0x80:
+                return opcode, message
+
+    def send(self, writer, message):
+        data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+        pieces = [data[i:i + FRAGMENT_BYTES] for i in range(0, len(data), FRAGMENT_BYTES)] or [b'']
+        for i, piece in enumerate(pieces):
+            writer.write(_frame(1 if i == 0 else 0, piece, i == len(pieces) - 1))
+
+    def answer(self, writer, request):
+        self.requests.append((request.get('a'), request.get('b')))
+        action = request.get('a')
+        body = request.get('b') or {}
+        status = 'ok'
+        reply = {}
+        if action == 'auth':
+            if body.get('cred') == 'wrong':
+                status, reply = 'invalid_token', 'Invalid claim'
+            else:
+                reply = {'auth': {'uid': 'uid', 'provider': 'password'}, 'expires': 1713604863}
+        elif action == 'q':
+            path = '/'.join(_keys(body.get('p', '')))
+            self.listeners[writer].add(path)
+            value = self.get(path)
+            if body.get('h') and body['h'] == nodeHash(value):
+                # the client already has this data
+                self.hashHits += 1
+            else:
+                self.snapshots += 1
+                self.push(writer, 'd', path, value)
+        elif action == 'n':
+            self.listeners[writer].discard('/'.join(_keys(body.get('p', ''))))
+        elif action == 'p' or action == 'm':
+            path = '/'.join(_keys(body.get('p', '')))
+            data = body.get('d')
+            if action == 'm':
+                for key in data:
+                    self.put(path + '/' + key, data[key])
+            else:
+                self.put(path, data)
+            self.notify(action, path, data)
+        else:
+            status, reply = 'unknown_action', action
+        self.send(writer, {'t': 'd', 'd': {'r': request.get('r'), 'b': {'s': status, 'd': reply}}})
+
+    def push(self, writer, action, path, data):
+        self.send(writer, {'t': 'd', 'd': {'a': action, 'b': {'p': path, 'd': data}}})
+
+    def notify(self, action, path, data):
+        # hand a write to the connections listening at or around its path
+        for writer in self.listeners:
+            for listened in self.listeners[writer]:
+                if path == listened or path.startswith(listened + '/') or not listened:
+                    self.push(writer, 'd' if action == 'p' else 'm', path, data)
+                    break
+                if listened.startswith(path + '/') or not path:
+                    self.push(writer, 'd', listened, self.get(listened))
+
+
+# nodeHash against hashes worked out by hand the way the Firebase SDKs do it
+# (LeafNode.hash, ChildrenNode.hash): base64 sha1 of 'string:' + text,
+# 'number:' + the big endian IEEE 754 double in lower case hex, or
+# 'boolean:' + true/false; a node hashes ':' + key + ':' + child hash for
+# each child, keys that are 32 bit integers first in numeric order, the rest
+# after them in string order. Nothing here has a priority, which would put a
+# 'priority:' part in front.
+HASH_VECTORS = [
+    ('hello', 'z6sRbrNLwbHX5fdjpvsTtWgXUFc='),       # string:hello
+    ('', 'Ki0Xy0V6morg0TO3Sxi/jwugYDQ='),            # string:
+    (1, 'YPVfR2bXt/lcDjiQZ8pOkAd3qkQ='),             # number:3ff0000000000000
+    (1.0, 'YPVfR2bXt/lcDjiQZ8pOkAd3qkQ='),
+    (-2.5, 'eBj7htp2uFU6m+ykmQDcicyETbY='),          # number:c004000000000000
+    (True, 'E5z61QM0lN/U2WsOnusszCTkR8M='),          # boolean:true
+    (False, 'aSSNoqcS4oQwJ2xxH20rvpp3zP0='),         # boolean:false
+    # :a:<hash of 'a'>:b:<hash of 'b'>, whatever order the dict has
+    ({'b': 'b', 'a': 'a'}, 'jOZu/ixay8zZuvpq0Wh9D5XbNzw='),
+    # -1, 9, 10 as integers, then '09' and 'a' as strings
+    ({'a': 'a', '10': 'a', '09': 'b', '9': 'b', '-1': 'a'}, '5NHba6E1GFW2sqBbFSv5SWbqW2Q='),
+    ({'x': {'x': 'y'}}, 'e/Pr+ysp5gdM95IYVBjTUq+dL1k='),
+    # empty children leave no trace
+    ({'x': {'x': 'y', 'gone': None}, 'empty': {}}, 'e/Pr+ysp5gdM95IYVBjTUq+dL1k='),
+    (None, ''),
+    ({}, ''),
+]
+
+
+def checkHashes():
+    for value, expected in HASH_VECTORS:
+        assert nodeHash(value) == expected, (value, nodeHash(value), expected)
+    print('hashes:', len(HASH_VECTORS), 'vectors match')
+
+
+async def main(port):
+    server = RTDBServer({'my_data': {'foo': 'hello', 'bar': 'world'}})
+    listener = await asyncio.start_server(server.handle, '0.0.0.0', port)
+    print('realtime database server on port', port)
+    async with listener:
+        await listener.serve_forever()
+
+
+async def check():
+    from src.firebase.firebase_realtime_async import AsyncFirebaseRealTime
+
+    # the server below answers listens with the same nodeHash, check it first
+    checkHashes()
+    server = RTDBServer({'my_data': {'foo': 'hello', 'bar': 'world', 'big': 'x' * 2000}})
+    listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    details = {'socketUrl': 'ws://127.0.0.1:%d/.ws?v=5' % port, 'mirrorMaxBytes': 0, 'keepAliveMs': 300}
+    changes = []
+    rt = AsyncFirebaseRealTime(details, None)
+    await rt.connect()
+    replies = []
+    rt.authenticateWithSocket('token', lambda status, data: replies.append(status))
+    rt.subscribeToRealTime('my_data', lambda path, value: changes.append((path, value)))
+    # long enough for the keep alive, which looks once a second, to ping
+    await asyncio.sleep(1.5)
+    assert replies == ['ok'], replies
+    assert rt.get('my_data') == server.get('my_data'), rt.get('my_data')
+    assert server.snapshots == 1 and server.pings, (server.snapshots, server.pings)
+    print('listen: snapshot of', len(json.dumps(rt.get('my_data'))), 'bytes, keep alive pings', server.pings)
+
+    # nothing changed while away: the hash matches, only the ack comes back
+    await rt.reconnect()
+    await asyncio.sleep(0.3)
+    assert server.hashHits == 1 and server.snapshots == 1, (server.hashHits, server.snapshots)
+    assert ('auth', {'cred': 'token'}) in server.requests[2:]
+    print('reconnect, unchanged: hash hit, no snapshot')
+
+    # changed while away: the snapshot is sent again
+    server.put('my_data/foo', 'changed')
+    await rt.reconnect()
+    await asyncio.sleep(0.3)
+    assert server.snapshots == 2 and rt.get('my_data/foo') == 'changed', (server.snapshots, rt.get('my_data/foo'))
+    print('reconnect, changed: snapshot sent again')
+
+    status, data = await rt.request('m', {'p': 'my_data', 'd': {'bar': 'there'}})
+    await asyncio.sleep(0.2)
+    assert status == 'ok' and rt.get('my_data/bar') == 'there', (status, rt.get('my_data/bar'))
+    assert changes[-1] == ('my_data/bar', 'there'), changes[-1]
+    print('update: acknowledged and pushed back')
+
+    # a nested subscription dropped again leaves the data of the path above it alone
+    rt.subscribeToRealTime('my_data/foo', lambda path, value: None)
+    await asyncio.sleep(0.2)
+    rt.unsubscribe('my_data/foo')
+    await asyncio.sleep(0.2)
+    assert rt.get('my_data') == server.get('my_data'), rt.get('my_data')
+    assert rt.mirror.hash('my_data') == nodeHash(server.get('my_data'))
+    print('nested unsubscribe: the mirror still holds all of my_data')
+
+    await rt.close()
+    listener.close()
+    print('ok,', server.connections, 'connections,', len(server.requests), 'requests')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--check']:
+        asyncio.run(check())
+    else:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8765))
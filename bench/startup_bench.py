@@ -0,0 +1,55 @@
+"""
+Benchmark of boot to first data, with and without the saved tokens
+
+Measures, on the board, how long it takes from the start of the sign in
+until the first snapshot of a subscribed path arrives: once cold (no saved
+tokens, email/password sign in) and once warm (tokens from the TokenStore).
+It uses the settings in sec/ like main.py and needs the wifi to be connected
+already, e.g. run it from the REPL after main.py has connected:
+
+    import bench.startup_bench
+    bench.startup_bench.run('my_data/')
+"""
+
+import time
+
+from src.configs.readConfigs import dbConnectionsDetails, accountDetail
+from src.firebase.authenticator import Auth
+from src.firebase.firebase_realtime import FirebaseRealTime
+from src.firebase.token_manager import TokenManager
+from src.firebase.token_store import TokenStore
+
+
+def _boot(store, path, timeoutMs):
+    # returns (bootPath, sign in ms, socket ms, first data ms), first data is None on timeout
+    start = time.ticks_ms()
+    tokens = TokenManager(Auth(dbConnectionsDetails['fbKey']), store=store)
+    flg, headers = tokens.signIn(accountDetail['firebaseUserName'], accountDetail['firebaseUserPassword'])
+    if not flg:
+        raise RuntimeError(headers)
+    signedIn = time.ticks_ms()
+
+    received = []
+
+    def onDataReceived(payload):
+        if '"a":"d"' in str(payload):
+            received.append(time.ticks_ms())
+
+    firebaseRealtime = FirebaseRealTime(dbConnectionsDetails, None, onDataReceived)
+    connected = time.ticks_ms()
+    firebaseRealtime.authenticateWithSocket(headers['idToken'])
+    firebaseRealtime.subscribeToRealTime(path)
+    while not received and time.ticks_diff(time.ticks_ms(), start) < timeoutMs:
+        firebaseRealtime.listen()
+    firebaseRealtime.firebaseSocket.close()
+    firstData = time.ticks_diff(received[0], start) if received else None
+    return tokens.bootPath, time.ticks_diff(signedIn, start), time.ticks_diff(connected, signedIn), firstData
+
+
+def run(path='my_data/', storePath='sec/token.json', timeoutMs=30000):
+    store = TokenStore(storePath)
+    store.clear()
+    print("boot       path        sign in(ms)  socket(ms)  first data(ms)")
+    for name in ('cold', 'warm'):
+        result = _boot(store, path, timeoutMs)
+        print("{:<10} {:<11} {:>11} {:>11} {:>15}".format(name, result[0], result[1], result[2], result[3]))
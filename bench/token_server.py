@@ -0,0 +1,160 @@
+"""
+Local stand-in for the Firebase token endpoints
+
+Answers signInWithPassword (identitytoolkit) and token refresh (securetoken)
+requests the way Google does, over plain HTTP/1.1 with keep-alive, so Auth
+and HTTPClient can be exercised without the real services. Run it with a
+desktop python from the project root:
+
+    python3 -m bench.token_server 8080
+
+and point Auth at it:
+
+    Auth(apiKey, identityURL='http://<pc address>:8080', tokenURL='http://<pc address>:8080')
+
+Every password is accepted except 'wrong', tokens expire after EXPIRES_IN
+seconds and every other reply is sent chunked.
+
+    python3 -m bench.token_server --check
+
+runs Auth, HTTPClient and TokenManager against it instead: a sign in, a
+refresh on the kept-alive connection, a rejected password, and a refresh
+after the server dropped the idle connection.
+"""
+
+import asyncio
+import json
+import sys
+
+EXPIRES_IN = 3600
+
+
+class TokenServer:
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.writers = []
+
+    def dropConnections(self):
+        """Close the open connections, like a server timing out idle ones"""
+        for writer in self.writers:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                path = line.split()[1].decode()
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b''):
+                        break
+                    name, _, value = header.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+                body = json.loads(await reader.readexactly(length)) if length else {}
+                self.requests += 1
+                status, reply = self.answer(path, body)
+                writer.write(self.encode(status, reply, chunked=self.requests % 2 == 0))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        self.writers.remove(writer)
+        writer.close()
+
+    def answer(self, path, body):
+        n = self.requests
+        if 'signInWithPassword' in path:
+            if body.get('password') == 'wrong':
+                return 400, {'error': {'code': 400, 'message': 'INVALID_PASSWORD',
+                                       'errors': [{'message': 'INVALID_PASSWORD', 'reason': 'invalid'}]}}
+            return 200, {'kind': 'identitytoolkit#VerifyPasswordResponse', 'localId': 'uid',
+                         'email': body.get('email'), 'displayName': '', 'idToken': 'id-token-%d' % n,
+                         'registered': True, 'refreshToken': 'refresh-token-%d' % n,
+                         'expiresIn': str(EXPIRES_IN)}
+        if path.startswith('/v1/token'):
+            if not str(body.get('refresh_token', '')).startswith('refresh-token'):
+                return 400, {'error': {'code': 400, 'message': 'INVALID_REFRESH_TOKEN'}}
+            return 200, {'access_token': 'id-token-%d' % n, 'expires_in': str(EXPIRES_IN),
+                         'token_type': 'Bearer', 'refresh_token': body['refresh_token'],
+                         'id_token': 'id-token-%d' % n, 'user_id': 'uid', 'project_id': '0'}
+        return 404, {'error': {'code': 404, 'message': 'NOT_FOUND'}}
+
+    def encode(self, status, reply, chunked):
+        data = json.dumps(reply).encode()
+        head = 'HTTP/1.1 %d %s\r\nContent-Type: application/json; charset=UTF-8\r\n' % (
+            status, 'OK' if status == 200 else 'Error')
+        if not chunked:
+            return (head + 'Content-Length: %d\r\n\r\n' % len(data)).encode() + data
+        half = len(data) // 2
+        out = (head + 'Transfer-Encoding: chunked\r\n\r\n').encode()
+        for part in (data[:half], data[half:]):
+            out += b'%x\r\n' % len(part) + part + b'\r\n'
+        return out + b'0\r\n\r\n'
+
+
+async def main(port):
+    server = TokenServer()
+    listener = await asyncio.start_server(server.handle, '0.0.0.0', port)
+    print('token server on port', port)
+    async with listener:
+        await listener.serve_forever()
+
+
+async def check():
+    import src.utils.compat
+    from src.firebase.authenticator import Auth
+    from src.firebase.httpclient import HTTPClient
+    from src.firebase.token_manager import TokenManager
+
+    server = TokenServer()
+    listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d' % listener.sockets[0].getsockname()[1]
+    http = HTTPClient()
+    auth = Auth('key', http, identityURL=url, tokenURL=url)
+    tokens = []
+    manager = TokenManager(auth, onToken=tokens.append)
+    # Auth blocks, the server runs on this loop
+    call = asyncio.get_running_loop().run_in_executor
+
+    flg, headers = await call(None, manager.signIn, 'pico@example.com', 'secret')
+    assert flg and headers['idToken'] == 'id-token-1' and auth.refreshToken == 'refresh-token-1', headers
+    assert 0 < manager.dueInMs() <= EXPIRES_IN * 1000, manager.dueInMs()
+    print('sign in:', headers['idToken'], 'refresh due in', manager.dueInMs() // 1000, 's')
+
+    # the second reply comes chunked, on the same connection
+    assert await call(None, manager.refresh)
+    assert auth.idToken == 'id-token-2' and http.reused == 1 and server.connections == 1, (
+        auth.idToken, http.reused, server.connections)
+    print('refresh:', auth.idToken, 'on the kept-alive connection')
+
+    flg, reason = await call(None, Auth('key', http, identityURL=url, tokenURL=url).validate_user,
+                             'pico@example.com', 'wrong')
+    assert not flg and reason['error']['message'] == 'INVALID_PASSWORD', reason
+    print('wrong password: rejected with', reason['error']['message'])
+
+    server.dropConnections()
+    await asyncio.sleep(0.1)
+    assert await call(None, manager.refresh)
+    assert auth.idToken == 'id-token-4' and server.connections == 2, (auth.idToken, server.connections)
+    assert tokens == ['id-token-1', 'id-token-2', 'id-token-4'], tokens
+    print('refresh after the server dropped the connection:', auth.idToken, 'on a new one')
+
+    http.close()
+    # let the handler see the pooled connection close before the loop goes
+    await asyncio.sleep(0.1)
+    listener.close()
+    print('ok,', server.requests, 'requests,', server.connections, 'connections,', http.reused, 'reused')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--check']:
+        asyncio.run(check())
+    else:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8080))
@@ -1,11 +1,15 @@
 # import WIFI_MANAGER 
 from src.wifi.wifi import WIFI_MANAGER
+from src.wifi.link_monitor import LinkMonitor
 from machine import Pin
 
 # import FirebaseRealTime 
 '''FIREBASE STACKS--------------'''
 from src.firebase.firebase_realtime import FirebaseRealTime
 from src.firebase.authenticator import Auth
+from src.firebase.supervisor import ConnectionSupervisor
+from src.firebase.token_manager import TokenManager
+from src.firebase.token_store import TokenStore
 
 # import configurations
 '''CONFIGURATIONS STACKS--------------'''
@@ -57,13 +61,16 @@ if wifi_manager.isWifiConnected():
 
     # 1 - create the authenticator instance
     authenticator = Auth(dbConnectionsDetails['fbKey'])
+    # keeps the idToken fresh and hands new ones to the realtime connection,
+    # the tokens saved in sec/token.json spare the sign in after a reboot
+    tokens = TokenManager(authenticator, store=TokenStore())
     
     # extacting your user name and password
     firebaseUserName = accountDetail['firebaseUserName']
     firebaseUserPassword = accountDetail['firebaseUserPassword']
     
     # validate the user to get the ID token
-    flg, headers = authenticator.validate_user(firebaseUserName, firebaseUserPassword)
+    flg, headers = tokens.signIn(firebaseUserName, firebaseUserPassword)
     if flg :
         # once authenticated extract the idToken
         idToken = headers['idToken']
@@ -83,14 +90,25 @@ if wifi_manager.isWifiConnected():
         
         # authenticate with the socket using the idToken
         firebaseRealtime.authenticateWithSocket(idToken)
+        tokens.register(firebaseRealtime)
 
         # subscribe to a path in realtime database
         path = 'my_data/'
         firebaseRealtime.subscribeToRealTime(path)
         
+        # watch the wifi, bring it back or roam to a stronger access point, dropping the socket when it does
+        monitor = LinkMonitor(wifi_manager, client=firebaseRealtime)
+
+        # reconnect and subscribe again whenever the connection drops (once the wifi is up)
+        supervisor = ConnectionSupervisor(firebaseRealtime, link=monitor)
+
         while True:
+            # sample the wifi link
+            monitor.poll()
             # Keep listen for data update from the server
-            firebaseRealtime.listen()
+            supervisor.listen()
+            # refresh the token when it is about to expire
+            tokens.poll()
         
 
     else:
@@ -0,0 +1,200 @@
+"""
+Websockets client on asyncio streams
+
+The same protocol as protocol.Websocket/myusocket.connect but driven by an
+asyncio (uasyncio on the board) event loop: reads await the stream instead of
+blocking, so other tasks keep running while nothing arrives.
+"""
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import ubinascii as binascii
+import urandom as random
+import ustruct as struct
+
+from src.utils.ticks import ticks_ms
+
+from src.firebase.masking import mask as mask_payload
+from src.utils.metrics import metrics
+from src.firebase.protocol import (urlparse, encode_frame, ConnectionClosed,
+                                   OP_CONT, OP_TEXT, OP_BYTES, OP_CLOSE, OP_PING, OP_PONG,
+                                   CLOSE_OK, CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG)
+
+# the same counters as protocol.Websocket, outgoing frames are counted by encode_frame
+_framesIn = metrics.counter('ws.framesIn')
+_bytesIn = metrics.counter('ws.bytesIn')
+
+
+class AsyncWebsocket:
+    """
+    Websocket client over an asyncio stream reader/writer pair.
+
+    Every frame is built in one buffer and handed to the writer with a single
+    write() call, so frames sent from different tasks never interleave.
+    Fragmented messages are reassembled up to maxMessageSize bytes.
+    """
+    is_client = True
+
+    def __init__(self, reader, writer, maxMessageSize=None):
+        self.reader = reader
+        self.writer = writer
+        self.maxMessageSize = maxMessageSize
+        self.open = True
+        # ticks_ms of the last frame (of any kind) and the last pong received
+        self.lastReceived = ticks_ms()
+        self.lastPong = None
+
+    async def _read(self, n):
+        try:
+            return await self.reader.readexactly(n)
+        except EOFError:
+            # the stream ended (asyncio.IncompleteReadError is an EOFError too)
+            self._close()
+            raise ConnectionClosed()
+
+    async def read_frame(self):
+        """Read a frame, returns fin, opcode, payload"""
+        byte1, byte2 = struct.unpack('!BB', await self._read(2))
+        self.lastReceived = ticks_ms()
+        fin = bool(byte1 & 0x80)
+        opcode = byte1 & 0x0f
+        mask = bool(byte2 & (1 << 7))
+        length = byte2 & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', await self._read(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await self._read(8))
+        mask_bits = await self._read(4) if mask else None
+        _framesIn.inc()
+        _bytesIn.inc(length)
+        if self.maxMessageSize and length > self.maxMessageSize:
+            await self.close(CLOSE_TOO_BIG)
+            raise ConnectionClosed()
+        data = await self._read(length) if length else b''
+        if mask_bits is not None:
+            data = mask_payload(bytearray(data), mask_bits, length)
+        return fin, opcode, data
+
+    async def write_frame(self, opcode, data=b''):
+        self.writer.write(encode_frame(opcode, data, self.is_client))
+        await self.writer.drain()
+
+    async def recv(self):
+        """
+        Receive the next message, str for text and bytes for binary messages.
+        Control frames are answered on the way, None is returned once the connection is closed.
+        """
+        message = None
+        messageOpcode = None
+        while self.open:
+            try:
+                fin, opcode, data = await self.read_frame()
+            except (ConnectionClosed, OSError):
+                self._close()
+                return None
+
+            if opcode == OP_TEXT or opcode == OP_BYTES or opcode == OP_CONT:
+                if opcode == OP_CONT:
+                    if messageOpcode is None:
+                        await self.close(CLOSE_PROTOCOL_ERROR)
+                        return None
+                elif messageOpcode is not None:
+                    await self.close(CLOSE_PROTOCOL_ERROR)
+                    return None
+                else:
+                    messageOpcode = opcode
+                if fin and message is None:
+                    return self._decode(messageOpcode, data)
+                if message is None:
+                    message = bytearray(data)
+                else:
+                    message.extend(data)
+                if self.maxMessageSize and len(message) > self.maxMessageSize:
+                    await self.close(CLOSE_TOO_BIG)
+                    return None
+                if fin:
+                    return self._decode(messageOpcode, message)
+            elif opcode == OP_CLOSE:
+                self._close()
+                return None
+            elif opcode == OP_PING:
+                await self.write_frame(OP_PONG, data)
+            elif opcode == OP_PONG:
+                self.lastPong = ticks_ms()
+            else:
+                await self.close(CLOSE_PROTOCOL_ERROR)
+                return None
+
+    def _decode(self, opcode, data):
+        if opcode == OP_TEXT:
+            return str(data, 'utf-8')
+        return bytes(data)
+
+    async def send(self, buf):
+        """Send a str as a text message or bytes as a binary message"""
+        if not self.open:
+            raise ConnectionClosed()
+        if isinstance(buf, str):
+            await self.write_frame(OP_TEXT, buf.encode('utf-8'))
+        else:
+            await self.write_frame(OP_BYTES, buf)
+
+    async def send_many(self, bufs):
+        """Send several messages with one write, small messages then share a TLS record"""
+        if not self.open:
+            raise ConnectionClosed()
+        frames = []
+        for buf in bufs:
+            if isinstance(buf, str):
+                frames.append(encode_frame(OP_TEXT, buf.encode('utf-8'), self.is_client))
+            else:
+                frames.append(encode_frame(OP_BYTES, buf, self.is_client))
+        self.writer.write(b''.join(frames))
+        await self.writer.drain()
+
+    async def ping(self, data=b''):
+        await self.write_frame(OP_PING, data)
+
+    async def close(self, code=CLOSE_OK, reason=''):
+        if not self.open:
+            return
+        try:
+            await self.write_frame(OP_CLOSE, struct.pack('!H', code) + reason.encode('utf-8'))
+        except OSError:
+            pass
+        self._close()
+
+    def _close(self):
+        if self.open:
+            self.open = False
+            self.writer.close()
+
+
+async def connect(uri, maxMessageSize=None):
+    """Connect a websocket, returns an AsyncWebsocket"""
+    uri = urlparse(uri)
+    assert uri
+    reader, writer = await asyncio.open_connection(uri.hostname, uri.port,
+                                                   ssl=True if uri.protocol == 'wss' else None)
+
+    # Sec-WebSocket-Key is 16 bytes of random base64 encoded
+    key = binascii.b2a_base64(bytes(random.getrandbits(8) for _ in range(16)))[:-1].decode('ascii')
+    request = ('GET {path} HTTP/1.1\r\n'
+               'Host: {host}:{port}\r\n'
+               'Connection: Upgrade\r\n'
+               'Upgrade: websocket\r\n'
+               'Sec-WebSocket-Key: {key}\r\n'
+               'Sec-WebSocket-Version: 13\r\n'
+               'Origin: http://{host}:{port}\r\n'
+               '\r\n').format(path=uri.path or '/', host=uri.hostname, port=uri.port, key=key)
+    writer.write(request.encode('utf-8'))
+    await writer.drain()
+
+    header = await reader.readline()
+    assert header.startswith(b'HTTP/1.1 101 '), header
+    while header and header != b'\r\n':
+        header = await reader.readline()
+
+    return AsyncWebsocket(reader, writer, maxMessageSize)
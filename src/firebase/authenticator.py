@@ -1,75 +1,77 @@
 import ujson
-import urequests as requests
 import time
-from machine import Timer
+
+from src.firebase.httpclient import HTTPClient
 
 class Auth(object):
     """ 
     Authenticate the user using the firebase authentication service
     the class will take the api key and use it to authenticate the user with google identity tool kit using a simple post request
     the validate_user method will take the user email and password and return the user data if the user is authenticated successfully
-    the
+    the requests go through one HTTPClient that keeps the connection to each endpoint open between calls and only
+    picks the needed fields out of the replies, pass httpClient to share it, identityURL and tokenURL point the
+    requests at another server (a local stand-in when testing)
+    validate_user does not refresh the token on its own, see token_manager.TokenManager for that
     
     """
-    def __init__(self, apiKey):
+    def __init__(self, apiKey, httpClient=None,
+                 identityURL="https://identitytoolkit.googleapis.com", tokenURL="https://securetoken.googleapis.com"):
         # construct the enpoint with the api key        
         self.apiKey = apiKey
-        self.refreshURL = "https://securetoken.googleapis.com/v1/token?key="+self.apiKey
-        self.signInURL = "https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key="+self.apiKey
+        self.http = httpClient if httpClient is not None else HTTPClient()
+        self.refreshURL = tokenURL + "/v1/token?key="+self.apiKey
+        self.signInURL = identityURL + "/v1/accounts:signInWithPassword?key="+self.apiKey
+        self.idToken = None
+        self.refreshToken = None
+        self.localID = None
+        self.expiresIn = 0
+        self.expiresAt = 0
     
     def validate_user(self, user_email, password):
-        # declaring  2 globals varaibles to be used in this scope
-        global tokenID
-        global expiresAt
-
         # constructing the username and password, in the header
         data = {"email":user_email,"password":password,"returnSecureToken":True}
-        headers = {"content-type": "application/json"}
         post_data = ujson.dumps(data)
         
         # getting the url from the
         _url = self.signInURL
+        fields = ("idToken", "email", "refreshToken", "expiresIn", "localId")
         
         try:
-            # send the request to he URL
-            res = requests.post(_url, headers = headers,data=post_data)
+            # send the request to he URL, only the fields and a possible error are kept from the reply
+            status, res_data = self.http.post(_url, post_data, fields + ("error",))
         except Exception as e:
             # catch any expecption
             return False, e
         # start of extracting headers data
         header_data = ''
-        if res.status_code == 200 :
+        if status == 200 :
             
             # if the request is successful, extracting headers: idToken, email, refreshToekn, expiresIn, localId
-            res_data = res.json()
             header_data = { "content-type": 'application/json; charset=utf-8'}
-            for header in ("idToken", "email", "refreshToken", "expiresIn", "localId"):
+            for header in fields:
+                if not header in res_data:
+                    return False, res_data
                 header_data[header] = str(res_data[header])
         else:
             # return false, and reason of failing
-            # print(res)
-            return False, res.json()
+            return False, res_data
         
         # once extract the headers, save data to locals varables
         self.refreshToken = header_data['refreshToken']
         self.localID = header_data['localId']
         self.idToken = header_data['idToken']
         
-        # update the global variables with data from the headers 
-        tokenID = header_data['idToken']
-        expiresAt = int(time.time()) - 60 + int(header_data['expiresIn'])
-        
-        # set up a timer that trigger the update refresh token function every 1000ms to update the token using the refresh token
-        Timer(mode=Timer.PERIODIC, period=1000, callback=self.updateRefreshToken)
+        # remember when the token runs out, with a minute to spare
+        self.expiresIn = int(header_data['expiresIn'])
+        self.expiresAt = int(time.time()) - 60 + self.expiresIn
         
         # sucessfully authenticated so return true and the header data inclduing the idToken
         return True, header_data
 
         
-    def updateRefreshToken(self,timer=None) :
-        global tokenID
-        global expiresAt
-        if time.time() < expiresAt :
+    def updateRefreshToken(self, force=False) :
+        """Swap the refresh token for a new idToken once the current one has expired (or now when force)"""
+        if not force and time.time() < self.expiresAt :
             return False, None, None
         
         # print("refreshing token")
@@ -77,30 +79,26 @@ class Auth(object):
         refreshToken = self.refreshToken
         data = {"grant_type":"refresh_token","refresh_token":refreshToken}
         post_data = ujson.dumps(data)
+        fields = ("id_token", "refresh_token", "access_token","expires_in")
         try:
-            res = requests.post(_url,
-                                headers = {'content-type': 'application/json'},
-                                data=post_data)
+            status, res_data = self.http.post(_url, post_data, fields + ("error",))
         except Exception as e:
             return False, e, None
         header_data = ''
-        if res.status_code == 200 :
+        if status == 200 :
             # if the request is successful, extracting headers: id_token, refresh_token, access_token
-            res_data = res.json()
-            #print(res_data)
             header_data = { "content-type": 'application/json; charset=utf-8'}
-            for header in ("id_token", "refresh_token", "access_token","expires_in"):
+            for header in fields:
+                if not header in res_data:
+                    return False, res_data, None
                 header_data[header] = str(res_data[header])
         else:
             # return false, and reason of failing
-            return False, res.json(), None    
+            return False, res_data, None    
         self.refreshToken = header_data['refresh_token']
         self.idToken = header_data['id_token']
         
-        expiresAt = int(time.time()) - 60 + int(header_data['expires_in'])
-        tokenID = header_data['id_token']
-        
-        if not self.rt == None:
-            self.rt.authenticateWithSocket(tokenID)
+        self.expiresIn = int(header_data['expires_in'])
+        self.expiresAt = int(time.time()) - 60 + self.expiresIn
         
-        return True, expiresAt,tokenID
\ No newline at end of file
+        return True, self.expiresAt, self.idToken
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""
+Packs the values of high rate sensor paths into short base64 strings
+"""
+
+import ubinascii as binascii
+import ustruct as struct
+
+# struct codes a field can have
+TYPES = 'bBhHiIqQfd'
+
+
+class Schema:
+    """
+    The layout of the values stored at a path: fields is a list of
+    (name, type) pairs, type being a struct code of TYPES ('b' int8, 'H'
+    uint16, 'i' int32, 'f' float32, 'd' float64...). version is written in
+    front of every value so data written with another layout is recognised.
+
+    encode(value) packs a record, a dict or a tuple/list in field order into
+    a base64 string (a float32 and an int16 take 12 characters where the JSON
+    of {"temp":21.53,"hum":40} takes 23). decode(text, record) unpacks it into
+    record (a new one when None) and returns it.
+
+    Records are instances of the class the schema builds for its fields.
+    MicroPython ignores __slots__, so on the board every record is a plain
+    instance with an attribute dict of all the fields. record is the one the
+    realtime client decodes into, so that cost is paid once: it is reused for
+    every value, copy the fields out to keep them.
+
+    encodeMany(values) / decodeMany(text) do the same for a list of values
+    packed back to back, e.g. a batch of samples sent in one write.
+    """
+
+    def __init__(self, name, fields, version=1):
+        for field in fields:
+            if len(field[1]) != 1 or field[1] not in TYPES:
+                raise ValueError('unsupported field type ' + str(field[1]))
+        self.name = name
+        self.fields = tuple(field[0] for field in fields)
+        self.version = version
+        self.format = '<' + ''.join(field[1] for field in fields)
+        self.size = struct.calcsize(self.format)
+        self.recordClass = type(name, (), {'__slots__': self.fields})
+        self.record = self.new()
+        # scratch buffer, with the version byte in front
+        self._buf = bytearray(1 + self.size)
+        self._buf[0] = version
+
+    def new(self):
+        return self.recordClass()
+
+    def values(self, value):
+        if isinstance(value, dict):
+            return tuple(value[name] for name in self.fields)
+        if isinstance(value, (tuple, list)):
+            return value
+        return tuple(getattr(value, name) for name in self.fields)
+
+    def encode(self, value):
+        struct.pack_into(self.format, self._buf, 1, *self.values(value))
+        return binascii.b2a_base64(self._buf)[:-1].decode('ascii')
+
+    def decode(self, text, record=None):
+        data = binascii.a2b_base64(text)
+        if len(data) != 1 + self.size or data[0] != self.version:
+            raise ValueError('not a ' + self.name + ' value')
+        return self._unpack(data, 1, record)
+
+    def encodeMany(self, values):
+        buf = bytearray(1 + self.size * len(values))
+        buf[0] = self.version
+        offset = 1
+        for value in values:
+            struct.pack_into(self.format, buf, offset, *self.values(value))
+            offset += self.size
+        return binascii.b2a_base64(buf)[:-1].decode('ascii')
+
+    def decodeMany(self, text):
+        data = binascii.a2b_base64(text)
+        if not data or data[0] != self.version or (len(data) - 1) % self.size:
+            raise ValueError('not a list of ' + self.name + ' values')
+        return [self._unpack(data, offset, None) for offset in range(1, len(data), self.size)]
+
+    def isRecord(self, value):
+        return isinstance(value, self.recordClass)
+
+    def _unpack(self, data, offset, record):
+        if record is None:
+            record = self.new()
+        values = struct.unpack_from(self.format, data, offset)
+        for i in range(len(values)):
+            setattr(record, self.fields[i], values[i])
+        return record
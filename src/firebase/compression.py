@@ -0,0 +1,133 @@
+"""
+permessage-deflate websocket compression (RFC 7692)
+
+Inflating uses the deflate module of MicroPython 1.21+ (or zlib/uzlib on
+older firmware and desktop python) with a window of 2**windowBits bytes, so
+the memory it takes is bounded by what is negotiated. Compressing outgoing
+messages needs a firmware built with deflate compression, without it the
+messages are simply sent as they are, which the extension allows.
+"""
+
+import uio as io
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+try:
+    import zlib
+except ImportError:
+    try:
+        import uzlib as zlib
+    except ImportError:
+        zlib = None
+
+# appended to a compressed message before inflating it: the empty block the
+# sender stripped (RFC 7692 7.2.2), then an empty final block so the inflater
+# sees a properly ended stream
+_TAIL = b'\x00\x00\xff\xff\x03\x00'
+
+
+def inflateRaw(data, windowBits, maxSize=None):
+    """Decompress a raw deflate stream, at most maxSize bytes of output (ValueError past that)"""
+    limit = -1 if maxSize is None else maxSize + 1
+    if deflate is not None:
+        out = deflate.DeflateIO(io.BytesIO(data), deflate.RAW, windowBits).read(limit)
+    elif hasattr(zlib, 'decompressobj'):
+        out = zlib.decompressobj(-windowBits).decompress(data, 0 if maxSize is None else limit)
+    else:
+        out = zlib.decompress(data, -windowBits)
+    if maxSize is not None and len(out) > maxSize:
+        raise ValueError('inflated message too big')
+    return out
+
+
+def deflateRaw(data, windowBits):
+    """Compress data to a raw deflate stream, None when this firmware can't compress"""
+    if deflate is not None:
+        out = io.BytesIO()
+        try:
+            stream = deflate.DeflateIO(out, deflate.RAW, windowBits)
+            stream.write(data)
+            stream.close()
+        except (OSError, AttributeError):
+            return None
+        return out.getvalue()
+    if hasattr(zlib, 'compressobj'):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -windowBits)
+        return compressor.compress(data) + compressor.flush()
+    return None
+
+
+class PerMessageDeflate:
+    """
+    The permessage-deflate extension of one websocket connection.
+
+    offer() is the Sec-WebSocket-Extensions value of the opening handshake: it
+    asks the server to compress with at most windowBits of window and to start
+    every message afresh (server_no_context_takeover), so messages can be
+    inflated one by one without keeping a window between them. accept(value)
+    checks the server's answer.
+
+    Every outgoing message is compressed on its own too, so the offer also
+    asks for client_no_context_takeover: a server that keeps its inflate
+    window between messages would misread them. When the server's answer
+    doesn't confirm it, the extension is kept for the incoming messages but
+    nothing is sent compressed (canCompress is False), which RFC 7692 allows.
+    Otherwise outgoing messages of at least minSize bytes are compressed when
+    the firmware can, and sent compressed only when that made them smaller.
+    bytesIn/bytesInflated and bytesOut/bytesDeflated count the payload bytes
+    on the wire and before compression.
+    """
+
+    def __init__(self, windowBits=11, minSize=64):
+        self.windowBits = windowBits
+        self.minSize = minSize
+        self.clientWindowBits = 15
+        self.canCompress = True
+        self.bytesIn = 0
+        self.bytesInflated = 0
+        self.bytesOut = 0
+        self.bytesDeflated = 0
+
+    def offer(self):
+        return ('permessage-deflate; server_no_context_takeover; client_no_context_takeover; '
+                'server_max_window_bits={}; client_max_window_bits').format(self.windowBits)
+
+    def accept(self, value):
+        """Check the extension in the server's handshake answer, False when the server can't be followed"""
+        params = [p.strip() for p in value.split(';')]
+        if params[0] != 'permessage-deflate' or 'server_no_context_takeover' not in params:
+            return False
+        # the client messages can only be compressed one by one
+        self.canCompress = 'client_no_context_takeover' in params
+        for param in params[1:]:
+            name, _, bits = param.partition('=')
+            bits = bits.strip().strip('"')
+            if name == 'server_max_window_bits' and bits:
+                if int(bits) > self.windowBits:
+                    return False
+                self.windowBits = int(bits)
+            elif name == 'client_max_window_bits' and bits:
+                self.clientWindowBits = int(bits)
+        return True
+
+    def inflate(self, data, maxSize=None):
+        out = inflateRaw(bytes(data) + _TAIL, self.windowBits, maxSize)
+        self.bytesIn += len(data)
+        self.bytesInflated += len(out)
+        return out
+
+    def deflate(self, data):
+        """The compressed payload of data, None when it is to be sent as it is"""
+        if not self.canCompress or len(data) < self.minSize:
+            return None
+        out = deflateRaw(data, self.clientWindowBits)
+        if out is None:
+            self.canCompress = False
+            return None
+        if len(out) >= len(data):
+            return None
+        self.bytesOut += len(out)
+        self.bytesDeflated += len(data)
+        return out
@@ -0,0 +1,219 @@
+"""
+Opens the TCP/TLS connections to the Firebase servers
+
+Resolving the host and the TLS handshake are the expensive parts of a
+connection on the Pico W: the handshake alone takes seconds of CPU and a big
+chunk of heap. Connector keeps the resolved addresses for dnsTtlMs.
+
+TLS session resumption is only done on CPython, through ssl.SSLContext and
+SSLSocket.session. MicroPython's ssl module can't hand a session out nor take
+one in, so on the Pico W every connection runs the full handshake.
+
+On CPython the sockets are handed out wrapped in a SocketStream, which gives
+them the read/readinto/readline/write methods the MicroPython sockets have
+and the rest of src/firebase relies on.
+"""
+
+import usocket as socket
+import ussl
+
+from src.utils.ticks import ticks_ms, ticks_diff
+from src.utils.metrics import metrics
+
+# CPython's ssl resumes sessions, MicroPython's has no SSLSession
+_SESSIONS = hasattr(ussl, 'SSLSession')
+# CPython sockets only have recv/send
+_STREAMS = not hasattr(socket.socket, 'readline')
+
+_ETIMEDOUT = 110
+
+
+class SocketStream:
+    """
+    The stream methods of a MicroPython socket over a CPython (SSL) socket:
+    read(n) returns what one receive gets (at most n bytes), readline() keeps
+    what it read past the line for the next read, write() sends everything,
+    and a read timeout raises OSError(ETIMEDOUT) like on the board.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buf = b''
+
+    def _recv(self, n):
+        try:
+            return self.sock.recv(n)
+        except socket.timeout:
+            raise OSError(_ETIMEDOUT, 'timed out')
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            chunks = [self._buf]
+            self._buf = b''
+            while True:
+                chunk = self._recv(4096)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        if self._buf:
+            data = self._buf[:n]
+            self._buf = self._buf[n:]
+            return data
+        return self._recv(n)
+
+    def readinto(self, buf):
+        if self._buf:
+            n = min(len(buf), len(self._buf))
+            buf[:n] = self._buf[:n]
+            self._buf = self._buf[n:]
+            return n
+        try:
+            return self.sock.recv_into(buf)
+        except socket.timeout:
+            raise OSError(_ETIMEDOUT, 'timed out')
+
+    def readline(self):
+        while True:
+            end = self._buf.find(b'\n') + 1
+            if end:
+                line = self._buf[:end]
+                self._buf = self._buf[end:]
+                return line
+            chunk = self._recv(512)
+            if not chunk:
+                line = self._buf
+                self._buf = b''
+                return line
+            self._buf += chunk
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+_dnsMs = metrics.histogram('net.dnsMs')
+_connectMs = metrics.histogram('net.connectMs')
+_tlsMs = metrics.histogram('net.tlsMs')
+_tlsResumed = metrics.counter('net.tlsResumed')
+
+
+class Connector:
+    """
+    open(host, port, secure) returns a connected (and, when secure, TLS
+    wrapped) socket.
+
+    Addresses are cached for dnsTtlMs and forgotten when connecting to them
+    fails. sessionSupport tells whether TLS sessions are resumed, which is
+    only the case on CPython (see the module docstring): the session of the
+    last connection to a host is offered on the next one. With TLS 1.3 the
+    server sends the session ticket after the handshake, so it is taken from
+    the previous socket when that one is still open and otherwise from right
+    after its handshake, where a TLS 1.3 server may not have sent it yet.
+
+    lastTimings holds the cost of the last open(): dnsMs, connectMs, tlsMs and
+    whether the TLS session was resumed. handshakes and resumed count the TLS
+    handshakes.
+    """
+
+    def __init__(self, dnsTtlMs=300000):
+        self.dnsTtlMs = dnsTtlMs
+        # (host, port) -> (address, ticks_ms when resolved)
+        self._addresses = {}
+        # host -> TLS session, and TLS socket, of the last connection
+        self._sessions = {}
+        self._sockets = {}
+        self.sessionSupport = _SESSIONS
+        self._context = None
+        self.lastTimings = None
+        self.handshakes = 0
+        self.resumed = 0
+
+    def resolve(self, host, port):
+        """Address of host:port, from the cache while it is younger than dnsTtlMs"""
+        key = (host, port)
+        cached = self._addresses.get(key)
+        if cached is not None and ticks_diff(ticks_ms(), cached[1]) < self.dnsTtlMs:
+            return cached[0]
+        address = socket.getaddrinfo(host, port)[0][-1]
+        self._addresses[key] = (address, ticks_ms())
+        return address
+
+    def forget(self, host, port=None):
+        """Drop the cached address(es) and TLS session of host"""
+        for key in list(self._addresses):
+            if key[0] == host and (port is None or key[1] == port):
+                del self._addresses[key]
+        self._sessions.pop(host, None)
+        self._sockets.pop(host, None)
+
+    def open(self, host, port, secure=True):
+        """Connect to host:port, wrapping the socket in TLS when secure"""
+        start = ticks_ms()
+        address = self.resolve(host, port)
+        resolved = ticks_ms()
+        sock = socket.socket()
+        try:
+            sock.connect(address)
+        except OSError:
+            # the host may have moved, resolve it again next time
+            sock.close()
+            self.forget(host, port)
+            raise
+        connected = ticks_ms()
+        resumed = False
+        if secure:
+            try:
+                sock, resumed = self._wrap(sock, host)
+            except Exception:
+                sock.close()
+                self._sessions.pop(host, None)
+                self._sockets.pop(host, None)
+                raise
+        _dnsMs.since(start, resolved)
+        _connectMs.since(resolved, connected)
+        if secure:
+            _tlsMs.since(connected, ticks_ms())
+            if resumed:
+                _tlsResumed.inc()
+        self.lastTimings = {
+            'dnsMs': ticks_diff(resolved, start),
+            'connectMs': ticks_diff(connected, resolved),
+            'tlsMs': ticks_diff(ticks_ms(), connected) if secure else 0,
+            'resumed': resumed,
+        }
+        if _STREAMS:
+            return SocketStream(sock)
+        return sock
+
+    def _wrap(self, sock, host):
+        if not self.sessionSupport:
+            tls = ussl.wrap_socket(sock, server_hostname=host)
+            self.handshakes += 1
+            return tls, False
+        if self._context is None:
+            self._context = ussl.create_default_context()
+        session = None
+        previous = self._sockets.pop(host, None)
+        if previous is not None:
+            # None once that socket is closed
+            session = previous.session
+        if session is None:
+            session = self._sessions.get(host)
+        tls = self._context.wrap_socket(sock, server_hostname=host, session=session)
+        self.handshakes += 1
+        resumed = tls.session_reused
+        if resumed:
+            self.resumed += 1
+        self._sockets[host] = tls
+        if tls.session is not None:
+            self._sessions[host] = tls.session
+        return tls, resumed
+
+
+# the connector shared by the websocket and the REST calls
+connector = Connector()
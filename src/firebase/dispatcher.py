@@ -0,0 +1,82 @@
+"""
+Request ids and reply routing for the realtime database protocol
+"""
+
+import ujson
+
+from src.utils.ticks import ticks_ms, ticks_diff, ticks_add, ticks_us
+from src.utils.metrics import metrics, US_BUCKETS
+
+_parseUs = metrics.histogram('json.parseUs', US_BUCKETS)
+
+# status handed to the callback of a request the server never answered
+STATUS_TIMEOUT = 'timeout'
+# status handed to the pending requests when the connection goes away
+STATUS_DISCONNECTED = 'disconnected'
+
+
+class RequestDispatcher:
+    """
+    Every request sent to the realtime database carries an id 'r' and the
+    server answers with {"t":"d","d":{"r":N,"b":{"s":"ok","d":...}}}.
+
+    request() hands out increasing ids, builds the message and remembers the
+    callback, resolve() routes a reply back to it with callback(status, data).
+    Requests that are not answered within timeoutMs are completed with
+    STATUS_TIMEOUT by expire(). Nothing waits on a reply, so any number of
+    requests can be in flight on the same socket.
+    """
+
+    def __init__(self, timeoutMs=10000):
+        self.timeoutMs = timeoutMs
+        self._nextId = 1
+        # id -> (deadline, callback)
+        self.pending = {}
+
+    def request(self, action, body, callback=None, timeoutMs=None):
+        """Register a request, returns its id and the message to send"""
+        requestId = self._nextId
+        self._nextId += 1
+        deadline = ticks_add(ticks_ms(), timeoutMs if timeoutMs is not None else self.timeoutMs)
+        self.pending[requestId] = (deadline, callback)
+        message = ujson.dumps({"t": "d", "d": {"r": requestId, "a": action, "b": body}})
+        return requestId, message
+
+    def resolve(self, requestId, status, data=None):
+        """Complete a request with the server reply, returns False for an unknown id"""
+        entry = self.pending.pop(requestId, None)
+        if entry is None:
+            return False
+        if entry[1] is not None:
+            entry[1](status, data)
+        return True
+
+    def cancel(self, requestId):
+        self.pending.pop(requestId, None)
+
+    def expire(self):
+        """Time out the requests past their deadline"""
+        if not self.pending:
+            return
+        now = ticks_ms()
+        for requestId in [r for r in self.pending if ticks_diff(self.pending[r][0], now) <= 0]:
+            self.resolve(requestId, STATUS_TIMEOUT)
+
+    def failAll(self, status=STATUS_DISCONNECTED):
+        """Complete every pending request with status, e.g. when the socket dies"""
+        for requestId in list(self.pending):
+            self.resolve(requestId, status)
+
+    def routeText(self, text):
+        """Route a raw reply message, returns True when it was a reply to a pending request"""
+        if not text.startswith('{"t":"d","d":{"r":'):
+            return False
+        try:
+            start = ticks_us()
+            message = ujson.loads(text)
+            _parseUs.since(start, ticks_us())
+            requestId = message['d']['r']
+            body = message['d'].get('b', {})
+        except (ValueError, KeyError, TypeError):
+            return False
+        return self.resolve(requestId, body.get('s'), body.get('d'))
@@ -1,51 +1,150 @@
 from src.firebase.myusocket import connect
+from src.firebase.connector import connector
+from src.firebase.realtime_core import RealtimeCore
+from src.firebase.keepalive import KeepAlive, PING, DEAD
+from src.firebase.compression import PerMessageDeflate
 import time
-from machine import Timer
 
 
-class FirebaseRealTime ():
+class FirebaseRealTime (RealtimeCore):
 
     """ The FirebaseRealTime class is used to connect to the firebase realtime database
     dbConnectionsDetails is a dictionary that contains the socketUrl of the firebase database
     the onDataReceived is a call back handler and will be called when data is received from the firebase database
     the class provides the user with the ability to subscribe to a realtime database and listen to incoming data
     the socket will be authenticated using the tokenID obtained from the authenticator class
+    dbConnectionsDetails may also carry an optional rxBufferSize (bytes), when set incoming messages are
+    read into one fixed buffer and onDataReceived gets a FrameView that is only valid during the callback
+    (call str() on it to decode the text, or .bytes() to keep a copy)
+    maxMessageSize (bytes) caps the size of a message the server splits into several frames
+    passing onDataChunk switches to streaming: every piece of an incoming message is handed to
+    onDataChunk(chunk, final) as it is read and the message is never buffered whole
+    passing onDataEvent parses the incoming messages as they stream in and calls onDataEvent(path, value)
+    for every value pushed by the database (value None means the path was deleted), acceptPath(path) can
+    return False to skip the subtrees the application does not care about (see jsonstream.prefixFilter)
+    setting mirrorMaxBytes in dbConnectionsDetails keeps a local copy of every subscribed path (0 for no limit),
+    read it with get(path) and register per path change callbacks with watch(path, callback)
+    with onDataEvent or the mirror onDataReceived is still called with every whole message, only in
+    streaming mode (onDataChunk) does it get nothing; pass onDataReceived=None to have the parser read
+    the messages as they stream in, without ever holding a whole one
+    with the mirror on, (re)subscribing sends the hash of the mirrored data so the server only pushes
+    the snapshot again when it has changed
+    subscribeToRealTime(path, handler) routes the changes at and below path to handler(path, value), value being
+    the whole subtree the change wrote at path in every mode (see router.PathRouter), any number
+    of paths can be subscribed each with their own handlers (see router.PathRouter), unsubscribe(path, handler)
+    removes a handler and stops listening to the path once it has none left
+    every request gets its own id, pass a callback(status, data) to authenticateWithSocket, subscribeToRealTime
+    or sendRequest to hear back from the server, status is 'ok' on success, the server error otherwise and
+    'timeout' when there was no answer within requestTimeoutMs (dbConnectionsDetails, default 10000)
+    set, update, push and remove write to the database over the same socket, they return straight away and
+    the optional callback(status, data) tells when the server has applied the write
+    reconnect() opens a new socket and replays the authentication and every subscription on it, see
+    supervisor.ConnectionSupervisor to have that happen on its own when the connection dies
+    the socket is read with a readTimeoutMs (default 1000) timeout so listen() returns regularly, when
+    nothing has arrived for keepAliveMs (default 25000) listen() sends a websocket ping and when its pong
+    does not come back within pongTimeoutMs (default 10000) the socket is closed, link (keepalive.KeepAlive)
+    holds the measured round trip time and a link health figure
     """
     
-    def __init__(self, dbConnectionsDetails,rxLED,onDataReceived):
-        self.socketAddress = dbConnectionsDetails['sockerUrl']
-        self.firebaseSocket = connect(self.socketAddress)
-        self.onDataReceived = onDataReceived
+    def __init__(self, dbConnectionsDetails,rxLED,onDataReceived,onDataChunk=None,onDataEvent=None,acceptPath=None):
+        RealtimeCore.__init__(self, dbConnectionsDetails, onDataReceived, onDataEvent, acceptPath)
+        self.socketAddress = dbConnectionsDetails.get('socketUrl') or dbConnectionsDetails.get('sockerUrl')
+        self.rxBufferSize = dbConnectionsDetails.get('rxBufferSize')
+        self.maxMessageSize = dbConnectionsDetails.get('maxMessageSize')
+        if 'dnsTtlMs' in dbConnectionsDetails:
+            connector.dnsTtlMs = dbConnectionsDetails['dnsTtlMs']
+        self.onDataChunk = onDataChunk
         self.rxLED = rxLED
-        Timer(mode=Timer.PERIODIC, period=5000, callback=self.keepAlive)
-
-    def authenticateWithSocket(self,tokenID):
-        #print("******************************************")
-        #print("refresh token in socket")
-        credString = '{"t":"d","d":{"r":2,"a":"auth","b":{"cred":"'+tokenID+'"}}}'
-        #print(credstring)
-        self.firebaseSocket.send(credString)
-        #print("******************************************")
-
-    def keepAlive(self,timer):
-        self.firebaseSocket.send('0')
- 
-    def subscribeToRealTime(self,path):
-        
-        #print("******************************************")
-        #print("subscribeString")
-        subscribeString = '{"t":"d","d":{"r":2,"a":"q","b":{"p":"'+path+'","h":""}}}'
-        self.firebaseSocket.send(subscribeString)
-        #print("******************************************")
-        
+        self._gotData = False
+        self.readTimeoutMs = dbConnectionsDetails.get('readTimeoutMs', 1000)
+        # true, or the window bits to allow the server (9-15), turns compression on
+        self.permessageDeflate = dbConnectionsDetails.get('permessageDeflate')
+        self.deflate = None
+        self.link = KeepAlive(dbConnectionsDetails.get('keepAliveMs', 25000),
+                              dbConnectionsDetails.get('pongTimeoutMs', 10000))
+        self.firebaseSocket = None
+        self._connect()
+
+    def _connect(self):
+        if self.permessageDeflate:
+            # a fresh one per connection, the window bits are negotiated again
+            windowBits = 11 if self.permessageDeflate is True else self.permessageDeflate
+            self.deflate = PerMessageDeflate(windowBits)
+        self.firebaseSocket = connect(self.socketAddress, self.rxBufferSize, self.maxMessageSize,
+                                      deflate=self.deflate)
+        if self.readTimeoutMs:
+            self.firebaseSocket.settimeout(self.readTimeoutMs / 1000)
+        self.link.reset()
+        # the parser reads the messages as they stream in unless onDataReceived wants them whole
+        if self.onDataChunk is not None or (self.parser is not None and self.onDataReceived is None):
+            self.firebaseSocket.onChunk = self._onChunk
+
+    def isConnected(self):
+        return self.firebaseSocket is not None and self.firebaseSocket.open
+
+    def drop(self):
+        """Abandon the current socket without a closing handshake, e.g. when the wifi under it went away"""
+        if self.isConnected():
+            self.firebaseSocket.abort()
+
+    def reconnect(self):
+        """Drop the current socket, open a new one and replay the authentication and the subscriptions"""
+        oldSocket = self.firebaseSocket
+        self.firebaseSocket = None
+        if oldSocket is not None and oldSocket.open:
+            try:
+                oldSocket.close()
+            except OSError:
+                pass
+        self._connect()
+        # the authentication and the subscriptions leave in as few writes as possible
+        self.firebaseSocket.cork()
+        try:
+            self._replay()
+        finally:
+            self.firebaseSocket.uncork()
+
+    def _sendText(self, text):
+        self.firebaseSocket.send(text)
+
+    def _onChunk(self, opcode, chunk, final):
+        if not self.onDataChunk == None :
+            self.onDataChunk(chunk, final)
+        if not self.parser == None :
+            self._feedParser(chunk, final)
+        if final:
+            self._gotData = True
 
     def listen(self,timer=None):
-        incomingMessage = self.firebaseSocket.recv()
-        self.onDataReceived(incomingMessage)
+        socket = self.firebaseSocket
+        # whatever the callbacks send while the message is handled goes out together afterwards
+        socket.cork()
+        try:
+            incomingMessage = socket.recv()
+            # in streaming mode the message has already been handed out chunk by chunk
+            if socket.onChunk == None :
+                self._handleText(incomingMessage)
+            elif self._gotData :
+                incomingMessage = True
+            self._gotData = False
+            self.requests.expire()
+            self._keepAlive()
+        finally:
+            socket.uncork()
             
         # blink to the light to signify that incoming data is avaliable
-        if not self.rxLED == None :
+        if incomingMessage and not self.rxLED == None :
             self.rxLED.on()
             time.sleep(0.05)
             self.rxLED.off()
-        
+
+    def _keepAlive(self):
+        # runs between two reads, so the ping never interleaves with another frame
+        if not self.isConnected():
+            return
+        state = self.link.poll(self.firebaseSocket)
+        if state == PING:
+            self.firebaseSocket.ping()
+        elif state == DEAD:
+            # the server stopped answering, listen() callers see isConnected() go False
+            self.firebaseSocket.abort()
@@ -0,0 +1,182 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from src.firebase.aprotocol import connect
+from src.firebase.realtime_core import RealtimeCore
+from src.firebase.keepalive import KeepAlive, PING, DEAD
+
+
+class AsyncFirebaseRealTime (RealtimeCore):
+
+    """ asyncio version of FirebaseRealTime
+    Instead of a blocking listen() loop and machine.Timer callbacks, receiving, sending, keep alive and token
+    refresh are tasks on one event loop, next to whatever tasks the application adds (wifi supervision,
+    sensors, ...). It runs on uasyncio on the board and on asyncio on a desktop python (import
+    src.utils.compat first there), which makes it possible to test against a local server: python3 -m
+    bench.rtdb_server --check runs it against the stand-in database of bench/rtdb_server.py.
+
+    dbConnectionsDetails, onDataReceived, onDataEvent and acceptPath are the same as for FirebaseRealTime,
+    keepAliveMs (default 25000) and pongTimeoutMs (default 10000) work as for FirebaseRealTime: a ping after
+    that long without incoming traffic, the connection is dropped when the pong doesn't come back in time.
+    All the request methods (authenticateWithSocket, subscribeToRealTime, set, update, push, remove) only
+    queue the message and return, request() can be awaited for the reply.
+
+        rt = AsyncFirebaseRealTime(dbConnectionsDetails, onDataReceived)
+        await rt.connect()
+        rt.authenticateWithSocket(idToken)
+        rt.subscribeToRealTime('my_data/')
+        await rt.closed()
+
+    reconnect() opens a new socket and replays the authentication and the subscriptions on it, run
+    supervisor.ConnectionSupervisor(rt).run() as a task to have that happen whenever the connection dies.
+    """
+
+    def __init__(self, dbConnectionsDetails, onDataReceived, onDataEvent=None, acceptPath=None):
+        RealtimeCore.__init__(self, dbConnectionsDetails, onDataReceived, onDataEvent, acceptPath)
+        self.socketAddress = dbConnectionsDetails.get('socketUrl') or dbConnectionsDetails.get('sockerUrl')
+        self.maxMessageSize = dbConnectionsDetails.get('maxMessageSize')
+        self.link = KeepAlive(dbConnectionsDetails.get('keepAliveMs', 25000),
+                              dbConnectionsDetails.get('pongTimeoutMs', 10000))
+        self.socket = None
+        # application tasks, and the client's own
+        self.tasks = []
+        self._tasks = []
+        # text messages waiting for the writer task
+        self._outgoing = []
+        self.coalesceBytes = dbConnectionsDetails.get('coalesceBytes', 1400)
+        self._pingPending = False
+        self._wake = asyncio.Event()
+        self._receiver = None
+        # set by close(), a closed client is not reconnected
+        self.closing = False
+
+    async def connect(self):
+        """Open the websocket and start the receive, send and keep alive tasks"""
+        self.socket = await connect(self.socketAddress, self.maxMessageSize)
+        self.link.reset()
+        self._receiver = asyncio.create_task(self._receive())
+        self._tasks = [asyncio.create_task(self._send()), asyncio.create_task(self._keepAlive())]
+
+    async def reconnect(self):
+        """Replace a dead connection: open a new socket, then replay the authentication and the subscriptions"""
+        self.drop()
+        self._outgoing = []
+        await self.connect()
+        self._replay()
+
+    def isConnected(self):
+        return self.socket is not None and self.socket.open
+
+    def drop(self):
+        """Abandon the current socket without a closing handshake, e.g. when it has stopped answering"""
+        if self.socket is not None:
+            self.socket._close()
+        if self._receiver is not None:
+            self._receiver.cancel()
+
+    def ping(self):
+        """Have the writer task send a websocket ping, the answer shows up in socket.lastPong"""
+        self._pingPending = True
+        self._wake.set()
+
+    def addTask(self, coroutine):
+        """Run an application coroutine next to the client, it is cancelled by close()"""
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def closed(self):
+        """Wait until the connection goes away"""
+        if self._receiver is not None:
+            try:
+                await self._receiver
+            except asyncio.CancelledError:
+                # the receive task was stopped by drop()
+                pass
+
+    async def close(self):
+        self.closing = True
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self._stopTasks()
+        if self.socket is not None:
+            await self.socket.close()
+        await self.closed()
+
+    def _sendText(self, text):
+        # only queue, the writer task puts the messages on the wire one after the other
+        self._outgoing.append(text)
+        self._wake.set()
+
+    async def request(self, action, body, timeoutMs=None):
+        """Send a request and wait for the reply, returns (status, data)"""
+        done = asyncio.Event()
+        result = []
+
+        def onReply(status, data):
+            result.append((status, data))
+            done.set()
+
+        self.sendRequest(action, body, onReply, timeoutMs)
+        await done.wait()
+        return result[0]
+
+    async def refreshToken(self, getToken, periodMs):
+        """
+        Task that re-authenticates the socket every periodMs with the token from getToken(),
+        getToken may be a plain function or a coroutine function. Run it with addTask.
+        """
+        while True:
+            await asyncio.sleep(periodMs / 1000)
+            token = getToken()
+            if hasattr(token, 'send'):
+                token = await token
+            if token:
+                self.authenticateWithSocket(token)
+
+    async def _send(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            if self._pingPending and self.socket.open:
+                self._pingPending = False
+                await self.socket.ping()
+            while self._outgoing and self.socket.open:
+                # everything queued since the last write goes out together, in batches of coalesceBytes
+                batch = []
+                size = 0
+                while self._outgoing and (not batch or size + len(self._outgoing[0]) <= self.coalesceBytes):
+                    text = self._outgoing.pop(0)
+                    batch.append(text)
+                    size += len(text)
+                await self.socket.send_many(batch)
+
+    async def _receive(self):
+        try:
+            while self.socket.open:
+                incomingMessage = await self.socket.recv()
+                if incomingMessage is None:
+                    break
+                self._handleText(incomingMessage)
+        finally:
+            self._stopTasks()
+            self.requests.failAll()
+
+    def _stopTasks(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _keepAlive(self):
+        while True:
+            await asyncio.sleep(1)
+            self.requests.expire()
+            state = self.link.poll(self.socket)
+            if state == PING:
+                self.ping()
+            elif state == DEAD:
+                # the server stopped answering, ends the receive task
+                self.drop()
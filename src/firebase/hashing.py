@@ -0,0 +1,68 @@
+"""
+Realtime database node hashes
+
+The server compares the 'h' sent with a listen request against the hash of
+its own copy of the data and skips sending the snapshot when they match.
+The hash is the one computed by the Firebase SDKs: a base64 sha1 over a text
+form of the node, children visited in key order.
+"""
+
+import uhashlib as hashlib
+import ubinascii as binascii
+import ustruct as struct
+
+_INT_MIN = -2147483648
+_INT_MAX = 2147483647
+
+
+def _sha1(text):
+    digest = hashlib.sha1(text.encode('utf-8')).digest()
+    return binascii.b2a_base64(digest)[:-1].decode('ascii')
+
+
+def _intKey(key):
+    # keys that look like 32 bit integers sort numerically, before every other key
+    n = len(key)
+    start = 1 if n > 1 and key[0] == '-' else 0
+    if n - start < 1 or n - start > 10:
+        return None
+    if not key[start:].isdigit():
+        return None
+    value = int(key)
+    if value < _INT_MIN or value > _INT_MAX:
+        return None
+    if str(value) != key:
+        return None
+    return value
+
+
+def _keyOrder(key):
+    value = _intKey(key)
+    if value is None:
+        return (1, 0, key)
+    return (0, value, key)
+
+
+def _leafText(value):
+    if isinstance(value, bool):
+        return 'boolean:' + ('true' if value else 'false')
+    if isinstance(value, (int, float)):
+        # the IEEE 754 double of the number as lower case hex
+        return 'number:' + binascii.hexlify(struct.pack('>d', float(value))).decode('ascii')
+    return 'string:' + str(value)
+
+
+def nodeHash(value):
+    """Hash of a database value as the server computes it, '' for an empty node"""
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        text = ''
+        for key in sorted(value, key=_keyOrder):
+            childHash = nodeHash(value[key])
+            if childHash:
+                text += ':' + key + ':' + childHash
+        return _sha1(text) if text else ''
+    if isinstance(value, list):
+        return nodeHash(dict((str(i), v) for i, v in enumerate(value)))
+    return _sha1(_leafText(value))
@@ -0,0 +1,177 @@
+"""
+Minimal HTTP/1.1 client for the Firebase REST endpoints
+
+Only what the token calls need: POST a JSON body over a kept-alive
+connection and pull a few top level fields out of the JSON reply while it is
+being read, without building the whole document.
+"""
+
+from src.firebase.connector import connector as defaultConnector
+from src.firebase.jsonstream import JSONStream
+from src.utils.ticks import ticks_ms, ticks_diff
+
+_READ_SIZE = const(512)
+
+
+def splitURL(url):
+    """'https://host:port/path?q' -> (secure, host, port, '/path?q')"""
+    scheme, _, rest = url.partition('://')
+    secure = scheme == 'https'
+    hostport, slash, path = rest.partition('/')
+    host, _, port = hostport.partition(':')
+    port = int(port) if port else (443 if secure else 80)
+    return secure, host, port, slash + path if slash else '/'
+
+
+def _fieldCollector(fields):
+    # keep the top level fields (and the members of those that are objects, e.g. error.message)
+    result = {}
+
+    def accept(path):
+        return path[0] in fields and len(path) <= 2
+
+    def onValue(path, value):
+        if len(path) == 1:
+            result[path[0]] = value
+        elif len(path) == 2:
+            parent = result.get(path[0])
+            if not isinstance(parent, dict):
+                parent = result[path[0]] = {}
+            parent[path[1]] = value
+
+    return result, accept, onValue
+
+
+class HTTPClient:
+    """
+    post(url, body, fields) sends body as a JSON POST and returns
+    (status, values): values holds the requested top level fields of the JSON
+    reply, nested one level deep for objects.
+
+    One connection per host is kept open between requests (HTTP keep-alive)
+    for up to idleTimeoutMs. When a kept connection turns out to have been
+    closed by the server the request is sent once more on a new one. Sockets
+    come from connector (connector.connector by default) so they share its
+    DNS and TLS session caches. opened and reused count the connections.
+    """
+
+    def __init__(self, connector=None, idleTimeoutMs=60000):
+        self.connector = connector if connector is not None else defaultConnector
+        self.idleTimeoutMs = idleTimeoutMs
+        # (secure, host, port) -> (socket, ticks_ms when it went idle)
+        self._pool = {}
+        self.opened = 0
+        self.reused = 0
+
+    def post(self, url, body, fields, headers=None):
+        """POST body (str or bytes) to url, returns (status, values of fields)"""
+        secure, host, port, path = splitURL(url)
+        key = (secure, host, port)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        request = 'POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'.format(
+            path, host, len(body))
+        if headers:
+            for name in headers:
+                request += '{}: {}\r\n'.format(name, headers[name])
+        request = request.encode('utf-8') + b'\r\n' + body
+
+        while True:
+            sock, reused = self._acquire(key)
+            try:
+                # headers and body in one write, one TLS record for small requests
+                sock.write(request)
+                status, keepAlive, values = self._readResponse(sock, fields)
+            except (OSError, ValueError):
+                self._discard(sock)
+                if reused:
+                    # the server dropped the idle connection, try once on a fresh one
+                    continue
+                raise
+            if keepAlive:
+                self._pool[key] = (sock, ticks_ms())
+            else:
+                self._discard(sock)
+            return status, values
+
+    def close(self):
+        """Close the kept-alive connections"""
+        for key in list(self._pool):
+            self._discard(self._pool.pop(key)[0])
+
+    def _acquire(self, key):
+        pooled = self._pool.pop(key, None)
+        if pooled is not None:
+            if ticks_diff(ticks_ms(), pooled[1]) < self.idleTimeoutMs:
+                self.reused += 1
+                return pooled[0], True
+            self._discard(pooled[0])
+        self.opened += 1
+        return self.connector.open(key[1], key[2], key[0]), False
+
+    def _discard(self, sock):
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _readResponse(self, sock, fields):
+        line = sock.readline()
+        if not line:
+            raise ValueError('connection closed')
+        status = int(line.split(None, 2)[1])
+        keepAlive = not line.startswith(b'HTTP/1.0')
+        length = None
+        chunked = False
+        while True:
+            line = sock.readline()
+            if not line or line == b'\r\n':
+                break
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b'content-length':
+                length = int(value)
+            elif name == b'transfer-encoding':
+                chunked = value == b'chunked'
+            elif name == b'connection':
+                keepAlive = value == b'keep-alive'
+
+        values, accept, onValue = _fieldCollector(fields)
+        parser = JSONStream(onValue, accept)
+        if chunked:
+            while True:
+                size = int(sock.readline().split(b';')[0], 16)
+                if size == 0:
+                    # trailers end with an empty line
+                    while sock.readline() not in (b'\r\n', b''):
+                        pass
+                    break
+                parser = self._readBody(sock, size, parser)
+                sock.readline()
+        elif length is not None:
+            self._readBody(sock, length, parser)
+        else:
+            # the body ends with the connection
+            self._readBody(sock, None, parser)
+            keepAlive = False
+        return status, keepAlive, values
+
+    def _readBody(self, sock, length, parser):
+        # read length bytes (or up to the end of the connection) into parser, returns the parser
+        # or None once the body turned out not to be JSON
+        while length is None or length > 0:
+            chunk = sock.read(_READ_SIZE if length is None else min(length, _READ_SIZE))
+            if not chunk:
+                if length is None:
+                    return parser
+                raise ValueError('connection closed')
+            if length is not None:
+                length -= len(chunk)
+            if parser is not None:
+                try:
+                    parser.feed(chunk)
+                except ValueError:
+                    # not JSON, keep reading so the connection stays usable
+                    parser = None
+        return parser
@@ -0,0 +1,399 @@
+"""
+Keeps the writes made while offline on flash and sends them once back online
+"""
+
+import ujson
+import ustruct as struct
+import uos as os
+
+from src.firebase.protocol import ConnectionClosed
+from src.utils.ticks import ticks_ms, ticks_diff
+from src.utils.metrics import metrics
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# record tags, a record is the header (tag, path id, payload length) then the payload
+_PATH = 1  # the path of an id, for the rest of the segment
+_INT = 2
+_FLOAT = 3
+_TRUE = 4
+_FALSE = 5
+_NULL = 6
+_STR = 7
+_JSON = 8
+
+_HEADER = '<BHH'
+_HEADER_SIZE = 5
+
+_journaled = metrics.counter('journal.records')
+_replayed = metrics.counter('journal.replayed')
+_dropped = metrics.counter('journal.dropped')
+_bytes = metrics.gauge('journal.bytes')
+
+
+def _pack(value):
+    if value is True:
+        return _TRUE, b''
+    if value is False:
+        return _FALSE, b''
+    if value is None:
+        return _NULL, b''
+    if isinstance(value, int) and -0x80000000 <= value <= 0x7fffffff:
+        return _INT, struct.pack('<i', value)
+    if isinstance(value, float):
+        return _FLOAT, struct.pack('<d', value)
+    if isinstance(value, str):
+        return _STR, value.encode('utf-8')
+    return _JSON, ujson.dumps(value).encode('utf-8')
+
+
+def _unpack(tag, payload):
+    if tag == _INT:
+        return struct.unpack('<i', payload)[0]
+    if tag == _FLOAT:
+        return struct.unpack('<d', payload)[0]
+    if tag == _TRUE:
+        return True
+    if tag == _FALSE:
+        return False
+    if tag == _NULL:
+        return None
+    if tag == _STR:
+        return str(payload, 'utf-8')
+    return ujson.loads(payload)
+
+
+def _record(tag, pathId, payload):
+    return struct.pack(_HEADER, tag, pathId, len(payload)) + payload
+
+
+class Journal:
+    """
+    Write path/value pairs through write(path, value): while the realtime
+    connection is up and nothing is waiting they go straight out as updates
+    of basePath, otherwise (or when the server doesn't acknowledge them) they
+    are appended to a journal on flash and poll() replays it once the
+    connection is back.
+
+    The journal is a directory of segment files of about segmentBytes, each a
+    sequence of binary records: the path is written once per segment and
+    referred to by a 2 byte id, ints, floats, booleans and strings are packed,
+    anything else is stored as JSON. Records are buffered in RAM and reach
+    the flash every flushMs or 256 bytes, a power cut loses at most that and
+    a half written record only ends its segment.
+
+    Writes are last value wins, like FirebaseRealTime.update: when the
+    journal grows past maxBytes it is compacted to the latest value of every
+    path. If that is still too big new writes are dropped (and counted).
+
+    Replaying reads from the checkpoint (segment, offset, saved with a tmp
+    file and a rename) one batch of at most batchSize records / batchBytes at
+    a time, sends it as one update and only moves the checkpoint when the
+    server acknowledged it, so a reboot in the middle resends at most one
+    batch. One batch is in flight at a time: a quick acknowledgement doubles
+    batchSize (up to maxBatch), a failure halves it. Replaying needs memory
+    for one batch whatever the size of the journal, compacting one value per
+    distinct path.
+
+    Call poll() from the main loop, or run() as an asyncio task.
+    journaled, replayed, sentDirect, dropped and compactions keep count.
+    """
+
+    def __init__(self, firebaseRealtime=None, directory='journal', basePath='', maxBytes=65536, segmentBytes=4096,
+                 batchSize=16, maxBatch=64, batchBytes=2048, flushMs=1000, fastAckMs=1000, pollMs=200):
+        self.rt = firebaseRealtime
+        self.directory = directory
+        self.basePath = basePath
+        self.maxBytes = maxBytes
+        self.segmentBytes = segmentBytes
+        self.batchSize = batchSize
+        self.maxBatch = maxBatch
+        self.batchBytes = batchBytes
+        self.flushMs = flushMs
+        self.fastAckMs = fastAckMs
+        self.pollMs = pollMs
+        self.journaled = 0
+        self.replayed = 0
+        self.sentDirect = 0
+        self.dropped = 0
+        self.compactions = 0
+        # records not on flash yet
+        self._buf = bytearray()
+        self._bufAt = None
+        # the segment being appended to
+        self._file = None
+        self._seg = None
+        self._ids = {}
+        # path -> token of the direct write in flight for it
+        self._direct = {}
+        self._token = 0
+        self._inFlight = False
+        # bumped by a compaction, a batch sent before it can't move the checkpoint
+        self._generation = 0
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass
+        # segment number -> size on flash
+        self._segments = {}
+        for name in os.listdir(directory):
+            if name.endswith('.jnl'):
+                self._segments[int(name[:-4])] = os.stat(self._name(int(name[:-4])))[6]
+        self._nextSeg = max(self._segments) + 1 if self._segments else 0
+        self._checkpoint = self._loadCheckpoint()
+        _bytes.set(self.size())
+
+    def size(self):
+        """Bytes in the journal, on flash or about to be"""
+        return sum(self._segments.values()) + len(self._buf)
+
+    def isEmpty(self):
+        return not self._segments and not self._buf
+
+    def write(self, path, value):
+        """Send or journal value for path, returns False when it was dropped"""
+        if self.rt is not None and self.isEmpty() and not self._inFlight and self.rt.isConnected():
+            self._token += 1
+            token = self._token
+            self._direct[path] = token
+
+            def onAck(status, data):
+                # journal it unless a newer write of the same path has been made since
+                if self._direct.get(path) == token:
+                    del self._direct[path]
+                    if status != 'ok':
+                        self._append(path, value)
+
+            try:
+                self.rt.update(self.basePath, {path: value}, onAck)
+            except (ConnectionClosed, OSError):
+                # the request is failed when the connection is replaced, onAck journals it then
+                pass
+            self.sentDirect += 1
+            return True
+        # a direct write of path still in flight is older than this one, it must not be journaled after it
+        self._direct.pop(path, None)
+        return self._append(path, value)
+
+    def flush(self):
+        """Put the buffered records on flash"""
+        if not self._buf:
+            return
+        self._file.write(self._buf)
+        self._file.flush()
+        self._segments[self._seg] += len(self._buf)
+        self._buf = bytearray()
+        self._bufAt = None
+
+    def poll(self):
+        """Flush when it is time to and replay the next batch while connected"""
+        if self._bufAt is not None and ticks_diff(ticks_ms(), self._bufAt) >= self.flushMs:
+            self.flush()
+        if self._inFlight or self.isEmpty() or self.rt is None or not self.rt.isConnected():
+            return
+        self.flush()
+        batch = {}
+        count = 0
+        size = 0
+        end = self._checkpoint
+        records = self._records(self._checkpoint)
+        for position, tag, path, payload in records:
+            end = position
+            if tag == _PATH:
+                continue
+            batch[path] = _unpack(tag, payload)
+            count += 1
+            size += len(path) + len(payload)
+            if count >= self.batchSize or size >= self.batchBytes:
+                break
+        records.close()
+        if not batch:
+            # only path records or a broken tail were left
+            self._advance(end)
+            return
+        self._inFlight = True
+        sentAt = ticks_ms()
+        generation = self._generation
+
+        def onAck(status, data):
+            self._inFlight = False
+            if status != 'ok':
+                self.batchSize = max(1, self.batchSize // 2)
+                return
+            self.replayed += count
+            _replayed.inc(count)
+            if ticks_diff(ticks_ms(), sentAt) < self.fastAckMs:
+                self.batchSize = min(self.maxBatch, self.batchSize * 2)
+            if generation == self._generation:
+                self._advance(end)
+
+        try:
+            self.rt.update(self.basePath, batch, onAck)
+        except (ConnectionClosed, OSError):
+            # failed with the other pending requests when the connection is replaced
+            pass
+
+    async def run(self):
+        """poll() for an asyncio task"""
+        while True:
+            self.poll()
+            await asyncio.sleep(self.pollMs / 1000)
+
+    def _append(self, path, value):
+        tag, payload = _pack(value)
+        if len(payload) > 0xffff:
+            raise ValueError('value too big for the journal')
+        need = 2 * _HEADER_SIZE + len(path) + len(payload)
+        if self.size() + need > self.maxBytes:
+            self._compact()
+            if self.size() + need > self.maxBytes:
+                self.dropped += 1
+                _dropped.inc()
+                return False
+        if self._seg is None or self._segments[self._seg] + len(self._buf) + need > self.segmentBytes:
+            self._roll()
+        pathId = self._ids.get(path)
+        if pathId is None:
+            pathId = self._ids[path] = len(self._ids)
+            self._buf.extend(_record(_PATH, pathId, path.encode('utf-8')))
+        self._buf.extend(_record(tag, pathId, payload))
+        self.journaled += 1
+        _journaled.inc()
+        _bytes.set(self.size())
+        if len(self._buf) >= 256:
+            self.flush()
+        elif self._bufAt is None:
+            self._bufAt = ticks_ms()
+        return True
+
+    def _roll(self):
+        # close the segment being appended to and start the next one
+        self._close()
+        self._seg = self._nextSeg
+        self._nextSeg += 1
+        self._file = open(self._name(self._seg), 'wb')
+        self._segments[self._seg] = 0
+        self._ids = {}
+
+    def _close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+        self._seg = None
+
+    def _records(self, start):
+        # yields ((segment, offset after the record), tag, path, payload) from start to the end of the journal
+        seg, offset = start
+        for number in sorted(self._segments):
+            if number < seg:
+                continue
+            if number > seg:
+                offset = 0
+            names = {}
+            with open(self._name(number), 'rb') as f:
+                position = 0
+                while True:
+                    header = f.read(_HEADER_SIZE)
+                    if len(header) < _HEADER_SIZE:
+                        break
+                    tag, pathId, length = struct.unpack(_HEADER, header)
+                    if position < offset and tag != _PATH:
+                        # before the start, only the path ids are needed
+                        f.seek(length, 1)
+                        position += _HEADER_SIZE + length
+                        continue
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        # cut short by a power failure
+                        break
+                    position += _HEADER_SIZE + length
+                    if tag == _PATH:
+                        names[pathId] = str(payload, 'utf-8')
+                        if position <= offset:
+                            continue
+                    if pathId in names:
+                        yield (number, position), tag, names[pathId], payload
+            if number != self._seg:
+                # the whole segment has been read, it can go
+                yield (number + 1, 0), _PATH, None, None
+
+    def _advance(self, position):
+        # the records before position have been delivered
+        seg, offset = position
+        for number in sorted(self._segments):
+            if number < seg and number != self._seg:
+                self._remove(number)
+        if seg == self._seg and offset >= self._segments[seg] and not self._buf:
+            # everything has been delivered, the next write starts a new segment
+            self._close()
+            self._remove(seg)
+            seg, offset = seg + 1, 0
+        self._saveCheckpoint(seg, offset)
+        _bytes.set(self.size())
+
+    def _compact(self):
+        # rewrite the journal with the latest value of every path
+        self._close()
+        latest = {}
+        records = self._records(self._checkpoint)
+        for position, tag, path, payload in records:
+            if tag != _PATH:
+                latest[path] = (tag, payload)
+        records.close()
+        seg = self._nextSeg
+        self._nextSeg += 1
+        size = 0
+        with open(self._name(seg), 'wb') as f:
+            pathId = 0
+            for path in latest:
+                tag, payload = latest[path]
+                record = _record(_PATH, pathId, path.encode('utf-8')) + _record(tag, pathId, payload)
+                f.write(record)
+                size += len(record)
+                pathId += 1
+        old = list(self._segments)
+        self._segments[seg] = size
+        self._saveCheckpoint(seg, 0)
+        for number in old:
+            self._remove(number)
+        self._generation += 1
+        self.compactions += 1
+
+    def _remove(self, number):
+        self._segments.pop(number, None)
+        try:
+            os.remove(self._name(number))
+        except OSError:
+            pass
+
+    def _name(self, number):
+        return '{}/{:08d}.jnl'.format(self.directory, number)
+
+    def _loadCheckpoint(self):
+        try:
+            with open(self.directory + '/checkpoint', 'rb') as f:
+                data = f.read(8)
+        except OSError:
+            return (0, 0)
+        if len(data) != 8:
+            # cut short, start from the oldest segment
+            return (0, 0)
+        return struct.unpack('<II', data)
+
+    def _saveCheckpoint(self, seg, offset):
+        self._checkpoint = (seg, offset)
+        path = self.directory + '/checkpoint'
+        with open(path + '.tmp', 'wb') as f:
+            f.write(struct.pack('<II', seg, offset))
+        try:
+            os.rename(path + '.tmp', path)
+        except OSError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            os.rename(path + '.tmp', path)
@@ -0,0 +1,427 @@
+"""
+Incremental JSON parsing
+
+JSONStream is fed a JSON document in pieces (as they come off the websocket)
+and reports every leaf value together with its path, without ever holding the
+whole document. Subtrees rejected by the accept predicate are scanned over
+without being built.
+
+FirebaseMessageParser sits on top of it and understands the realtime database
+wire envelope {"t":"d","d":{"r":1,"a":"d","b":{"p":"path","d":...}}}, turning
+the data part into (database path, value) events.
+"""
+
+import ujson
+
+# parser states
+_VALUE = const(0)    # expecting a value
+_KEY = const(1)      # expecting an object key (or the end of the object)
+_COLON = const(2)    # expecting the ':' after a key
+_NEXT = const(3)     # expecting ',' or the end of the container
+_STRING = const(4)   # inside a string
+_LITERAL = const(5)  # inside a number, true, false or null
+_DONE = const(6)     # the root value is complete
+
+_OBJECT = const(0x7b)  # {
+_ARRAY = const(0x5b)   # [
+_QUOTE = const(0x22)
+_WHITESPACE = b' \t\r\n'
+_LITERAL_END = b' \t\r\n,}]'
+
+
+class JSONStream:
+    """
+    Incremental JSON parser.
+
+    onValue(path, value) is called for every scalar (and every empty object or
+    array) as soon as it has been read. path is the list of keys and array
+    indexes from the root down to the value, it is reused by the parser so copy
+    it if you need to keep it.
+    accept(path), when given, is asked before each value is read, returning
+    False skips that value and everything below it.
+    onEnd() is called once the root value is complete.
+    """
+
+    def __init__(self, onValue, accept=None, onEnd=None):
+        self.onValue = onValue
+        self.accept = accept
+        self.onEnd = onEnd
+        self._buf = bytearray()
+        self.reset()
+
+    def reset(self):
+        """Get ready to parse a new document"""
+        self.path = []
+        self._stack = []
+        self._counts = []
+        self._state = _VALUE
+        self._isKey = False
+        self._escaped = False
+        self._esc = False
+        # depth of the stack where skipping started, -1 when not skipping
+        self._skipAt = -1
+        self._buf = bytearray()
+        self.done = False
+
+    def feed(self, chunk):
+        """Parse the next piece of the document (bytes, bytearray, memoryview or str)"""
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        elif not isinstance(chunk, bytes):
+            chunk = bytes(chunk)
+        i = 0
+        n = len(chunk)
+        while i < n:
+            state = self._state
+            if state == _STRING:
+                i = self._string(chunk, i, n)
+                continue
+            c = chunk[i]
+            if state == _LITERAL:
+                if c in _LITERAL_END:
+                    self._end_literal()
+                    # the delimiter is handled by the next state
+                    continue
+                if self._skipAt < 0:
+                    self._buf.append(c)
+                i += 1
+                continue
+            i += 1
+            if c in _WHITESPACE:
+                continue
+            if state == _VALUE:
+                if self._stack and self._stack[-1] == _ARRAY:
+                    if c == 0x5d and self._counts[-1] == 0:  # ] of an empty array
+                        self._close(c)
+                        continue
+                    self.path[-1] = self._counts[-1]
+                    self._counts[-1] += 1
+                self._start_value(c)
+            elif state == _NEXT:
+                if c == 0x2c:  # ,
+                    self._state = _KEY if self._stack[-1] == _OBJECT else _VALUE
+                elif c == 0x7d or c == 0x5d:  # } ]
+                    self._close(c)
+                else:
+                    self._error(c)
+            elif state == _KEY:
+                if c == _QUOTE:
+                    self._isKey = True
+                    self._begin_string()
+                elif c == 0x7d and self._counts[-1] == 0:
+                    self._close(c)
+                else:
+                    self._error(c)
+            elif state == _COLON:
+                if c != 0x3a:  # :
+                    self._error(c)
+                self._state = _VALUE
+            else:
+                self._error(c)
+
+    def end(self):
+        """Flush a trailing number at the root and check the document is complete"""
+        if self._state == _LITERAL and not self._stack:
+            self._end_literal()
+        if not self.done:
+            raise ValueError('incomplete JSON document')
+
+    def _error(self, c):
+        raise ValueError('unexpected {!r} in JSON'.format(chr(c)))
+
+    def _start_value(self, c):
+        # c is the first byte of a value, self.path already points at it
+        if self._skipAt < 0 and self.accept is not None and self._stack and not self.accept(self.path):
+            self._skipAt = len(self._stack)
+        if c == _OBJECT or c == _ARRAY:
+            self._stack.append(c)
+            self._counts.append(0)
+            self.path.append(None)
+            self._state = _KEY if c == _OBJECT else _VALUE
+        elif c == _QUOTE:
+            self._isKey = False
+            self._begin_string()
+        else:
+            self._state = _LITERAL
+            self._buf = bytearray()
+            if self._skipAt < 0:
+                self._buf.append(c)
+
+    def _close(self, c):
+        kind = self._stack.pop()
+        if (kind == _OBJECT) != (c == 0x7d):
+            self._error(c)
+        count = self._counts.pop()
+        self.path.pop()
+        if count == 0 and self._skipAt < 0:
+            self.onValue(self.path, {} if kind == _OBJECT else [])
+        self._value_done()
+
+    def _value_done(self):
+        if self._skipAt == len(self._stack):
+            self._skipAt = -1
+        if self._stack:
+            self._state = _NEXT
+        else:
+            self._state = _DONE
+            self.done = True
+            if self.onEnd is not None:
+                self.onEnd()
+
+    def _begin_string(self):
+        self._state = _STRING
+        self._buf = bytearray()
+        self._escaped = False
+        self._esc = False
+
+    def _string(self, chunk, i, n):
+        # consume string content from chunk[i:], return where parsing should carry on
+        keep = self._skipAt < 0
+        buf = self._buf
+        while i < n:
+            if self._esc:
+                # the byte after a backslash never ends the string
+                self._esc = False
+                if keep:
+                    buf.append(chunk[i])
+                i += 1
+                continue
+            j = chunk.find(b'"', i)
+            end = j if j >= 0 else n
+            k = chunk.find(b'\\', i, end)
+            if k >= 0:
+                if keep:
+                    buf.extend(chunk[i:k + 1])
+                self._escaped = True
+                self._esc = True
+                i = k + 1
+                continue
+            if keep:
+                buf.extend(chunk[i:end])
+            if j < 0:
+                return n
+            self._end_string()
+            return j + 1
+        return i
+
+    def _end_string(self):
+        value = None
+        if self._skipAt < 0:
+            if self._escaped:
+                # let the json module deal with \n, \uXXXX and friends
+                value = ujson.loads('"' + str(self._buf, 'utf-8') + '"')
+            else:
+                value = str(self._buf, 'utf-8')
+        if self._isKey:
+            if self._skipAt < 0:
+                self.path[-1] = value
+            self._counts[-1] += 1
+            self._state = _COLON
+        else:
+            if self._skipAt < 0:
+                self.onValue(self.path, value)
+            self._value_done()
+
+    def _end_literal(self):
+        if self._skipAt < 0:
+            text = str(self._buf, 'ascii')
+            if text == 'true':
+                value = True
+            elif text == 'false':
+                value = False
+            elif text == 'null':
+                value = None
+            elif '.' in text or 'e' in text or 'E' in text:
+                value = float(text)
+            else:
+                value = int(text)
+            self.onValue(self.path, value)
+        self._value_done()
+
+
+def prefixFilter(paths):
+    """
+    Build an accept predicate for FirebaseMessageParser that only lets through the given
+    database paths, their parents (so the parser can reach them) and everything below them.
+    """
+    paths = [p.strip('/') for p in paths]
+
+    def accept(path):
+        for p in paths:
+            if path == p or path.startswith(p + '/') or p.startswith(path + '/') or path == '':
+                return True
+        return False
+    return accept
+
+
+class FirebaseMessage:
+    """
+    The envelope fields of one realtime database message.
+    t is the message type ('d' data, 'c' control), action the 'a' field ('d' set, 'm' merge, ...),
+    requestId the 'r' of a reply, path the 'p' of a data push, status the 's' of a reply and hash its 'h'.
+    data holds the body of replies and control messages, data pushes are streamed as events instead
+    unless the parser was asked to materialize them. Materialized arrays become dicts keyed by index
+    strings, the same way the database addresses them.
+    """
+    __slots__ = ('t', 'action', 'requestId', 'path', 'status', 'hash', 'data')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.t = None
+        self.action = None
+        self.requestId = None
+        self.path = None
+        self.status = None
+        self.hash = None
+        self.data = None
+
+
+class FirebaseMessageParser:
+    """
+    Streaming parser for realtime database messages.
+
+    The data of a push ({"t":"d","d":{"a":"d"|"m","b":{"p":...,"d":...}}}) is reported as
+    onValue(path, value) events, path being the full database path of the value ('' for the root).
+    A None value means the node was deleted. accept(path), when given, is asked with database paths
+    and returning False skips that subtree without building it (see prefixFilter).
+    onMessage(message) is called with a FirebaseMessage once the whole message has been read, the
+    same FirebaseMessage object is reused for every message.
+    With materialize=True the data of pushes is built into message.data instead of being reported
+    as events (accept still applies).
+    """
+
+    def __init__(self, onValue, onMessage=None, accept=None, materialize=False):
+        self.onValue = onValue
+        self.onMessage = onMessage
+        self.accept = accept
+        self.materialize = materialize
+        self.message = FirebaseMessage()
+        self._json = JSONStream(self._on_json_value, self._accept_json, self._on_json_end)
+        self._data = None
+        self._materialize = None
+
+    def reset(self):
+        """Drop whatever was parsed of the current message"""
+        self._json.reset()
+        self.message.clear()
+        self._data = None
+        self._materialize = None
+
+    def feed(self, chunk):
+        self._json.feed(chunk)
+
+    def end(self):
+        """Finish the current message and get ready for the next one"""
+        try:
+            self._json.end()
+        finally:
+            self.reset()
+
+    def parse(self, text):
+        """Parse one whole message"""
+        self.feed(text)
+        self.end()
+
+    def _payload_depth(self, path):
+        # number of envelope keys in front of the payload, 0 if path is not inside the payload
+        if len(path) >= 2 and path[0] == 'd':
+            if self.message.t == 'c':
+                if path[1] == 'd':
+                    return 2
+            elif len(path) >= 3 and path[1] == 'b' and path[2] == 'd':
+                return 3
+        return 0
+
+    def _db_path(self, path, depth):
+        base = self.message.path.strip('/') if self.message.path else ''
+        parts = [str(k) for k in path[depth:]]
+        if base:
+            parts.insert(0, base)
+        return '/'.join(parts)
+
+    def _should_materialize(self):
+        # replies and control messages are small and wanted whole, so is a push whose path came after
+        # its data (we can't name the values until we know it)
+        if self._materialize is None:
+            self._materialize = self.materialize or self._is_whole()
+        return self._materialize
+
+    def _is_whole(self):
+        m = self.message
+        return m.t == 'c' or m.requestId is not None or m.path is None
+
+    def _accept_json(self, path):
+        depth = self._payload_depth(path)
+        if depth == 0 or self.accept is None or self._is_whole():
+            return True
+        return self.accept(self._db_path(path, depth))
+
+    def _on_json_value(self, path, value):
+        depth = self._payload_depth(path)
+        if depth:
+            if self._should_materialize():
+                self._data = _put(self._data, path, depth, value)
+            else:
+                self.onValue(self._db_path(path, depth), value)
+            return
+        m = self.message
+        if len(path) == 1 and path[0] == 't':
+            m.t = value
+        elif len(path) == 2 and path[0] == 'd':
+            key = path[1]
+            if key == 'a':
+                m.action = value
+            elif key == 'r':
+                m.requestId = value
+            elif key == 't' and m.t == 'c':
+                # control messages carry their own type, keep it as the action
+                m.action = value
+        elif len(path) == 3 and path[0] == 'd' and path[1] == 'b':
+            key = path[2]
+            if key == 'p':
+                m.path = value
+            elif key == 's':
+                m.status = value
+            elif key == 'h':
+                m.hash = value
+
+    def _on_json_end(self):
+        m = self.message
+        if self._materialize and not self.materialize and m.requestId is None and m.t == 'd':
+            # a push that named its path last, report its values now
+            walkValues(self._data, m.path, self.onValue, self.accept)
+        else:
+            m.data = self._data
+        if self.onMessage is not None:
+            self.onMessage(m)
+
+
+def _put(tree, path, depth, value):
+    # store value in the nested dict tree at path[depth:], returns the (new) root
+    if len(path) == depth:
+        return value
+    if not isinstance(tree, dict):
+        tree = {}
+    node = tree
+    for k in path[depth:-1]:
+        k = str(k)
+        child = node.get(k)
+        if not isinstance(child, dict):
+            child = node[k] = {}
+        node = child
+    node[str(path[-1])] = value
+    return tree
+
+
+def walkValues(value, path, onValue, accept=None):
+    """Report the leaves of a materialized value found at database path as onValue(path, value) events"""
+    path = path.strip('/') if path else ''
+    if accept is not None and path and not accept(path):
+        return
+    if isinstance(value, dict) and value:
+        for k in value:
+            walkValues(value[k], path + '/' + str(k) if path else str(k), onValue, accept)
+    else:
+        onValue(path, value)
@@ -0,0 +1,74 @@
+"""
+Keeps an idle websocket alive and measures the link
+"""
+
+from src.utils.ticks import ticks_ms, ticks_diff
+
+# what poll() asks the caller to do
+PING = 1
+DEAD = 2
+
+
+class KeepAlive:
+    """
+    Pings the server only once nothing has been received for idleMs, a busy
+    connection costs no extra traffic.
+
+    poll(socket) is called regularly from the code that owns the socket (the
+    listen loop or the asyncio keep alive task) and says what to do: PING
+    (send a websocket ping), DEAD (the last ping went unanswered for
+    pongTimeoutMs) or None. The pong is matched through socket.lastPong.
+
+    rttMs is the smoothed round trip time of the pings, lastRttMs the last
+    one. health is a 0-100 figure of the link: the share of recent pings that
+    were answered, scaled down when the round trip grows past goodRttMs.
+    """
+
+    def __init__(self, idleMs=25000, pongTimeoutMs=10000, goodRttMs=300):
+        self.idleMs = idleMs
+        self.pongTimeoutMs = pongTimeoutMs
+        self.goodRttMs = goodRttMs
+        self.rttMs = None
+        self.lastRttMs = None
+        self.pings = 0
+        self.missed = 0
+        self.health = 100
+        # smoothed share of answered pings, 0-1
+        self._answered = 1.0
+        self._pingAt = None
+
+    def poll(self, socket):
+        now = ticks_ms()
+        if self._pingAt is not None:
+            pong = socket.lastPong
+            if pong is not None and ticks_diff(pong, self._pingAt) >= 0:
+                self._pong(ticks_diff(pong, self._pingAt))
+            elif ticks_diff(now, self._pingAt) >= self.pongTimeoutMs:
+                self._pingAt = None
+                self.missed += 1
+                self._score(0)
+                return DEAD
+            else:
+                return None
+        if ticks_diff(now, socket.lastReceived) < self.idleMs:
+            return None
+        self._pingAt = now
+        self.pings += 1
+        return PING
+
+    def reset(self):
+        """Forget the outstanding ping, e.g. after a reconnect"""
+        self._pingAt = None
+
+    def _pong(self, rtt):
+        self._pingAt = None
+        self.lastRttMs = rtt
+        self.rttMs = rtt if self.rttMs is None else (self.rttMs * 7 + rtt) // 8
+        self._score(1)
+
+    def _score(self, answered):
+        self._answered = self._answered * 0.75 + answered * 0.25
+        rttScore = 1.0
+        if self.rttMs is not None and self.rttMs > self.goodRttMs:
+            rttScore = self.goodRttMs / self.rttMs
+        self.health = int(100 * self._answered * rttScore)
@@ -0,0 +1,57 @@
+"""
+Websocket payload masking
+
+RFC 6455 masks every client frame by XOR-ing the payload with a 4 byte key.
+The helpers in this module do that in place on a preallocated bytearray, a
+machine word at a time, instead of building a new bytes object byte by byte.
+
+On MicroPython the viper routines of viper_mask are used, on CPython (or a
+port built without viper) the whole payload is XOR-ed as one big integer,
+which allocates copies of it. ENGINE tells which one is in use.
+"""
+
+
+def _mask_bigint(buf, offset, length, mask_bits):
+    # XOR the payload with the repeated key as one big integer
+    if length <= 0:
+        return
+    key = bytes(mask_bits) * ((length + 3) >> 2)
+    end = offset + length
+    value = int.from_bytes(buf[offset:end], 'little') ^ int.from_bytes(key[:length], 'little')
+    buf[offset:end] = value.to_bytes(length, 'little')
+
+
+try:
+    from src.firebase.viper_mask import mask_words as _mask_words, mask_bytes as _mask_bytes
+except (ImportError, SyntaxError, ValueError):
+    # CPython, or a port without viper
+    _mask_words = None
+    _mask_bytes = None
+
+# which engine mask() runs on, shown by bench/mask_bench.py
+ENGINE = 'bigint' if _mask_words is None else 'viper'
+
+
+def mask(buf, mask_bits, length=None, offset=0):
+    """
+    XOR the length bytes of buf from offset on with the 4 byte mask_bits in place.
+    buf must be a writable buffer (bytearray or memoryview of one), nothing is allocated
+    on MicroPython. Masking is its own inverse, so the same call unmasks.
+    Pass the bytearray itself and an offset rather than a memoryview slice of it: only a
+    bytearray is known to be word aligned, a memoryview is masked a byte at a time.
+    """
+    if length is None:
+        length = len(buf) - offset
+    if _mask_words is not None:
+        if type(buf) is bytearray:
+            _mask_words(buf, offset, length, mask_bits)
+        else:
+            _mask_bytes(buf, offset, length, mask_bits)
+    else:
+        _mask_bigint(buf, offset, length, mask_bits)
+    return buf
+
+
+def mask_generator(data, mask_bits):
+    """The original per byte implementation, kept as a reference for the benchmark"""
+    return bytes(b ^ mask_bits[i % 4] for i, b in enumerate(data))
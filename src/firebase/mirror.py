@@ -0,0 +1,297 @@
+"""
+Local mirror of the subscribed realtime database paths
+"""
+
+from ucollections import OrderedDict
+
+from src.firebase.hashing import nodeHash
+
+
+def splitPath(path):
+    """'a/b/' -> ['a', 'b']"""
+    if not path:
+        return []
+    return [k for k in path.split('/') if k]
+
+
+def sizeOf(value):
+    """Rough number of heap bytes taken by a mirrored value"""
+    if value is None:
+        return 0
+    if isinstance(value, dict):
+        n = 32
+        for k in value:
+            n += 16 + len(k) + sizeOf(value[k])
+        return n
+    if isinstance(value, str):
+        return 16 + len(value)
+    return 16
+
+
+class Mirror:
+    """
+    In memory copy of the subscribed parts of the realtime database.
+
+    The tree is made of plain dicts and is kept up to date by apply() with the
+    'd' (set) and 'm' (merge) actions pushed by the server. get(path) walks the
+    tree so it costs O(depth). watch(path, callback) calls callback(path, value)
+    whenever something at, above or below path changes.
+
+    When maxBytes is set the mirror keeps an estimate of its size, counted per
+    child of each tracked path, and evicts the least recently used children
+    once it grows past maxBytes. Evicted paths are listed in evicted until the
+    server sends them again.
+    """
+
+    def __init__(self, maxBytes=None):
+        self.root = {}
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.evicted = set()
+        # tracked (subscribed) paths as lists of keys
+        self._roots = []
+        # unit path -> estimated size, least recently used first
+        self._units = OrderedDict()
+        self._watchers = {}
+
+    def track(self, path):
+        """Mirror the subtree at path (called on subscribe)"""
+        keys = splitPath(path)
+        if keys not in self._roots:
+            self._roots.append(keys)
+
+    def untrack(self, path):
+        """Stop mirroring path and drop the part of its data no other tracked path covers"""
+        keys = splitPath(path)
+        if keys not in self._roots:
+            return
+        self._roots.remove(keys)
+        n = len(keys)
+        for root in self._roots:
+            if len(root) <= n and keys[:len(root)] == root:
+                # still mirrored for a path above it, only its units change
+                self._recount(keys)
+                return
+        # the tracked paths below it keep their data
+        kept = [(root, self._peek(root)) for root in self._roots if len(root) > n and root[:n] == keys]
+        prefix = '/'.join(keys)
+        for unit in list(self._units):
+            if not prefix or unit == prefix or unit.startswith(prefix + '/'):
+                self.size -= self._units.pop(unit)
+        for unit in list(self.evicted):
+            if not prefix or unit == prefix or unit.startswith(prefix + '/'):
+                if not any(unit.startswith('/'.join(root) + '/') for root, value in kept):
+                    self.evicted.discard(unit)
+        if keys:
+            parent = self._peek(keys[:-1])
+            if isinstance(parent, dict):
+                parent.pop(keys[-1], None)
+                self._prune(keys)
+        else:
+            self.root = {}
+        for root, value in kept:
+            self._set(root, value)
+
+    def get(self, path, default=None):
+        """Current value at path, default when it is not in the mirror"""
+        keys = splitPath(path)
+        node = self.root
+        for k in keys:
+            if not isinstance(node, dict):
+                return default
+            node = node.get(k)
+            if node is None:
+                return default
+        self._touch(keys)
+        return node
+
+    def isComplete(self, path):
+        """False when part of the data at path has been evicted"""
+        path = '/'.join(splitPath(path))
+        for unit in self.evicted:
+            if not path or unit == path or unit.startswith(path + '/') or path.startswith(unit + '/'):
+                return False
+        return True
+
+    def hash(self, path):
+        """Hash of the mirrored data at path for a listen request, '' when the mirror can't vouch for it"""
+        if not self.isComplete(path):
+            return ''
+        return nodeHash(self.get(path))
+
+    def watch(self, path, callback):
+        path = '/'.join(splitPath(path))
+        if path not in self._watchers:
+            self._watchers[path] = []
+        self._watchers[path].append(callback)
+
+    def unwatch(self, path, callback):
+        path = '/'.join(splitPath(path))
+        callbacks = self._watchers.get(path)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._watchers[path]
+
+    def apply(self, action, path, data):
+        """Apply a server push: action 'd' replaces the node at path, 'm' replaces each of the given children"""
+        keys = splitPath(path)
+        if action == 'm':
+            if isinstance(data, dict):
+                for k in data:
+                    self._set(keys + splitPath(k), data[k])
+        else:
+            self._set(keys, data)
+        self._evict()
+        self._notify(keys)
+
+    def clear(self):
+        self.root = {}
+        self.size = 0
+        self._units = OrderedDict()
+        self.evicted = set()
+
+    def _unit_depth(self, keys):
+        # children of the deepest tracked path above keys are the unit of eviction
+        depth = 0
+        for root in self._roots:
+            n = len(root)
+            if n >= depth and keys[:n] == root:
+                depth = n
+        return depth + 1
+
+    def _peek(self, keys):
+        # the value at keys, without touching it
+        node = self.root
+        for k in keys:
+            if not isinstance(node, dict):
+                return None
+            node = node.get(k)
+        return node
+
+    def _recount(self, keys):
+        # the tracked paths around keys changed, count the units at keys again
+        prefix = '/'.join(keys)
+        for unit in list(self._units):
+            if not prefix or unit == prefix or unit.startswith(prefix + '/'):
+                self.size -= self._units.pop(unit)
+        depth = self._unit_depth(keys)
+        if len(keys) >= depth:
+            unit = '/'.join(keys[:depth])
+            size = sizeOf(self._peek(keys[:depth]))
+            self.size += size - self._units.pop(unit, 0)
+            if size > 0:
+                self._units[unit] = size
+        else:
+            self._add_units(keys, self._peek(keys), depth)
+
+    def _touch(self, keys):
+        if not self._units:
+            return
+        depth = self._unit_depth(keys)
+        if len(keys) < depth:
+            return
+        unit = '/'.join(keys[:depth])
+        size = self._units.pop(unit, None)
+        if size is not None:
+            # move to the most recently used end
+            self._units[unit] = size
+
+    def _set(self, keys, value):
+        if value == {}:
+            value = None
+        # find the parent, creating it when there is something to store
+        node = self.root
+        for k in keys[:-1]:
+            child = node.get(k)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[k] = {}
+            node = child
+
+        if keys:
+            old = node.get(keys[-1])
+            if value is None:
+                node.pop(keys[-1], None)
+            else:
+                node[keys[-1]] = value
+        else:
+            old = self.root
+            self.root = value if isinstance(value, dict) else {}
+
+        self._account(keys, old, value)
+        if value is None:
+            self._prune(keys)
+
+    def _account(self, keys, old, value):
+        depth = self._unit_depth(keys)
+        if len(keys) >= depth:
+            # the change is inside one unit
+            unit = '/'.join(keys[:depth])
+            delta = sizeOf(value) - sizeOf(old)
+            size = self._units.pop(unit, 0) + delta
+            self.size += delta
+            if size > 0:
+                self._units[unit] = size
+            self.evicted.discard(unit)
+            return
+        # the change covers whole units, drop the old ones and count the new ones
+        prefix = '/'.join(keys)
+        for unit in list(self._units):
+            if not prefix or unit == prefix or unit.startswith(prefix + '/'):
+                self.size -= self._units.pop(unit)
+        for unit in list(self.evicted):
+            if not prefix or unit.startswith(prefix + '/'):
+                self.evicted.discard(unit)
+        self._add_units(keys, value, depth)
+
+    def _add_units(self, keys, value, depth):
+        if not isinstance(value, dict):
+            return
+        for k in value:
+            child = keys + [k]
+            if len(child) >= depth:
+                size = sizeOf(value[k])
+                self._units['/'.join(child)] = size
+                self.size += size
+            else:
+                self._add_units(child, value[k], self._unit_depth(child))
+
+    def _prune(self, keys):
+        # a node left without children no longer exists in the database
+        while keys:
+            keys = keys[:-1]
+            node = self.root
+            for k in keys:
+                node = node.get(k)
+            if not keys or node:
+                return
+            parent = self.root
+            for k in keys[:-1]:
+                parent = parent[k]
+            del parent[keys[-1]]
+            size = self._units.pop('/'.join(keys), None)
+            if size is not None:
+                self.size -= size
+
+    def _evict(self):
+        if not self.maxBytes:
+            return
+        while self.size > self.maxBytes and self._units:
+            unit = next(iter(self._units))
+            keys = splitPath(unit)
+            self._set(keys, None)
+            self._units.pop(unit, None)
+            self.evicted.add(unit)
+
+    def _notify(self, keys):
+        if not self._watchers:
+            return
+        changed = '/'.join(keys)
+        for path in list(self._watchers):
+            if (path == changed or not path or not changed
+                    or changed.startswith(path + '/') or path.startswith(changed + '/')):
+                value = self.get(path)
+                for callback in self._watchers.get(path, ()):
+                    callback(path, value)
@@ -5,21 +5,30 @@ Based very heavily off
 https://github.com/aaugustin/websockets/blob/master/websockets/client.py
 """
 
-import usocket as socket
 import ubinascii as binascii
 import urandom as random
-import ussl
 
 from src.firebase.protocol import Websocket, urlparse
+from src.firebase.connector import connector as defaultConnector
+from src.utils.ticks import ticks_ms
+from src.utils.metrics import metrics
+
+_upgradeMs = metrics.histogram('ws.upgradeMs')
 
 
 
 class WebsocketClient(Websocket):
     is_client = True
 
-def connect(uri):
+def connect(uri, rxBufferSize=None, maxMessageSize=None, connector=None, deflate=None):
     """
     Connect a websocket.
+    rxBufferSize optionally sets the size of the fixed receive buffer and maxMessageSize
+    the largest fragmented message that will be reassembled (see protocol.Websocket)
+    The socket is opened by connector (connector.connector by default), which caches the address
+    and the TLS session, connector.lastTimings gets the time the websocket upgrade took as upgradeMs
+    deflate, a compression.PerMessageDeflate, is offered to the server and set on the websocket when
+    the server takes it up
     """
 
     uri = urlparse(uri)
@@ -28,39 +37,48 @@ def connect(uri):
     if __debug__: LOGGER.debug("open connection %s:%s",
                                 uri.hostname, uri.port)
     '''
-    sock = socket.socket()
-    addr = socket.getaddrinfo(uri.hostname, uri.port)
-    sock.connect(addr[0][4])
-    if uri.protocol == 'wss':
-        sock = ussl.wrap_socket(sock, server_hostname=uri.hostname)
+    if connector is None:
+        connector = defaultConnector
+    sock = connector.open(uri.hostname, uri.port, uri.protocol == 'wss')
+    start = ticks_ms()
 
     def send_header(header, *args):
         #if __debug__: LOGGER.debug(str(header), *args)
-        sock.write(header % args + '\r\n')
+        sock.write((header % args + '\r\n').encode('utf-8'))
 
     # Sec-WebSocket-Key is 16 bytes of random base64 encoded
     key = binascii.b2a_base64(bytes(random.getrandbits(8)
-                                    for _ in range(16)))[:-1]
+                                    for _ in range(16)))[:-1].decode('ascii')
 
-    send_header(b'GET %s HTTP/1.1', uri.path or '/')
-    send_header(b'Host: %s:%s', uri.hostname, uri.port)
-    send_header(b'Connection: Upgrade')
-    send_header(b'Upgrade: websocket')
-    send_header(b'Sec-WebSocket-Key: %s', key)
-    send_header(b'Sec-WebSocket-Version: 13')
-    send_header(b'Origin: http://{hostname}:{port}'.format(
-        hostname=uri.hostname,
-        port=uri.port)
-    )
-    send_header(b'')
+    send_header('GET %s HTTP/1.1', uri.path or '/')
+    send_header('Host: %s:%s', uri.hostname, uri.port)
+    send_header('Connection: Upgrade')
+    send_header('Upgrade: websocket')
+    send_header('Sec-WebSocket-Key: %s', key)
+    send_header('Sec-WebSocket-Version: 13')
+    if deflate is not None:
+        send_header('Sec-WebSocket-Extensions: %s', deflate.offer())
+    send_header('Origin: http://%s:%s', uri.hostname, uri.port)
+    send_header('')
 
     header = sock.readline()[:-2]
     assert header.startswith(b'HTTP/1.1 101 '), header
 
-    # We don't (currently) need these headers
+    # Only the extension header is of interest
     # FIXME: should we check the return key?
+    accepted = False
     while header:
         #if __debug__: LOGGER.debug(str(header))
         header = sock.readline()[:-2]
+        name, _, value = header.partition(b':')
+        if deflate is not None and name.strip().lower() == b'sec-websocket-extensions':
+            accepted = deflate.accept(value.decode('utf-8').strip())
+            if not accepted:
+                sock.close()
+                raise ValueError('unsupported permessage-deflate answer')
+    connector.lastTimings['upgradeMs'] = _upgradeMs.since(start, ticks_ms())
 
-    return WebsocketClient(sock)
\ No newline at end of file
+    ws = WebsocketClient(sock, rxBufferSize, maxMessageSize)
+    if accepted:
+        ws.deflate = deflate
+    return ws
\ No newline at end of file
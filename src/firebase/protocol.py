@@ -2,14 +2,33 @@
 Websockets protocol
 """
 
-#import logging
 import ure as re
 import ustruct as struct
 import urandom as random
 import usocket as socket
 from ucollections import namedtuple
 
-#LOGGER = logging.getLogger(__name__)
+from src.firebase.masking import mask as mask_payload
+from src.utils.ticks import ticks_ms, ticks_us, ticks_diff
+from src.utils.metrics import metrics, US_BUCKETS
+
+try:
+    from micropython import schedule as _schedule
+except ImportError:
+    _schedule = None
+
+# logging is an optional micropython-lib package, only log when it is installed
+try:
+    import logging
+    LOGGER = logging.getLogger(__name__)
+except ImportError:
+    LOGGER = None
+
+_framesIn = metrics.counter('ws.framesIn')
+_bytesIn = metrics.counter('ws.bytesIn')
+_framesOut = metrics.counter('ws.framesOut')
+_bytesOut = metrics.counter('ws.bytesOut')
+_maskUs = metrics.histogram('ws.maskUs', US_BUCKETS)
 
 # Opcodes
 OP_CONT = const(0x0)
@@ -30,6 +49,9 @@ CLOSE_TOO_BIG = const(1009)
 CLOSE_MISSING_EXTN = const(1010)
 CLOSE_BAD_CONDITION = const(1011)
 
+# errno of a socket read that timed out, ETIMEDOUT and EAGAIN
+_TIMEOUT_ERRORS = (110, 11)
+
 URL_RE = re.compile(r'(wss|ws)://([A-Za-z0-9-\.]+)(?:\:([0-9]+))?(/.+)?')
 URI = namedtuple('URI', ('protocol', 'hostname', 'port', 'path'))
 
@@ -60,18 +82,142 @@ def urlparse(uri):
         return URI(protocol, host, int(port), path)
 
 
+def encode_frame(opcode, data=b'', mask=True, fin=True, rsv1=False, buf=None):
+    """
+    Build a complete frame, header and (masked) payload, in one bytearray.
+    rsv1 marks a compressed message (permessage-deflate).
+    When buf (a bytearray) is big enough the frame is built in it and a memoryview of buf is
+    returned, valid until buf is used again.
+    See https://tools.ietf.org/html/rfc6455#section-5.2 for the details.
+    """
+    length = len(data)
+
+    # Byte 1: FIN(1) RSV1(1) _(1) _(1) OPCODE(4)
+    byte1 = (0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode
+    # Byte 2: MASK(1) LENGTH(7)
+    byte2 = 0x80 if mask else 0
+
+    if length < 126:  # 126 is magic value to use 2-byte length header
+        header = struct.pack('!BB', byte1, byte2 | length)
+    elif length < (1 << 16):  # Length fits in 2-bytes
+        header = struct.pack('!BBH', byte1, byte2 | 126, length)
+    elif length < (1 << 64):
+        header = struct.pack('!BBQ', byte1, byte2 | 127, length)
+    else:
+        raise ValueError()
+
+    start = len(header) + (4 if mask else 0)
+    if buf is not None and len(buf) >= start + length:
+        frame = memoryview(buf)[:start + length]
+    else:
+        buf = frame = bytearray(start + length)
+    frame[:len(header)] = header
+    frame[start:] = data
+    if mask:  # Mask is 4 bytes
+        mask_bits = struct.pack('!I', random.getrandbits(32))
+        frame[len(header):start] = mask_bits
+        maskStart = ticks_us()
+        # mask the bytearray itself, at an offset, for the word at a time path
+        mask_payload(buf, mask_bits, length, start)
+        _maskUs.since(maskStart, ticks_us())
+    _framesOut.inc()
+    _bytesOut.inc(length)
+    return frame
+
+
+class FrameView:
+    """
+    A received payload that still lives in the websocket receive buffer.
+
+    Returned by Websocket.recv() when the socket was created with a receive
+    buffer. data is a memoryview into that buffer, so it is only valid until
+    the next call to recv(). The text is decoded lazily, on the first str().
+    """
+    __slots__ = ('data', 'opcode', '_text')
+
+    def __init__(self):
+        self.data = None
+        self.opcode = OP_TEXT
+        self._text = None
+
+    def _set(self, opcode, data):
+        self.opcode = opcode
+        self.data = data
+        self._text = None
+        return self
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        if self._text is None:
+            self._text = str(self.data, 'utf-8')
+        return self._text
+
+    def bytes(self):
+        # copy the payload out of the receive buffer
+        return bytes(self.data)
+
+
 class Websocket:
     """
     Basis of the Websocket protocol.
 
     This can probably be replaced with the C-based websocket module, but
     this one currently supports more options.
+
+    When rxBufferSize is given every frame that fits is read straight into one
+    preallocated bytearray and recv() hands back a FrameView over it instead of
+    allocating a new bytes and str per message. Larger frames fall back to a
+    heap allocation.
+
+    maxMessageSize bounds the size of a message reassembled from fragments,
+    larger messages close the socket with CLOSE_TOO_BIG. Setting onChunk
+    switches recv() to streaming, see recv().
     """
     is_client = False
-
-    def __init__(self, sock):
+    # the most bytes of queued frames put together in one socket write
+    coalesceBytes = 1400
+    # size of the scratch buffer used for streaming when there is no receive buffer
+    chunkSize = 1024
+    # how long the rest of a started frame may take to arrive before the connection is given up
+    midFrameTimeoutMs = 10000
+
+    def __init__(self, sock, rxBufferSize=None, maxMessageSize=None, onChunk=None):
         self.sock = sock
         self.open = True
+        self.maxMessageSize = maxMessageSize
+        self.onChunk = onChunk
+        # the negotiated compression.PerMessageDeflate, None without compression
+        self.deflate = None
+        self.rsv1 = False
+        self._compressed = False
+        self._chunkbuf = None
+        # state of a fragmented message being reassembled
+        self._msgopcode = None
+        self._msglen = 0
+        self._msgbuf = None
+        # ticks_ms of the last frame (of any kind) and the last pong received
+        self.lastReceived = ticks_ms()
+        self.lastPong = None
+        # fixed receive arena for the zero copy mode
+        self._rxbuf = None
+        self._rxview = None
+        self._frame = None
+        if rxBufferSize:
+            self._rxbuf = bytearray(rxBufferSize)
+            self._rxview = memoryview(self._rxbuf)
+            self._frame = FrameView()
+        # scratch buffer the frames written straight away are built in,
+        # it grows to the largest such frame and is then reused
+        self._txbuf = bytearray(0)
+        # outgoing frames waiting to be written, see flush()
+        self._outbox = []
+        self._writing = False
+        self._corked = 0
+        # frames queued and socket writes done, their ratio is the coalescing achieved
+        self.queued = 0
+        self.writes = 0
     
     def __enter__(self):
         return self
@@ -82,92 +228,222 @@ class Websocket:
     def settimeout(self, timeout):
         self.sock.settimeout(timeout)
 
-    def read_frame(self, max_size=None):
+    def read_header(self):
         """
-        Read a frame from the socket.
+        Read a frame header from the socket.
+        Returns fin, opcode, the payload length and the 4 mask bytes (None if the payload is not masked).
         See https://tools.ietf.org/html/rfc6455#section-5.2 for the details.
         """
 
         # Frame header
-        two_bytes = self.sock.read(2)
+        try:
+            two_bytes = self.sock.read(2)
+        except OSError as e:
+            # a read timeout (see settimeout) between frames only means nothing arrived
+            if e.args and e.args[0] in _TIMEOUT_ERRORS:
+                raise NoDataException
+            raise
 
         if not two_bytes:
             raise NoDataException
+        if len(two_bytes) == 1:
+            # the frame has started, the second byte must follow
+            two_bytes += self._read_exact(1)
+
+        # any frame at all shows the connection is alive
+        self.lastReceived = ticks_ms()
 
         byte1, byte2 = struct.unpack('!BB', two_bytes)
 
-        # Byte 1: FIN(1) _(1) _(1) _(1) OPCODE(4)
+        # Byte 1: FIN(1) RSV1(1) _(1) _(1) OPCODE(4)
         fin = bool(byte1 & 0x80)
         opcode = byte1 & 0x0f
+        # set on the first frame of a compressed message
+        self.rsv1 = bool(byte1 & 0x40)
 
         # Byte 2: MASK(1) LENGTH(7)
         mask = bool(byte2 & (1 << 7))
         length = byte2 & 0x7f
 
         if length == 126:  # Magic number, length header is 2 bytes
-            length, = struct.unpack('!H', self.sock.read(2))
+            length, = struct.unpack('!H', self._read_exact(2))
         elif length == 127:  # Magic number, length header is 8 bytes
-            length, = struct.unpack('!Q', self.sock.read(8))
+            length, = struct.unpack('!Q', self._read_exact(8))
 
+        mask_bits = None
         if mask:  # Mask is 4 bytes
-            mask_bits = self.sock.read(4)
+            mask_bits = self._read_exact(4)
+
+        _framesIn.inc()
+        _bytesIn.inc(length)
+        return fin, opcode, length, mask_bits
 
+    def read_payload(self, length, mask_bits=None, offset=0):
+        """
+        Read a frame payload of length bytes.
+        In zero copy mode the payload is placed at offset in the receive buffer and a memoryview is returned,
+        otherwise (or when it does not fit) a new bytearray.
+        Returns None when the payload can not be allocated, the socket is closed in that case.
+        """
         try:
-            data = self.sock.read(length)
+            if self._rxbuf is not None and offset + length <= len(self._rxbuf):
+                # fits in the receive arena, no allocation at all
+                data = self._rxview[offset:offset + length]
+            else:
+                data = bytearray(length)
+            self._read_into(memoryview(data))
         except MemoryError:
             # We can't receive this many bytes, close the socket
-            if __debug__: LOGGER.debug("Frame of length %s too big. Closing",
-                                       length)
+            if __debug__ and LOGGER: LOGGER.debug("Frame of length %s too big. Closing",
+                                                  length)
             self.close(code=CLOSE_TOO_BIG)
-            return True, OP_CLOSE, None
+            return None
 
-        if mask:
-            data = bytes(b ^ mask_bits[i % 4]
-                         for i, b in enumerate(data))
+        if mask_bits is not None:
+            if type(data) is bytearray:
+                mask_payload(data, mask_bits, length)
+            else:
+                # unmask the arena itself, see masking.mask
+                mask_payload(self._rxbuf, mask_bits, length, offset)
 
-        return fin, opcode, data
+        return data
 
-    def write_frame(self, opcode, data=b''):
+    def read_frame(self, max_size=None):
         """
-        Write a frame to the socket.
+        Read a frame from the socket.
         See https://tools.ietf.org/html/rfc6455#section-5.2 for the details.
         """
-        fin = True
-        mask = self.is_client  # messages sent by client are masked
-
-        length = len(data)
-
-        # Frame header
-        # Byte 1: FIN(1) _(1) _(1) _(1) OPCODE(4)
-        byte1 = 0x80 if fin else 0
-        byte1 |= opcode
-
-        # Byte 2: MASK(1) LENGTH(7)
-        byte2 = 0x80 if mask else 0
+        fin, opcode, length, mask_bits = self.read_header()
+        data = self.read_payload(length, mask_bits)
+        if data is None:
+            return True, OP_CLOSE, None
+        return fin, opcode, data
 
-        if length < 126:  # 126 is magic value to use 2-byte length header
-            byte2 |= length
-            self.sock.write(struct.pack('!BB', byte1, byte2))
+    def _read_exact(self, n):
+        """Read n bytes of a frame that has started"""
+        buf = bytearray(n)
+        self._read_into(memoryview(buf))
+        return buf
 
-        elif length < (1 << 16):  # Length fits in 2-bytes
-            byte2 |= 126  # Magic code
-            self.sock.write(struct.pack('!BBH', byte1, byte2, length))
+    def _read_into(self, view):
+        """
+        Fill the whole of view from the socket.
+        The frame has started, so a read timeout only means the rest is late: wait for it, up to
+        midFrameTimeoutMs, then close the socket and raise ConnectionClosed rather than leave the
+        stream in the middle of a frame.
+        """
+        got = 0
+        total = len(view)
+        stalledAt = None
+        while got < total:
+            try:
+                n = self.sock.readinto(view[got:])
+            except OSError as e:
+                if not (e.args and e.args[0] in _TIMEOUT_ERRORS):
+                    raise
+                if stalledAt is None:
+                    stalledAt = ticks_ms()
+                elif ticks_diff(ticks_ms(), stalledAt) >= self.midFrameTimeoutMs:
+                    if __debug__ and LOGGER: LOGGER.debug("Frame stalled for %s ms. Closing", self.midFrameTimeoutMs)
+                    self._close()
+                    raise ConnectionClosed()
+                continue
+            stalledAt = None
+            if not n:
+                # the stream ended in the middle of a frame
+                raise ValueError('short read')
+            got += n
 
-        elif length < (1 << 64):
-            byte2 |= 127  # Magic code
-            self.sock.write(struct.pack('!BBQ', byte1, byte2, length))
+    def write_frame(self, opcode, data=b''):
+        """
+        Queue a frame and, unless the socket is corked, write out the queue.
+        The frame is built whole (see encode_frame) so it goes out in a single write. When
+        nothing is queued it is built in the reusable _txbuf and written at once, queued frames
+        need buffers of their own.
+        """
+        rsv1 = False
+        if self.deflate is not None and (opcode == OP_TEXT or opcode == OP_BYTES):
+            compressed = self.deflate.deflate(data)
+            if compressed is not None:
+                data = compressed
+                rsv1 = True
+        self.queued += 1
+        if not self._corked and not self._writing and not self._outbox and self.open:
+            # claim _txbuf before building in it: a frame posted meanwhile (see post) sees the
+            # write in progress and is queued with a buffer of its own
+            self._writing = True
+            try:
+                size = len(data) + 14
+                if len(self._txbuf) < size:
+                    self._txbuf = bytearray(size)
+                # messages sent by client are masked
+                frame = encode_frame(opcode, data, self.is_client, True, rsv1, self._txbuf)
+                self._write((frame,))
+            finally:
+                self._writing = False
+            # a frame posted while building or writing
+            if self._outbox:
+                self.flush()
+            return
+        self._outbox.append(encode_frame(opcode, data, self.is_client, True, rsv1))
+        if not self._corked:
+            self.flush()
 
+    def flush(self):
+        """
+        Write the queued frames, small ones back to back in one write (one TLS record)
+        up to coalesceBytes. Only one caller writes at a time: a frame queued meanwhile by
+        a scheduled callback (see post) is picked up by the writer already running.
+        """
+        if self._writing:
+            return
+        self._writing = True
+        try:
+            while self._outbox and self.open:
+                frames = self._outbox
+                self._outbox = []
+                batch = []
+                size = 0
+                for frame in frames:
+                    if batch and size + len(frame) > self.coalesceBytes:
+                        self._write(batch)
+                        batch = []
+                        size = 0
+                    batch.append(frame)
+                    size += len(frame)
+                self._write(batch)
+        finally:
+            self._writing = False
+        # a frame queued between the last check and the end of the write
+        if self._outbox and self.open:
+            self.flush()
+
+    def _write(self, frames):
+        self.sock.write(frames[0] if len(frames) == 1 else b''.join(frames))
+        self.writes += 1
+
+    def cork(self):
+        """Hold the frames written from now on in the queue, until uncork()"""
+        self._corked += 1
+
+    def uncork(self):
+        self._corked -= 1
+        if not self._corked:
+            self.flush()
+
+    def post(self, buf):
+        """
+        send() for interrupt handlers: the frame is built and written later from the
+        main program via micropython.schedule, after whatever write is in progress.
+        """
+        if _schedule is None:
+            self.send(buf)
         else:
-            raise ValueError()
-
-        if mask:  # Mask is 4 bytes
-            mask_bits = struct.pack('!I', random.getrandbits(32))
-            self.sock.write(mask_bits)
-
-            data = bytes(b ^ mask_bits[i % 4]
-                         for i, b in enumerate(data))
+            _schedule(self._posted, buf)
 
-        self.sock.write(data)
+    def _posted(self, buf):
+        if self.open:
+            self.send(buf)
 
     def recv(self):
         """
@@ -177,45 +453,174 @@ class Websocket:
         fire off a routine to process frames and put the data in a queue.
         If you don't call recv() sufficiently often you won't process control
         frames.
+
+        Fragmented messages (OP_CONT) are reassembled before being returned, up
+        to maxMessageSize bytes. When onChunk is set the payload of every data
+        frame is instead handed to onChunk(opcode, chunk, final) in pieces as it
+        is read, nothing is buffered and recv() returns '' once the last
+        fragment of a message has been delivered.
         """
         assert self.open
         while self.open:
             try:
-                fin, opcode, data = self.read_frame()
+                fin, opcode, length, mask_bits = self.read_header()
+
+                if opcode == OP_TEXT or opcode == OP_BYTES or opcode == OP_CONT:
+                    if opcode == OP_CONT:
+                        # This is a continuation of a previous frame
+                        if self._msgopcode is None:
+                            self._protocol_error()
+                        opcode = self._msgopcode
+                    elif self._msgopcode is not None:
+                        # a new message started before the previous one finished
+                        self._protocol_error()
+                    else:
+                        self._compressed = self.rsv1 and self.deflate is not None
+
+                    # a compressed message is collected whole and inflated before it is handed out
+                    if self.onChunk is not None and not self._compressed:
+                        self._stream_payload(opcode, length, mask_bits, fin)
+                        self._msgopcode = None if fin else opcode
+                        if fin:
+                            return ''
+                        continue
+
+                    if self.maxMessageSize and self._msglen + length > self.maxMessageSize:
+                        if __debug__ and LOGGER: LOGGER.debug("Message over %s bytes. Closing",
+                                                              self.maxMessageSize)
+                        self._reset_message()
+                        self.close(code=CLOSE_TOO_BIG)
+                        return
+
+                    if fin and self._msgopcode is None:
+                        # the common case, a whole message in one frame
+                        data = self.read_payload(length, mask_bits)
+                        if data is None:
+                            self._close()
+                            return
+                        return self._deliver(opcode, data)
+
+                    data = self._read_fragment(length, mask_bits)
+                    if data is None:
+                        self._reset_message()
+                        self._close()
+                        return
+                    self._msgopcode = opcode
+                    if not fin:
+                        continue
+                    self._reset_message()
+                    return self._deliver(opcode, data)
+
+                # control frames may arrive between the fragments of a message,
+                # keep them clear of the part already in the receive buffer
+                data = self.read_payload(length, mask_bits, self._msglen if self._msgbuf is None else 0)
+
             except NoDataException:
                 return ''
             except ValueError:
-                LOGGER.debug("Failed to read frame. Socket dead.")
+                if __debug__ and LOGGER: LOGGER.debug("Failed to read frame. Socket dead.")
                 self._close()
                 raise ConnectionClosed()
 
-            if not fin:
-                raise NotImplementedError()
-
-            if opcode == OP_TEXT:
-                return data.decode('utf-8')
-
-            elif opcode == OP_BYTES:
-                return data
-
-            elif opcode == OP_CLOSE:
+            if opcode == OP_CLOSE or data is None:
                 self._close()
                 return
             elif opcode == OP_PONG:
                 # Ignore this frame, keep waiting for a data frame
+                self.lastPong = ticks_ms()
                 continue
             elif opcode == OP_PING:
                 # We need to send a pong frame
-                if __debug__: LOGGER.debug("Sending PONG")
+                if __debug__ and LOGGER: LOGGER.debug("Sending PONG")
                 self.write_frame(OP_PONG, data)
                 # And then wait to receive
                 continue
-            elif opcode == OP_CONT:
-                # This is a continuation of a previous frame
-                raise NotImplementedError(opcode)
             else:
-                raise ValueError(opcode)
-        
+                self._protocol_error()
+
+    def _deliver(self, opcode, data):
+        # hand a complete message back to the caller of recv()
+        if self._compressed:
+            self._compressed = False
+            data = self._inflate(data)
+            if data is None:
+                return
+            if self.onChunk is not None:
+                self.onChunk(opcode, memoryview(data), True)
+                return ''
+        if self._frame is not None and type(data) is memoryview:
+            return self._frame._set(opcode, data)
+        if opcode == OP_TEXT:
+            return str(data, 'utf-8')
+        return data
+
+    def _inflate(self, data):
+        try:
+            return self.deflate.inflate(data, self.maxMessageSize)
+        except (ValueError, OSError, MemoryError):
+            # corrupt, or bigger than maxMessageSize once inflated
+            if __debug__ and LOGGER: LOGGER.debug("Can't inflate message. Closing")
+            self.close(code=CLOSE_TOO_BIG)
+            return None
+
+    def _read_fragment(self, length, mask_bits):
+        """
+        Append one fragment to the message being reassembled and return the message so far.
+        Fragments are stacked up in the receive buffer while they fit and moved to the heap once they don't.
+        """
+        in_arena = self._msgbuf is None
+        data = self.read_payload(length, mask_bits, self._msglen if in_arena else 0)
+        if data is None:
+            return None
+        if in_arena and type(data) is memoryview:
+            # already in place right behind the previous fragments
+            self._msglen += length
+            return self._rxview[:self._msglen]
+        if in_arena:
+            if self._msglen == 0:
+                self._msgbuf = data
+            else:
+                self._msgbuf = bytearray(self._rxview[:self._msglen])
+                self._msgbuf.extend(data)
+        else:
+            self._msgbuf.extend(data)
+        self._msglen += length
+        return self._msgbuf
+
+    def _reset_message(self):
+        self._msgopcode = None
+        self._msglen = 0
+        self._msgbuf = None
+
+    def _stream_payload(self, opcode, length, mask_bits, fin):
+        # read the payload piece by piece into one scratch buffer and pass each piece on
+        raw = self._rxbuf
+        if raw is None:
+            if self._chunkbuf is None:
+                self._chunkbuf = bytearray(self.chunkSize)
+            raw = self._chunkbuf
+        buf = memoryview(raw)
+        # keep the pieces a multiple of 4 so the mask key stays in step
+        size = len(buf) & ~3
+        if length == 0:
+            self.onChunk(opcode, buf[:0], fin)
+            return
+        remaining = length
+        while remaining > 0:
+            n = size if remaining > size else remaining
+            piece = buf[:n]
+            self._read_into(piece)
+            if mask_bits is not None:
+                # every piece starts at the start of raw
+                mask_payload(raw, mask_bits, n)
+            remaining -= n
+            self.onChunk(opcode, piece, fin and remaining == 0)
+
+    def _protocol_error(self):
+        if __debug__ and LOGGER: LOGGER.debug("Unexpected frame. Closing")
+        self._reset_message()
+        self.close(code=CLOSE_PROTOCOL_ERROR)
+        raise ConnectionClosed()
 
     def send(self, buf):
         """Send data to the websocket."""
@@ -232,6 +637,16 @@ class Websocket:
 
         self.write_frame(opcode, buf)
 
+    def ping(self, data=b''):
+        """Send a ping, the peer answers with a pong (see lastPong)"""
+        assert self.open
+        self.write_frame(OP_PING, data)
+
+    def abort(self):
+        """Drop the connection without the closing handshake, for a peer that stopped answering"""
+        if self.open:
+            self._close()
+
     def close(self, code=CLOSE_OK, reason=''):
         """Close the websocket."""
         if not self.open:
@@ -240,9 +655,12 @@ class Websocket:
         buf = struct.pack('!H', code) + reason.encode('utf-8')
 
         self.write_frame(OP_CLOSE, buf)
+        # even when corked, nothing can follow a close
+        self.flush()
         self._close()
 
     def _close(self):
-        if __debug__: LOGGER.debug("Connection closed")
+        if __debug__ and LOGGER: LOGGER.debug("Connection closed")
         self.open = False
+        self._outbox = []
         self.sock.close()
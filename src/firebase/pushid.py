@@ -0,0 +1,41 @@
+"""
+Push ids for FirebaseRealTime.push
+
+Same layout as the ids generated by the Firebase SDKs: 8 characters of
+timestamp followed by 12 random characters, so keys pushed from the same
+device sort in the order they were created.
+"""
+
+import urandom as random
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+_lastTime = 0
+_lastRandom = []
+
+
+def pushId(nowMs):
+    """A new push id for the time nowMs (milliseconds since 1970, ideally corrected to the server clock)"""
+    global _lastTime, _lastRandom
+    nowMs = int(nowMs)
+    duplicateTime = nowMs == _lastTime
+    _lastTime = nowMs
+
+    timeChars = []
+    for _ in range(8):
+        timeChars.append(PUSH_CHARS[nowMs % 64])
+        nowMs //= 64
+    timeChars.reverse()
+
+    if not duplicateTime or len(_lastRandom) != 12:
+        _lastRandom = [random.getrandbits(6) for _ in range(12)]
+    else:
+        # same millisecond: bump the random part by one so the ids stay ordered
+        i = 11
+        while i >= 0 and _lastRandom[i] == 63:
+            _lastRandom[i] = 0
+            i -= 1
+        if i >= 0:
+            _lastRandom[i] += 1
+
+    return ''.join(timeChars) + ''.join(PUSH_CHARS[n] for n in _lastRandom)
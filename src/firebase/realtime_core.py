@@ -0,0 +1,255 @@
+from src.firebase.jsonstream import FirebaseMessageParser, walkValues
+from src.firebase.mirror import Mirror, splitPath
+from src.firebase.dispatcher import RequestDispatcher
+from src.firebase.pushid import pushId
+from src.firebase.router import PathRouter
+from src.utils.ticks import ticks_us
+from src.utils.metrics import metrics, US_BUCKETS
+import time
+import ujson
+
+_parseUs = metrics.histogram('json.parseUs', US_BUCKETS)
+
+
+class RealtimeCore():
+
+    """ The realtime database protocol, independent of how the socket is driven
+    FirebaseRealTime (blocking listen loop) and AsyncFirebaseRealTime (asyncio) both build on it,
+    they provide _sendText(text) to put a text frame on the wire and feed the incoming messages
+    to _handleText(text) or, when streaming, to the parser.
+    dbConnectionsDetails, onDataReceived, onDataEvent and acceptPath are described in FirebaseRealTime
+    """
+
+    def __init__(self, dbConnectionsDetails, onDataReceived, onDataEvent=None, acceptPath=None):
+        self.onDataReceived = onDataReceived
+        self.onDataEvent = onDataEvent
+        self.parser = None
+        self.mirror = None
+        self.subscriptions = []
+        # handlers of the subscribed paths
+        self.router = PathRouter()
+        # path -> codec.Schema of the values at and right below it
+        self.schemas = {}
+        # the last token the socket was authenticated with, replayed on reconnect
+        self.idToken = None
+        self.requests = RequestDispatcher(dbConnectionsDetails.get('requestTimeoutMs', 10000))
+        # server clock minus local clock in ms, learned from the connection handshake
+        self.serverTimeOffset = 0
+        if dbConnectionsDetails.get('mirrorMaxBytes') is not None:
+            self.mirror = Mirror(dbConnectionsDetails['mirrorMaxBytes'])
+            # the mirror stores whole values, so have the parser build them instead of streaming events
+            self.parser = FirebaseMessageParser(None, self._onMessage, acceptPath, materialize=True)
+        elif onDataEvent is not None:
+            self.parser = FirebaseMessageParser(onDataEvent, self._onMessage, acceptPath)
+
+    def _sendText(self, text):
+        """Put a text message on the socket. The hook every client overrides:
+        FirebaseRealTime sends it right away, AsyncFirebaseRealTime queues it for its writer task"""
+        raise NotImplementedError('%s must send the messages itself' % type(self).__name__)
+
+    def sendRequest(self, action, body, callback=None, timeoutMs=None):
+        """Send a request to the database, callback(status, data) is called with the reply. Returns the request id"""
+        if action == "auth":
+            # replayed on reconnect, however the authentication was sent
+            self.idToken = body.get("cred")
+        requestId, message = self.requests.request(action, body, callback, timeoutMs)
+        self._sendText(message)
+        return requestId
+
+    def authenticateWithSocket(self,tokenID,callback=None):
+        #print("refresh token in socket")
+        self.idToken = tokenID
+        return self.sendRequest("auth", {"cred": tokenID}, callback)
+
+    def subscribeToRealTime(self,path,handler=None,callback=None):
+        """Listen to path, handler(path, value) (optional) is called with the changes at and below it"""
+
+        #print("subscribeString")
+        if not handler == None :
+            self.router.add(path, handler)
+            self._materializeForRouter()
+        if not path in self.subscriptions:
+            self.subscriptions.append(path)
+        dataHash = ''
+        if not self.mirror == None :
+            self.mirror.track(path)
+            dataHash = self.mirror.hash(path)
+        return self.sendRequest("q", {"p": path, "h": dataHash}, callback)
+
+    def unsubscribe(self, path, handler=None, callback=None):
+        """Remove handler (all of them when None) from path, stop listening to path once it has none left"""
+        empty = self.router.remove(path, handler)
+        self._materializeForRouter()
+        if not empty or not path in self.subscriptions:
+            return None
+        self.subscriptions.remove(path)
+        if not self.mirror == None :
+            self.mirror.untrack(path)
+        return self.sendRequest("n", {"p": path}, callback)
+
+    def declareSchema(self, path, schema):
+        """Pack the values written at path or right below it with schema (a codec.Schema), the handlers get them unpacked"""
+        self.schemas['/'.join(splitPath(path))] = schema
+        self.router.decode = self._decode
+
+    def set(self, path, value, callback=None):
+        """Replace the value at path"""
+        if self.schemas :
+            value = self._encode(path, value)
+        return self.sendRequest("p", {"p": path, "d": value}, callback)
+
+    def update(self, path, values, callback=None):
+        """Replace the given children of path (keys may be relative paths), leave the others alone"""
+        if self.schemas :
+            prefix = path.rstrip('/') + '/'
+            values = {key: self._encode(prefix + key, values[key]) for key in values}
+        return self.sendRequest("m", {"p": path, "d": values}, callback)
+
+    def push(self, path, value, callback=None):
+        """Store value under a new, time ordered, key below path and return that key"""
+        key = pushId(self.serverTimeMs())
+        self.set(path.rstrip('/') + '/' + key, value, callback)
+        return key
+
+    def remove(self, path, callback=None):
+        """Delete the value at path"""
+        return self.sendRequest("p", {"p": path, "d": None}, callback)
+
+    def serverTimeMs(self):
+        """Best guess of the server clock, in milliseconds since 1970"""
+        return int(time.time() * 1000) + self.serverTimeOffset
+
+    def _onHandshake(self, data):
+        # the first message of a connection carries the server time
+        if isinstance(data, dict) and 'ts' in data:
+            self.serverTimeOffset = data['ts'] - int(time.time() * 1000)
+
+    def resubscribe(self):
+        """Listen again to every subscribed path, e.g. after the socket has been reconnected"""
+        for path in self.subscriptions:
+            self.subscribeToRealTime(path)
+
+    def _replay(self):
+        # on a fresh socket: forget the requests of the old one, authenticate again and resubscribe
+        self.requests.failAll()
+        if not self.parser == None :
+            self.parser.reset()
+        if not self.idToken == None :
+            self.authenticateWithSocket(self.idToken)
+        self.resubscribe()
+
+    def get(self, path):
+        """Current value at path from the local mirror, None if it is not known"""
+        return self.mirror.get(path)
+
+    def watch(self, path, callback):
+        """Call callback(path, value) whenever the mirrored value at path changes"""
+        self.mirror.watch(path, callback)
+
+    def unwatch(self, path, callback):
+        self.mirror.unwatch(path, callback)
+
+    def _onMessage(self, message):
+        # a complete message has been parsed
+        if not message.requestId == None :
+            self.requests.resolve(message.requestId, message.status, message.data)
+        elif message.t == 'c' and message.action == 'h':
+            self._onHandshake(message.data)
+        elif message.t == 'd' and (message.action == 'd' or message.action == 'm'):
+            if not self.mirror == None :
+                self.mirror.apply(message.action, message.path, message.data)
+            elif not self.parser.materialize :
+                # the values have been streamed out as events already
+                return
+            if self.router.size :
+                self.router.routeMessage(message.action, message.path, message.data)
+            if not self.onDataEvent == None :
+                walkValues(message.data, message.path, self.onDataEvent, self.parser.accept)
+
+    def _materializeForRouter(self):
+        # handlers get whole values in every mode, so with onDataEvent the pushes are only
+        # streamed out value by value while no path has a handler
+        if not self.parser == None and self.mirror == None :
+            self.parser.materialize = self.router.size > 0
+
+    def _schemaOf(self, path):
+        # the schema declared at path or at its parent
+        keys = splitPath(path)
+        schema = self.schemas.get('/'.join(keys))
+        if schema is None and keys:
+            schema = self.schemas.get('/'.join(keys[:-1]))
+        return schema
+
+    def _encode(self, path, value):
+        schema = self._schemaOf(path)
+        if schema is None:
+            return value
+        if schema.isRecord(value) or (isinstance(value, dict) and len(value) == len(schema.fields)
+                                      and all(name in value for name in schema.fields)):
+            return schema.encode(value)
+        return value
+
+    def _decode(self, path, value):
+        # a packed value becomes the schema's reused record, a snapshot of packed values a dict of new records
+        schema = self._schemaOf(path)
+        if schema is None:
+            return value
+        try:
+            if isinstance(value, str):
+                return schema.decode(value, schema.record)
+            if isinstance(value, dict):
+                return {key: schema.decode(value[key]) if isinstance(value[key], str) else value[key]
+                        for key in value}
+        except ValueError:
+            # not packed with this schema
+            pass
+        return value
+
+    def _feedParser(self, chunk, final):
+        start = ticks_us()
+        try:
+            self.parser.feed(chunk)
+            if final:
+                self.parser.end()
+            _parseUs.since(start, ticks_us())
+        except ValueError:
+            # not a JSON message, drop it rather than the connection
+            self.parser.reset()
+
+    def _handleText(self, incomingMessage):
+        # a whole message: parse it, or route replies and hand it to the application
+        if not self.parser == None :
+            if incomingMessage :
+                self._feedParser(str(incomingMessage), True)
+                # the parser has the events and the mirror, the application still gets the message
+                if not self.onDataReceived == None :
+                    self.onDataReceived(incomingMessage)
+            return
+        if not incomingMessage :
+            # nothing arrived (read timeout), nothing to hand out
+            return
+        text = str(incomingMessage)
+        if self.requests.pending :
+            self.requests.routeText(text)
+        if text.startswith('{"t":"c"') :
+            try:
+                self._onHandshake(ujson.loads(text)['d']['d'])
+            except (ValueError, KeyError, TypeError):
+                pass
+        elif self.router.size and text.startswith('{"t":"d"') :
+            self._routeText(text)
+        if not self.onDataReceived == None :
+            self.onDataReceived(incomingMessage)
+
+    def _routeText(self, text):
+        # hand a data push to the handlers of the subscribed paths
+        try:
+            start = ticks_us()
+            message = ujson.loads(text)['d']
+            _parseUs.since(start, ticks_us())
+            action = message.get('a')
+            body = message['b']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        if (action == 'd' or action == 'm') and isinstance(body, dict) and 'p' in body :
+            self.router.routeMessage(action, body['p'], body.get('d'))
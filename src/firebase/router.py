@@ -0,0 +1,123 @@
+"""
+Routes database changes to the handlers of the subscribed paths
+"""
+
+from src.firebase.mirror import splitPath
+
+
+class _Node:
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+
+def _child(value, key):
+    # the part of value below key, None when there is none
+    if isinstance(value, dict):
+        return value.get(key)
+    if isinstance(value, list) and key.isdigit() and int(key) < len(value):
+        return value[int(key)]
+    return None
+
+
+class PathRouter:
+    """
+    A prefix trie of database paths, one node per key, holding the handlers
+    registered with add(path, handler).
+
+    route(path, value) hands a change (value replacing whatever was at path,
+    None for a delete) to the handlers of the deepest registered path at or
+    above path, as handler(path, value), and to the handlers registered below
+    path with their part of the value, as handler(theirPath, theirValue).
+    Finding them walks the keys of path once, so the cost depends on the
+    depth of the path and not on the number of subscriptions.
+    routeMessage(action, path, data) does the same for a whole 'd' (set) or
+    'm' (merge) push of the server.
+
+    Handlers always get whole values, the subtree the change put at the path
+    they are called with, never one leaf at a time: the realtime client
+    routes complete pushes whether it runs plain, with the mirror or with
+    onDataEvent (its parser builds the pushes whole while a handler is
+    registered).
+
+    decode(path, value), when set, turns the value handed to the handlers of
+    path into what they expect (see RealtimeCore.declareSchema).
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+        self.decode = None
+
+    def add(self, path, handler):
+        node = self.root
+        for key in splitPath(path):
+            child = node.children.get(key)
+            if child is None:
+                child = node.children[key] = _Node()
+            node = child
+        node.handlers.append(handler)
+        self.size += 1
+
+    def remove(self, path, handler=None):
+        """Remove handler (all of them when None) from path, returns True when path has no handler left"""
+        keys = splitPath(path)
+        nodes = [self.root]
+        for key in keys:
+            child = nodes[-1].children.get(key)
+            if child is None:
+                return True
+            nodes.append(child)
+        node = nodes[-1]
+        if handler is None:
+            self.size -= len(node.handlers)
+            node.handlers = []
+        elif handler in node.handlers:
+            node.handlers.remove(handler)
+            self.size -= 1
+        # drop the branch when nothing hangs off it anymore
+        for i in range(len(keys), 0, -1):
+            if nodes[i].handlers or nodes[i].children:
+                break
+            del nodes[i - 1].children[keys[i - 1]]
+        return not node.handlers
+
+    def route(self, path, value):
+        keys = splitPath(path)
+        node = self.root
+        best = node if node.handlers else None
+        for key in keys:
+            node = node.children.get(key)
+            if node is None:
+                break
+            if node.handlers:
+                best = node
+        if best is not None:
+            delivered = value if self.decode is None else self.decode(path, value)
+            for handler in best.handlers:
+                handler(path, delivered)
+        if node is not None and node.children:
+            self._descend(node, '/'.join(keys), value)
+
+    def routeMessage(self, action, path, data):
+        if action == 'm':
+            if isinstance(data, dict):
+                prefix = '/'.join(splitPath(path))
+                for key in data:
+                    self.route(prefix + '/' + key if prefix else key, data[key])
+        else:
+            self.route(path, data)
+
+    def _descend(self, node, path, value):
+        for key in node.children:
+            child = node.children[key]
+            childPath = path + '/' + key if path else key
+            childValue = _child(value, key)
+            if child.handlers:
+                delivered = childValue if self.decode is None else self.decode(childPath, childValue)
+                for handler in child.handlers:
+                    handler(childPath, delivered)
+            if child.children:
+                self._descend(child, childPath, childValue)
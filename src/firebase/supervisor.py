@@ -0,0 +1,159 @@
+"""
+Keeps the realtime database connection up
+"""
+
+import time
+import urandom as random
+
+from src.firebase.protocol import ConnectionClosed
+from src.utils.ticks import ticks_ms, ticks_diff
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter: every next() doubles (factor) the delay up
+    to maxMs and returns a random value between half of it and all of it, so
+    boards that lost the same router don't all come back at the same moment.
+    """
+
+    def __init__(self, baseMs=500, maxMs=60000, factor=2):
+        self.baseMs = baseMs
+        self.maxMs = maxMs
+        self.factor = factor
+        self.attempts = 0
+        self._delay = baseMs
+
+    def next(self):
+        """Milliseconds to wait before the next attempt"""
+        delay = self._delay
+        self._delay = min(self._delay * self.factor, self.maxMs)
+        self.attempts += 1
+        half = delay // 2
+        return half + ((delay - half) * random.getrandbits(16) >> 16)
+
+    def reset(self):
+        self.attempts = 0
+        self._delay = self.baseMs
+
+
+class ConnectionSupervisor:
+    """
+    Watches a FirebaseRealTime (or AsyncFirebaseRealTime) connection and brings
+    it back when it dies.
+
+    The connection counts as dead when reading fails, when the server closes
+    it, or when the client's keep alive gives up on it (a ping left unanswered,
+    see keepalive.KeepAlive). It is then reconnected, waiting backoff.next() ms
+    between the attempts, and the authentication and every subscription are
+    replayed in order on the new socket. The backoff only starts over once a
+    connection stayed up minUptimeMs: when a server accepts and drops right
+    away the next attempt waits the backoff too instead of looping at once.
+
+    With the blocking client call listen() in place of firebaseRealtime.listen()
+    in the main loop. With the asyncio client run the run() coroutine as a task.
+
+    link is optional, something with an isUp() (e.g. a wifi LinkMonitor): while
+    it says the network is down no reconnection is attempted, the blocking
+    listen() returns right away instead of sleeping in the backoff.
+
+    onDisconnected() and onReconnected(downtimeMs) are optional callbacks.
+    reconnects, disconnects, downtimeMs (total) and lastDowntimeMs keep count.
+    """
+
+    def __init__(self, firebaseRealtime, backoff=None, onDisconnected=None, onReconnected=None, link=None,
+                 minUptimeMs=10000):
+        self.rt = firebaseRealtime
+        self.link = link
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.minUptimeMs = minUptimeMs
+        self.onDisconnected = onDisconnected
+        self.onReconnected = onReconnected
+        self.reconnects = 0
+        self.disconnects = 0
+        self.downtimeMs = 0
+        self.lastDowntimeMs = 0
+        self._downAt = None
+        # ticks_ms of the last reconnection, and whether the connection it made died too soon
+        self._upAt = None
+        self._shortLived = False
+
+    def listen(self):
+        """One round of the main loop: listen to the socket, reconnect when the connection is gone"""
+        if self.rt.isConnected():
+            try:
+                self.rt.listen()
+            except (ConnectionClosed, OSError):
+                pass
+            if self.rt.isConnected():
+                return
+        self._recover()
+
+    def _lost(self):
+        if self._downAt is not None:
+            # still down since the last round
+            return
+        self.disconnects += 1
+        self._downAt = ticks_ms()
+        if self._upAt is not None:
+            self._shortLived = ticks_diff(self._downAt, self._upAt) < self.minUptimeMs
+            if not self._shortLived:
+                self.backoff.reset()
+            self._upAt = None
+        if not self.onDisconnected == None :
+            self.onDisconnected()
+
+    def _restored(self):
+        self.lastDowntimeMs = ticks_diff(ticks_ms(), self._downAt)
+        self._downAt = None
+        self.downtimeMs += self.lastDowntimeMs
+        self.reconnects += 1
+        self._upAt = ticks_ms()
+        if not self.onReconnected == None :
+            self.onReconnected(self.lastDowntimeMs)
+
+    def _recover(self):
+        self._lost()
+        while True:
+            if self._linkDown():
+                # the link monitor brings the network back first, don't spin the main loop meanwhile
+                time.sleep(0.1)
+                return
+            if self._shortLived:
+                self._shortLived = False
+                time.sleep(self.backoff.next() / 1000)
+            try:
+                self.rt.reconnect()
+                break
+            except (ConnectionClosed, OSError, AssertionError):
+                # no network yet or the handshake failed
+                time.sleep(self.backoff.next() / 1000)
+        self._restored()
+
+    def _linkDown(self):
+        return not self.link == None and not self.link.isUp()
+
+    async def run(self):
+        """Supervise an AsyncFirebaseRealTime, run it as a task next to the client"""
+        while True:
+            await self.rt.closed()
+            if self.rt.closing:
+                return
+            self._lost()
+            while True:
+                if self._linkDown():
+                    await asyncio.sleep(0.5)
+                    continue
+                if self._shortLived:
+                    self._shortLived = False
+                    await asyncio.sleep(self.backoff.next() / 1000)
+                try:
+                    await self.rt.reconnect()
+                    break
+                except (ConnectionClosed, OSError, AssertionError):
+                    await asyncio.sleep(self.backoff.next() / 1000)
+            self._restored()
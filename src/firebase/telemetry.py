@@ -0,0 +1,124 @@
+"""
+Write-behind buffer for high rate sensor data
+"""
+
+from ucollections import OrderedDict
+
+from src.utils.ticks import ticks_ms, ticks_diff
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+class TelemetryWriter:
+    """
+    Coalesces writes on top of FirebaseRealTime.update.
+
+    write(path, value) only records the latest value for path (relative to
+    basePath), nothing is sent until a flush. A flush sends every pending value
+    as one update and happens when maxBatch paths are pending, when the oldest
+    pending value is flushIntervalMs old (checked by poll(), call it from the
+    main loop) or when flush() is called.
+
+    At most maxInFlight updates wait for their acknowledgement at any time, on
+    a slow link new values keep coalescing in the buffer instead. The buffer
+    holds up to maxPending paths, past that either the oldest pending value or
+    the new one is dropped (policy DROP_OLDEST or DROP_NEWEST) and counted in
+    dropped. Values of an update the server rejected are put back unless a
+    newer value has been written since, whether that one is still pending or
+    in another update on its way (every write gets a sequence number).
+    """
+
+    def __init__(self, firebaseRealtime, basePath='', maxBatch=32, flushIntervalMs=1000,
+                 maxPending=128, policy=DROP_OLDEST, maxInFlight=2):
+        self.rt = firebaseRealtime
+        self.basePath = basePath
+        self.maxBatch = maxBatch
+        self.flushIntervalMs = flushIntervalMs
+        self.maxPending = maxPending
+        self.policy = policy
+        self.maxInFlight = maxInFlight
+        self.pending = OrderedDict()
+        self.inFlight = 0
+        self.dropped = 0
+        self.written = 0
+        self.sent = 0
+        self._firstPendingAt = None
+        # path -> sequence number of its latest write, while that one is pending or in flight
+        self._latest = {}
+        self._seq = 0
+
+    def write(self, path, value):
+        """Record the latest value for path, returns False if it was dropped"""
+        self.written += 1
+        if path not in self.pending and len(self.pending) >= self.maxPending:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            oldest = next(iter(self.pending))
+            del self.pending[oldest]
+            self._latest.pop(oldest, None)
+        if not self.pending:
+            self._firstPendingAt = ticks_ms()
+        self._seq += 1
+        self._latest[path] = self._seq
+        self.pending[path] = value
+        if len(self.pending) >= self.maxBatch:
+            self.flush()
+        return True
+
+    def poll(self):
+        """Flush when the oldest pending value has waited flushIntervalMs"""
+        if self.pending and ticks_diff(ticks_ms(), self._firstPendingAt) >= self.flushIntervalMs:
+            self.flush()
+
+    def flush(self):
+        """Send the pending values as one update, returns False when the link is still busy"""
+        if not self.pending:
+            return True
+        if self.inFlight >= self.maxInFlight:
+            return False
+        batch = self.pending
+        seqs = {path: self._latest[path] for path in batch}
+        self.pending = OrderedDict()
+        self._firstPendingAt = None
+        self.inFlight += 1
+        self.sent += 1
+
+        def onAck(status, data):
+            self.inFlight -= 1
+            if status != 'ok':
+                self._requeue(batch, seqs)
+            else:
+                self._forget(seqs)
+
+        try:
+            self.rt.update(self.basePath, batch, onAck)
+        except Exception:
+            self.inFlight -= 1
+            self._requeue(batch, seqs)
+            raise
+        return True
+
+    def _forget(self, seqs):
+        # the values delivered that nothing has been written over since
+        for path in seqs:
+            if self._latest.get(path) == seqs[path]:
+                del self._latest[path]
+
+    def _requeue(self, batch, seqs):
+        # put back what was not overwritten since, oldest first
+        merged = OrderedDict()
+        for path in batch:
+            if self._latest.get(path) == seqs[path]:
+                merged[path] = batch[path]
+        for path in self.pending:
+            merged[path] = self.pending[path]
+        while len(merged) > self.maxPending:
+            oldest = next(iter(merged))
+            del merged[oldest]
+            self._latest.pop(oldest, None)
+            self.dropped += 1
+        self.pending = merged
+        if self.pending and self._firstPendingAt is None:
+            self._firstPendingAt = ticks_ms()
@@ -0,0 +1,155 @@
+"""
+Keeps the Firebase ID token fresh
+"""
+
+from src.firebase.supervisor import Backoff
+from src.utils.ticks import ticks_ms, ticks_diff, ticks_add
+from src.utils.metrics import metrics
+
+_refreshMs = metrics.histogram('auth.refreshMs')
+_refreshFailures = metrics.counter('auth.refreshFailures')
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+class TokenManager:
+    """
+    Refreshes the ID token of an Auth shortly before it expires and hands the
+    new one to every registered FirebaseRealTime / AsyncFirebaseRealTime.
+
+    Exactly one refresh is scheduled, refreshMarginMs before the token runs
+    out. Nothing runs in an interrupt: call poll() from the main loop (between
+    two listen() calls, so the new token is sent by the same code that reads
+    the socket) or run the run() coroutine as a task with the asyncio client.
+    A failed refresh is retried after backoff.next() ms, when the refresh
+    token itself is rejected and signIn() was used the user is signed in
+    again. onToken(idToken), when given, is called with every new token.
+
+    With a store (token_store.TokenStore) every new token is saved and
+    signIn() starts from the saved refresh token: one refresh call gets a new
+    ID token, and only when that fails does it fall back to the
+    email/password sign in. The saved ID token is never reused as is, the
+    board's clock restarts at every boot so its age can't be told. bootPath
+    tells which of 'refreshed' or 'password' the last signIn() took.
+
+        tokens = TokenManager(authenticator)
+        flg, headers = tokens.signIn(firebaseUserName, firebaseUserPassword)
+        tokens.register(firebaseRealtime)
+        while True:
+            supervisor.listen()
+            tokens.poll()
+    """
+
+    def __init__(self, auth, refreshMarginMs=300000, backoff=None, onToken=None, store=None):
+        self.auth = auth
+        self.store = store
+        self.bootPath = None
+        self.refreshMarginMs = refreshMarginMs
+        self.backoff = backoff if backoff is not None else Backoff(2000, 60000)
+        self.onToken = onToken
+        self.clients = []
+        self.refreshes = 0
+        self.failures = 0
+        self._credentials = None
+        # ticks_ms of the next refresh, None when there is no token yet
+        self._dueAt = None
+
+    def signIn(self, email, password):
+        """Sign in (from the stored tokens when possible) and schedule the refresh, returns (flg, headers)"""
+        self._credentials = (email, password)
+        if self.store is not None and self._resume(email):
+            self._tokenChanged()
+            return True, {"idToken": self.auth.idToken, "refreshToken": self.auth.refreshToken,
+                          "expiresIn": str(self.auth.expiresIn), "email": email,
+                          "localId": self.auth.localID}
+        flg, data = self.auth.validate_user(email, password)
+        if flg:
+            self.bootPath = 'password'
+            self._tokenChanged()
+        else:
+            self._credentials = None
+        return flg, data
+
+    def _resume(self, email):
+        saved = self.store.load()
+        if saved is None or saved.get('email') != email:
+            return False
+        auth = self.auth
+        auth.refreshToken = saved['refreshToken']
+        auth.localID = saved.get('localId')
+        # the RTC restarts at every boot, so the saved expiry can't be checked: always refresh
+        flg, _, _ = auth.updateRefreshToken(force=True)
+        if flg:
+            self.bootPath = 'refreshed'
+        return flg
+
+    def register(self, firebaseRealtime):
+        """Have firebaseRealtime re-authenticated with every new token"""
+        if firebaseRealtime not in self.clients:
+            self.clients.append(firebaseRealtime)
+
+    def unregister(self, firebaseRealtime):
+        if firebaseRealtime in self.clients:
+            self.clients.remove(firebaseRealtime)
+
+    def dueInMs(self):
+        """Milliseconds until the next refresh, None when nothing is scheduled"""
+        if self._dueAt is None:
+            return None
+        return max(0, ticks_diff(self._dueAt, ticks_ms()))
+
+    def poll(self):
+        """Refresh when it is time, returns True when the token changed"""
+        if self._dueAt is None or ticks_diff(ticks_ms(), self._dueAt) < 0:
+            return False
+        return self.refresh()
+
+    def refresh(self):
+        """Refresh the token now, returns True on success"""
+        start = ticks_ms()
+        flg, reason, _ = self.auth.updateRefreshToken(force=True)
+        if not flg and self._credentials is not None and isinstance(reason, dict) and 'error' in reason:
+            # the refresh token itself was rejected (revoked, password changed...), sign in again
+            flg, reason = self.auth.validate_user(*self._credentials)
+        _refreshMs.since(start, ticks_ms())
+        if not flg:
+            _refreshFailures.inc()
+            self.failures += 1
+            self._dueAt = ticks_add(ticks_ms(), self.backoff.next())
+            return False
+        self.refreshes += 1
+        self._tokenChanged()
+        return True
+
+    def _tokenChanged(self):
+        self.backoff.reset()
+        self._dueAt = ticks_add(ticks_ms(), max(0, self.auth.expiresIn * 1000 - self.refreshMarginMs))
+        token = self.auth.idToken
+        if self.store is not None and self._credentials is not None:
+            try:
+                self.store.save(self._credentials[0], self.auth)
+            except OSError:
+                # a full or read only file system only costs the next boot a sign in
+                pass
+        for client in self.clients:
+            try:
+                client.authenticateWithSocket(token)
+            except (OSError, AssertionError):
+                # the socket is down, the token is replayed when it reconnects
+                pass
+        if not self.onToken == None :
+            self.onToken(token)
+
+    async def run(self):
+        """
+        Refresh task for the asyncio client, run it with addTask.
+        The refresh itself is the blocking HTTPS call of poll(): it only sleeps in between, and while a
+        refresh is made (a second or more with the TLS handshake, once an hour) the whole event loop waits.
+        """
+        while True:
+            delay = self.dueInMs()
+            await asyncio.sleep((1000 if delay is None else delay) / 1000)
+            self.poll()
@@ -0,0 +1,74 @@
+"""
+Keeps the auth tokens in flash across reboots
+"""
+
+import ujson
+import uos as os
+import time
+
+
+class TokenStore:
+    """
+    Saves the refresh token, the ID token and its expiry to a file under sec/
+    so a reboot can skip the email/password sign in.
+
+    save() writes the new content to path + '.tmp' and renames it over path,
+    a power cut in the middle leaves either the old or the new tokens. The
+    file is only written when its content actually changes, an idle board
+    doesn't wear the flash. load() returns the saved dict (email, idToken,
+    refreshToken, localId, expiresAt, savedAt) or None.
+    """
+
+    def __init__(self, path='sec/token.json'):
+        self.path = path
+        self.writes = 0
+        self._saved = None
+
+    def load(self):
+        for path in (self.path, self.path + '.tmp'):
+            # the .tmp file is complete when a save was cut short right before the rename
+            try:
+                with open(path) as f:
+                    data = ujson.loads(f.read())
+            except (OSError, ValueError):
+                continue
+            if isinstance(data, dict) and data.get('refreshToken'):
+                self._saved = data
+                return data
+        return None
+
+    def save(self, email, auth):
+        """Store the tokens of auth (an Auth that has signed in as email)"""
+        data = {
+            'email': email,
+            'idToken': auth.idToken,
+            'refreshToken': auth.refreshToken,
+            'localId': getattr(auth, 'localID', None),
+            'expiresAt': auth.expiresAt,
+        }
+        if self._saved is not None and all(self._saved.get(k) == data[k] for k in data):
+            return False
+        data['savedAt'] = int(time.time())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(ujson.dumps(data))
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            # file systems that don't rename over an existing file
+            self._remove(self.path)
+            os.rename(tmp, self.path)
+        self._saved = data
+        self.writes += 1
+        return True
+
+    def clear(self):
+        self._remove(self.path)
+        self._remove(self.path + '.tmp')
+        self._saved = None
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,47 @@
+"""
+Viper routines of masking, only importable on MicroPython
+
+They live in a module of their own because viper code is refused when the
+module is compiled, not when it runs, on a port built without the native
+emitters: masking imports this module and falls back to its pure python
+path when the import fails.
+"""
+
+import micropython
+
+
+@micropython.viper
+def mask_words(buf, offset: int, length: int, mask_bits):
+    # bytearray storage comes straight from the gc heap, so it is
+    # word aligned: the bytes up to the first word boundary after
+    # offset go one by one, then the payload is walked as 32 bit words
+    m = ptr8(mask_bits)
+    b = ptr8(buf)
+    i = 0
+    while i < length and ((offset + i) & 3):
+        b[offset + i] = b[offset + i] ^ m[i & 3]
+        i += 1
+    # the key turned to start where the first word does
+    key = m[i & 3] | (m[(i + 1) & 3] << 8) | (m[(i + 2) & 3] << 16) | (m[(i + 3) & 3] << 24)
+    words = ptr32(buf)
+    w = (offset + i) >> 2
+    end = (offset + length) >> 2
+    while w < end:
+        words[w] = words[w] ^ key
+        w += 1
+    if (end << 2) - offset > i:
+        i = (end << 2) - offset
+    while i < length:
+        b[offset + i] = b[offset + i] ^ m[i & 3]
+        i += 1
+
+
+@micropython.viper
+def mask_bytes(buf, offset: int, length: int, mask_bits):
+    # memoryview slices may start anywhere, so go byte by byte
+    m = ptr8(mask_bits)
+    b = ptr8(buf)
+    i = 0
+    while i < length:
+        b[offset + i] = b[offset + i] ^ m[i & 3]
+        i += 1
@@ -0,0 +1,34 @@
+"""
+Desktop python support
+
+The project is written against the MicroPython module names (ujson, ustruct,
+...) and the const() builtin. Importing this module first makes the parts that
+do not touch the hardware (protocol, parser, mirror, the asyncio client)
+importable on CPython, so they can be run and tested on Linux. On MicroPython
+it does nothing.
+"""
+
+import sys
+
+if sys.implementation.name != 'micropython':
+    import builtins
+    import binascii
+    import collections
+    import hashlib
+    import io
+    import json
+    import os
+    import random
+    import re
+    import socket
+    import ssl
+    import struct
+    import time
+
+    for _name, _module in (('ubinascii', binascii), ('ucollections', collections), ('uhashlib', hashlib), ('uio', io),
+                           ('ujson', json), ('uos', os), ('urandom', random), ('ure', re), ('usocket', socket),
+                           ('ussl', ssl), ('ustruct', struct), ('utime', time)):
+        sys.modules.setdefault(_name, _module)
+
+    if not hasattr(builtins, 'const'):
+        builtins.const = lambda value: value
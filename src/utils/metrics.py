@@ -0,0 +1,159 @@
+"""
+Counters, gauges and latency histograms cheap enough to leave on
+"""
+
+import ujson
+
+from src.utils.ticks import ticks_ms, ticks_diff
+
+try:
+    import gc
+except ImportError:
+    gc = None
+
+# upper bounds of the latency buckets, the last bucket takes everything above
+MS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+US_BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Fixed buckets: counts[i] is the number of values <= buckets[i] (and above
+    the bucket before), the last count the values above all of them.
+    """
+
+    def __init__(self, buckets=MS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def since(self, start, now):
+        """Observe the ticks between start and now, returns them"""
+        elapsed = ticks_diff(now, start)
+        self.observe(elapsed)
+        return elapsed
+
+    def snapshot(self):
+        # [count, sum, max, bucket counts]
+        return [self.count, self.total, self.max, self.counts]
+
+
+class Metrics:
+    """
+    A registry of named metrics: counter(name), gauge(name) and
+    histogram(name, buckets) create the metric on first use and return the
+    same object afterwards. Hot code looks its metrics up once (at import or
+    in __init__) and only calls inc()/set()/observe() on them, which is an
+    attribute update and, for a histogram, a walk over a dozen bounds.
+
+    sample() updates the heap gauges (heap.free, heap.alloc) and counts
+    gc.collections, the collections seen since the last sample: the heap in
+    use shrinking between two samples, so several collections in between
+    count as one. json() is a snapshot as one compact line,
+    {"t":uptime ms,"c":{counters},"g":{gauges},"h":{name:[count,sum,max,[buckets]]}},
+    and push(firebaseRealtime, path) writes that snapshot to the database.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._startedAt = ticks_ms()
+        self._lastAlloc = None
+        self._heapFree = self.gauge('heap.free')
+        self._heapAlloc = self.gauge('heap.alloc')
+        self._collections = self.counter('gc.collections')
+
+    def _get(self, name, cls, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(*args)
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def histogram(self, name, buckets=MS_BUCKETS):
+        return self._get(name, Histogram, buckets)
+
+    def sample(self):
+        if gc is None or not hasattr(gc, 'mem_free'):
+            return
+        alloc = gc.mem_alloc()
+        if self._lastAlloc is not None and alloc < self._lastAlloc:
+            self._collections.inc()
+        self._lastAlloc = alloc
+        self._heapAlloc.set(alloc)
+        self._heapFree.set(gc.mem_free())
+
+    def snapshot(self):
+        self.sample()
+        counters = {}
+        gauges = {}
+        histograms = {}
+        for name in self.metrics:
+            metric = self.metrics[name]
+            if isinstance(metric, Counter):
+                counters[name] = metric.snapshot()
+            elif isinstance(metric, Gauge):
+                gauges[name] = metric.snapshot()
+            else:
+                histograms[name] = metric.snapshot()
+        return {'t': ticks_diff(ticks_ms(), self._startedAt), 'c': counters, 'g': gauges, 'h': histograms}
+
+    def json(self):
+        snapshot = self.snapshot()
+        try:
+            return ujson.dumps(snapshot, separators=(',', ':'))
+        except TypeError:
+            # firmware older than 1.20 has no separators
+            return ujson.dumps(snapshot)
+
+    def push(self, firebaseRealtime, path, callback=None):
+        """Write the snapshot to path, the database keys can't hold dots so they become _"""
+        snapshot = self.snapshot()
+        for kind in ('c', 'g', 'h'):
+            values = snapshot[kind]
+            snapshot[kind] = {name.replace('.', '_'): values[name] for name in values}
+        return firebaseRealtime.set(path, snapshot, callback)
+
+
+# the registry the library reports to
+metrics = Metrics()
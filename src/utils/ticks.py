@@ -0,0 +1,25 @@
+"""
+Millisecond ticks that work on MicroPython and on a desktop python
+"""
+
+import time
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+    ticks_add = time.ticks_add
+except AttributeError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+    def ticks_add(ticks, delta):
+        return ticks + delta
+
+try:
+    ticks_us = time.ticks_us
+except AttributeError:
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
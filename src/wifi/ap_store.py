@@ -0,0 +1,66 @@
+"""
+Remembers the last access point the board connected to
+"""
+
+import ujson
+import uos as os
+
+
+class APStore:
+    """
+    Saves the SSID, BSSID and channel of the last successful connection to a
+    file under sec/ so the next boot or reconnect can go straight to that
+    access point without scanning.
+
+    Like the TokenStore the file is written to path + '.tmp' and renamed over
+    path, and only when the access point changed. load() returns the saved
+    dict (ssid, bssid as bytes, channel) or None.
+    """
+
+    def __init__(self, path='sec/wifi_ap.json'):
+        self.path = path
+        self.writes = 0
+        self._saved = None
+
+    def load(self):
+        for path in (self.path, self.path + '.tmp'):
+            try:
+                with open(path) as f:
+                    data = ujson.loads(f.read())
+                bssid = bytes(int(b, 16) for b in data['bssid'].split(':'))
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                continue
+            self._saved = data
+            return {'ssid': data['ssid'], 'bssid': bssid, 'channel': data.get('channel')}
+        return None
+
+    def save(self, ssid, bssid, channel):
+        data = {
+            'ssid': ssid,
+            'bssid': ':'.join('{:02x}'.format(b) for b in bssid),
+            'channel': channel,
+        }
+        if self._saved == data:
+            return False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(ujson.dumps(data))
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            self._remove(self.path)
+            os.rename(tmp, self.path)
+        self._saved = data
+        self.writes += 1
+        return True
+
+    def clear(self):
+        self._remove(self.path)
+        self._remove(self.path + '.tmp')
+        self._saved = None
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
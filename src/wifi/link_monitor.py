@@ -0,0 +1,157 @@
+"""
+Watches the wifi link, brings it back and roams to a stronger access point
+"""
+
+from src.utils.ticks import ticks_ms, ticks_diff
+from src.utils.metrics import metrics
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+_rssi = metrics.gauge('wifi.rssi')
+_roams = metrics.counter('wifi.roams')
+_losses = metrics.counter('wifi.losses')
+
+
+class LinkMonitor:
+    """
+    Samples the link of a WIFI_MANAGER every sampleMs: is it still connected
+    and how strong is the signal (rssi is smoothed over the samples, a sample
+    is one status call, nothing goes on air).
+
+    When the link is gone it reconnects through the WIFI_MANAGER state
+    machine, trying again every retryMs until it succeeds. When rssi drops
+    below roamRssi it scans (at most every roamScanMs) for a known access
+    point at least roamMarginDb stronger and moves over to it.
+
+    client is the realtime connection riding on the link (a FirebaseRealTime
+    or AsyncFirebaseRealTime): it is dropped as soon as the link is lost or a
+    roam starts, so its ConnectionSupervisor reconnects as soon as isUp()
+    again instead of waiting for a read to time out. Pass the monitor as link
+    to the ConnectionSupervisor so it doesn't try while the wifi is down.
+
+    Call poll() from the main loop or run() as an asyncio task. The optional
+    callbacks onLinkLost(), onLinkRestored(outageMs) and onRoamed(ap) tell
+    what happened; samples, roams, losses and lastOutageMs keep count.
+    """
+
+    def __init__(self, wifiManager, client=None, sampleMs=2000, roamRssi=-72, roamMarginDb=8, roamScanMs=60000,
+                 retryMs=5000, onLinkLost=None, onLinkRestored=None, onRoamed=None):
+        self.wifi = wifiManager
+        self.client = client
+        self.sampleMs = sampleMs
+        self.roamRssi = roamRssi
+        self.roamMarginDb = roamMarginDb
+        self.roamScanMs = roamScanMs
+        self.retryMs = retryMs
+        self.onLinkLost = onLinkLost
+        self.onLinkRestored = onLinkRestored
+        self.onRoamed = onRoamed
+        self.rssi = None
+        self.samples = 0
+        self.roams = 0
+        self.losses = 0
+        self.lastOutageMs = 0
+        self._sampledAt = ticks_ms()
+        self._scannedAt = None
+        self._connecting = False
+        self._roaming = False
+        self._retryAt = None
+        self._downAt = None
+
+    def isUp(self):
+        return not self._connecting and self._retryAt is None and self.wifi.isWifiConnected()
+
+    def poll(self):
+        """Sample the link when it is time to and move a reconnection on, returns isUp()"""
+        now = ticks_ms()
+        if self._connecting:
+            if self.wifi.step():
+                self._connecting = False
+                if self.wifi.isWifiConnected():
+                    self._restored()
+                else:
+                    self._retryAt = ticks_ms()
+            return self.isUp()
+        if self._retryAt is not None:
+            if ticks_diff(now, self._retryAt) >= self.retryMs:
+                self._retryAt = None
+                self._reconnect()
+            return False
+        if ticks_diff(now, self._sampledAt) < self.sampleMs:
+            return True
+        self._sampledAt = now
+        self.samples += 1
+        if not self.wifi.isWifiConnected():
+            self._lost()
+            self._reconnect()
+            return False
+        rssi = self._sampleRssi()
+        if rssi is not None:
+            self.rssi = rssi if self.rssi is None else (self.rssi * 3 + rssi) // 4
+            _rssi.set(self.rssi)
+            if self.rssi < self.roamRssi and (self._scannedAt is None or ticks_diff(now, self._scannedAt) >= self.roamScanMs):
+                self._scannedAt = now
+                self._roam()
+        return self.isUp()
+
+    async def run(self):
+        """poll() for an asyncio task"""
+        while True:
+            self.poll()
+            await asyncio.sleep((self.wifi.pollMs if self._connecting else self.sampleMs) / 1000)
+
+    def _sampleRssi(self):
+        try:
+            return self.wifi.wlan.status('rssi')
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _roam(self):
+        # the strongest known access point that beats the current one by roamMarginDb
+        current = self.wifi.ap['bssid'] if self.wifi.ap else None
+        known = dict(self.wifi.knownWifi)
+        best = None
+        for net in self.wifi.scan(0):
+            netSsid = str(net[0], 'utf-8')
+            if netSsid not in known or net[1] == current or net[3] < self.rssi + self.roamMarginDb:
+                continue
+            if best is None or net[3] > best[3]:
+                best = net
+        if best is None:
+            return
+        ap = {'ssid': str(best[0], 'utf-8'), 'bssid': best[1], 'channel': best[2]}
+        self.roams += 1
+        _roams.inc()
+        self._roaming = ap
+        self._lost()
+        self.wifi.wlan.disconnect()
+        self.wifi.start(ap=ap)
+        self._connecting = True
+
+    def _reconnect(self):
+        self.wifi.start()
+        self._connecting = True
+
+    def _lost(self):
+        self._downAt = ticks_ms()
+        self.rssi = None
+        if not self._roaming:
+            self.losses += 1
+            _losses.inc()
+        if not self.client == None :
+            self.client.drop()
+        if not self.onLinkLost == None and not self._roaming:
+            self.onLinkLost()
+
+    def _restored(self):
+        self.lastOutageMs = ticks_diff(ticks_ms(), self._downAt)
+        self._sampledAt = ticks_ms()
+        roamed = self._roaming
+        self._roaming = False
+        if roamed and not self.onRoamed == None :
+            self.onRoamed(self.wifi.ap)
+        if not self.onLinkRestored == None :
+            self.onLinkRestored(self.lastOutageMs)
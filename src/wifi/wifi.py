@@ -3,6 +3,27 @@ import time
 import json
 from machine import Timer
 
+from src.utils.ticks import ticks_ms, ticks_diff
+from src.utils.metrics import metrics
+from src.wifi.ap_store import APStore
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# states of the connection state machine
+IDLE = 0
+SCANNING = 1
+CONNECTING = 2
+CONNECTED = 3
+FAILED = 4
+
+STAT_GOT_IP = getattr(network, 'STAT_GOT_IP', 3)
+
+_connectMs = metrics.histogram('wifi.connectMs')
+_connectFailures = metrics.counter('wifi.connectFailures')
+
 class WIFI_MANAGER():
     """
     The Wifi Manager takes in a list of currently known wifi and tries to connect to the wifi in the list
@@ -21,10 +42,22 @@ class WIFI_MANAGER():
     + deactivate_wifi (will deactivate the wifi)
     + ledIndicateConnected (will turn on the led to indicate wifi is connected)
     + ledIndicateDisconnected (will blink the led to indicate wifi is disconnected)
+
+    connecting is a state machine: start() scans once, ranks the known networks found by signal strength and
+    step() moves it on without ever blocking for more than the scan, call it from your loop until it returns
+    True (or await run() from an asyncio task). Each network gets attemptTimeoutMs to come up before the next
+    one is tried, state tells where it is and connectTimeMs how long the last successful connection took.
+    By default __init__ runs it to the end before returning, pass autoConnect=False to drive it yourself
+
+    the access point of the last successful connection (ssid, bssid, channel) is kept in flash by apStore
+    (an APStore, pass apStore=False to turn it off): start() connects straight to it and only scans when
+    that fails, connectPath says which way it went ('cached' or 'scan'). Scan results are kept for
+    scanTtlMs and shared by scan_wifi and the connection, ap is the access point of the current connection
     
     """
 
-    def __init__(self, currentKnownListOfWifi, callbacks = {}, led = None ):
+    def __init__(self, currentKnownListOfWifi, callbacks = {}, led = None, autoConnect = True, attemptTimeoutMs = 10000, pollMs = 100,
+                 apStore = None, scanTtlMs = 30000):
             
         # get the wireless lan interface singleton
         self.wlan = network.WLAN(network.STA_IF)
@@ -42,26 +75,31 @@ class WIFI_MANAGER():
         self.callbacks = callbacks    
         self.onWifiConnected = self.callbacks['onWifiConnected']
         self.onWifiConnectedFailed = self.callbacks['onWifiConnectedFailed']
-    
-    
-        if (self.wlan.isconnected() == False):
-            # wifi is not connected
-
-            # create a handler to handle the connection fail
-            def _connectionFailHandler(payload):
-                return
-
-            for wifi in currentKnownListOfWifi:
-                # try to connect to the wifi using current known list of wifi
-                _ssid = currentKnownListOfWifi[wifi]['ssid']
-                _pw = currentKnownListOfWifi[wifi]['pw']
 
-                # connect to wifi using the know ssid and password, also passing the onWifiConnected and onWifiConnectedFailed handlers
-                connected = self.connect_to_wifi(ssid=_ssid,pw=_pw,onWifiConnected=self.onWifiConnected,onWifiConnectedFailed=_connectionFailHandler)
-                
-                # if connected break the loop and exit
-                if connected:
-                    break
+        # the known networks as (ssid, password)
+        self.knownWifi = [(currentKnownListOfWifi[wifi]['ssid'], currentKnownListOfWifi[wifi]['pw']) for wifi in currentKnownListOfWifi]
+        self.attemptTimeoutMs = attemptTimeoutMs
+        self.pollMs = pollMs
+        self.state = IDLE
+        self.connectTimeMs = None
+        self._queue = []
+        self._candidates = None
+        self._run = None
+        self._direct = None
+        self.apStore = APStore() if apStore is None else apStore
+        self.connectPath = None
+        # the access point connected to, {'ssid', 'bssid', 'channel'}
+        self.ap = None
+        self.scanTtlMs = scanTtlMs
+        self._scanned = None
+        self._scannedAt = 0
+    
+        if not autoConnect:
+            pass
+        elif (self.wlan.isconnected() == False):
+            # wifi is not connected, try the known networks, strongest first
+            self.start()
+            self.wait()
         else:
             # wifi is already connected
             status = self.wlan.ifconfig()
@@ -80,6 +118,140 @@ class WIFI_MANAGER():
             # blink led to indicate disconnected    
             self.timer1.init(period=100, mode=Timer.PERIODIC, callback=lambda t: self.led.value(not self.led.value()))
 
+    def start(self, candidates = None, payload = None, onWifiConnected = None, onWifiConnectedFailed = None, ap = None):
+        """Begin connecting to one of candidates ([(ssid, pw)], the known networks by default)
+
+        ap ({'ssid', 'bssid', 'channel'}) is the access point to try first, the remembered one by default
+        """
+        self._candidates = candidates if candidates is not None else self.knownWifi
+        # callbacks of this run and the payload handed back to them
+        self._run = (payload,
+                     onWifiConnected if onWifiConnected is not None else self.onWifiConnected,
+                     onWifiConnectedFailed if onWifiConnectedFailed is not None else self.onWifiConnectedFailed)
+        self._startedAt = ticks_ms()
+        self._tried = 0
+        self._direct = None
+        # go straight to the last access point when it is one of the candidates
+        cached = ap if ap is not None else self._loadAP()
+        pw = dict(self._candidates).get(cached['ssid']) if cached else None
+        if pw is not None:
+            self.activate_wifi()
+            self._direct = cached
+            self._queue = []
+            self._attempt(cached['ssid'], pw, cached['bssid'])
+        else:
+            self.state = SCANNING
+
+    def step(self):
+        """Move the connection on, returns True once it has connected or failed"""
+        if self.state == SCANNING:
+            self.activate_wifi()
+            # one scan for all the candidates, the strongest access point of each ssid
+            seen = {}
+            for net in self.scan():
+                netSsid = str(net[0], 'utf-8')
+                if netSsid not in seen or net[3] > seen[netSsid][3]:
+                    seen[netSsid] = net
+            self._seen = seen
+            self._queue = [c for c in self._candidates if c[0] in seen]
+            self._queue.sort(key=lambda c: seen[c[0]][3], reverse=True)
+            self._next()
+        elif self.state == CONNECTING:
+            # possible status: 0=STAT_IDLE, 1=STAT_CONNECTING, 3=STAT_GOT_IP, negative on failure
+            status = self.wlan.status()
+            if status == STAT_GOT_IP:
+                self._connected()
+            elif status < 0 or ticks_diff(ticks_ms(), self._attemptAt) >= self.attemptTimeoutMs:
+                self.wlan.disconnect()
+                if self._direct:
+                    # the remembered access point is gone, look around
+                    self._direct = None
+                    self.state = SCANNING
+                else:
+                    self._next()
+        return self.state == CONNECTED or self.state == FAILED
+
+    def wait(self):
+        """Step until connected or failed, returns True when connected"""
+        while not self.step():
+            time.sleep_ms(self.pollMs)
+        return self.state == CONNECTED
+
+    async def run(self):
+        """wait() for an asyncio task, returns True when connected"""
+        while not self.step():
+            await asyncio.sleep(self.pollMs / 1000)
+        return self.state == CONNECTED
+
+    def _next(self):
+        # try the next candidate, or give up
+        if not self._queue:
+            self.state = FAILED
+            _connectFailures.inc()
+            payload, _, onWifiConnectedFailed = self._run
+            ssids = ", ".join(c[0] for c in self._candidates)
+            # none of them showed up in the scan
+            reason = " connection failed" if self._tried else " is not valid"
+            self.ledIndicateDisconnected()
+            if onWifiConnectedFailed:
+                onWifiConnectedFailed({"result":False, "data":ssids+reason,"cmd":payload})
+            return
+        ssid, pw = self._queue.pop(0)
+        self._attempt(ssid, pw, self._seen[ssid][1])
+
+    def _attempt(self, ssid, pw, bssid):
+        self._ssid = ssid
+        self._tried += 1
+        self._attemptAt = ticks_ms()
+        try:
+            self.wlan.connect(ssid, pw, bssid=bssid)
+        except TypeError:
+            # firmware without the bssid argument
+            self.wlan.connect(ssid, pw)
+        self.state = CONNECTING
+
+    def _connected(self):
+        self.state = CONNECTED
+        self.connectTimeMs = _connectMs.since(self._startedAt, ticks_ms())
+        if self._direct:
+            self.connectPath = 'cached'
+            self.ap = self._direct
+        else:
+            self.connectPath = 'scan'
+            net = self._seen[self._ssid]
+            self.ap = {'ssid': self._ssid, 'bssid': net[1], 'channel': net[2]}
+        self._saveAP(self.ap['ssid'], self.ap['bssid'], self.ap['channel'])
+        payload, onWifiConnected, _ = self._run
+        status = self.wlan.ifconfig()
+        data = "Network connected"+ str(status)
+        self.ledIndicateConnected()
+        if onWifiConnected:
+            onWifiConnected({"result":True, "data":str(self._ssid)+" connected" + data,"cmd":payload,
+                             "timeMs":self.connectTimeMs})
+
+    def scan(self, maxAgeMs = None):
+        """The networks around as wlan.scan() lists them, the last results while they are younger than maxAgeMs (scanTtlMs)"""
+        if maxAgeMs is None:
+            maxAgeMs = self.scanTtlMs
+        if self._scanned is None or ticks_diff(ticks_ms(), self._scannedAt) >= maxAgeMs:
+            self._scanned = self.wlan.scan()
+            self._scannedAt = ticks_ms()
+        return self._scanned
+
+    def _loadAP(self):
+        if not self.apStore:
+            return None
+        return self.apStore.load()
+
+    def _saveAP(self, ssid, bssid, channel):
+        if not self.apStore:
+            return
+        try:
+            self.apStore.save(ssid, bssid, channel)
+        except OSError:
+            # a full or read only flash only costs a scan next time
+            pass
+
     # helper function to check if wifi is connected
     def isWifiConnected(self):
         return self.wlan.isconnected()
@@ -99,7 +271,7 @@ class WIFI_MANAGER():
         # authmodes = ['Open', 'WEP', 'WPA-PSK' 'WPA2-PSK4', 'WPA/WPA2-PSK', 'Hidden', '']
         if self.wlan.active :
             # scan for wifi in the vicinity, and return the list of wifi found 
-            wifi_list = self.wlan.scan()
+            wifi_list = self.scan()
             wifis = []
 
             for item in wifi_list:
@@ -133,18 +305,6 @@ class WIFI_MANAGER():
     # connect to wifi using the ssid and password
     def connect_to_wifi(self,ssid,pw,payload = None,onWifiConnected = None, onWifiConnectedFailed = None, force=False):
         
-        # check if onWifiConnectedFailed is passed in as a parameter
-        # if not then used the callback handler that was passed in during initialization
-        if onWifiConnectedFailed == None :
-            if "onWifiConnectedFailed" in callbacks:
-                onWifiConnectedFailed = self.onWifiConnectedFailed
-        
-        # check if onWifiConnected is passed in as a parameter
-        # if not then used the callback handler that was passed in during initialization
-        if onWifiConnected == None:
-            if self.onWifiConnected:
-                onWifiConnected = self.onWifiConnected
-
         # check if wifi is already connected  
         # if force was passed in as parameter then force the connection to disconnect
         # prior to connecting to the new wifi
@@ -156,58 +316,14 @@ class WIFI_MANAGER():
             else:
                 # if force was passed in as a parameter then
                 # just report that wifi has been connected and return
+                if onWifiConnected == None:
+                    onWifiConnected = self.onWifiConnected
                 status = self.wlan.ifconfig()
                 data = "Network connected"+ str(status)
                 onWifiConnected({"result":True, "data":data,"cmd":payload})
                 self.ledIndicateConnected()
                 return
         
-        '''
-        Start the wifi connection process
-        '''
-        
-        # make sure the the wifi is activated
-        self.activate_wifi()
-        
-        # scan for ssid in the vicinity      
-        nets = self.wlan.scan()
-        nets_ssid = []
-        for net in nets:
-            net_ssid = str(net[0], 'utf-8')
-            nets_ssid.append(net_ssid)
-
-        #compare the detected list of wifi with the ssid to be connected passed in as parameter
-        if ssid in nets_ssid:
-            self.wlan.connect(ssid, pw)
-            # allow 10 attempts for connections
-            max_wait = 10                
-            while max_wait > 0:
-                # possible status:
-                # [0=STAT_IDLE, 1=STAT_CONNECTING, 2=STAT_WRONG_PASSWORD, 3=STAT_NO_AP_FOUND, 4=STAT_CONNECT_FAIL, 5=STAT_GOT_IP]
-                if self.wlan.status() < 0 or self.wlan.status() >= 3:
-                    break
-                max_wait -= 1
-                # print('waiting for connection to '+str(ssid)+'...')
-                time.sleep(1)
-            
-            if self.wlan.status() != 3:
-                connectFailMessage = {"result":False, "data":str(ssid)+" connection failed","cmd":payload}
-                onWifiConnectedFailed(connectFailMessage)
-                self.ledIndicateDisconnected()
-                return False
-            else:
-                # wifi is now connected
-                status = self.wlan.ifconfig()
-                data = "Network connected"+ str(status)
-
-                # call the handler when on wifi is connected
-                onWifiConnected({"result":True, "data":str(ssid)+" connected" + data,"cmd":payload})
-                self.ledIndicateConnected()
-                return True
-        else:
-
-            connectFailMessage = {"result":False, "data":str(ssid)+" is not valid","cmd":payload}
-            # call the handler when on wifi connection failed
-            onWifiConnectedFailed(connectFailMessage)
-            self.ledIndicateDisconnected()
-            return False
\ No newline at end of file
+        # run the state machine with this one network, the handlers default to the ones passed in at initialization
+        self.start([(ssid, pw)], payload, onWifiConnected, onWifiConnectedFailed)
+        return self.wait()